@@ -1,14 +1,20 @@
 import logging
 import os
-import random
-import string
 import asyncio
-import sqlite3
 import datetime
+import time
+from typing import Optional, Tuple
+import functools
+import html
+import tempfile
+from zoneinfo import ZoneInfo
 from aiogram import Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
     KeyboardButton,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -19,6 +25,18 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+import database as db
+import importer
+import maintenance
+from export import EXPORT_FORMATS, GameExport
+from fsm_storage import FSM_TTL, SQLiteStorage
+from outbox import Outbox
+from scheduler import Scheduler
+from cache import TTLCache, is_missing
+from dispatch import CommandTable
+from throttle import ThrottlingMiddleware
+from metrics import HANDLER_ERRORS, METRICS_PORT, Gauge, HandlerMetricsMiddleware, start_metrics_server
+
 # === ЛОГИРОВАНИЕ ===
 logging.basicConfig(
     level=logging.INFO,
@@ -30,10 +48,70 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("Переменная окружения BOT_TOKEN не задана!")
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# polling (по умолчанию), webhook или cluster (ingress + CLUSTER_WORKERS процессов);
+# worker — процесс кластера, его запускает ingress
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Свой сервер Bot API (например, локальный telegram-bot-api); по умолчанию — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+MENU_CACHE_TTL = float(os.getenv("MENU_CACHE_TTL", "300"))
+# Записи участников после жеребьёвки: размер — в записях (каждая с двумя пожеланиями)
+PARTICIPANT_CACHE_SIZE = int(os.getenv("PARTICIPANT_CACHE_SIZE", "10000"))
+PARTICIPANT_CACHE_TTL = float(os.getenv("PARTICIPANT_CACHE_TTL", "300"))
+
+# Часовой пояс, в котором организаторы указывают время в /schedule
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Europe/Moscow"))
+
+# /admin_archive без аргумента архивирует игры после жеребьёвки старше стольких дней
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "60"))
+
+# sqlite (по умолчанию), memory или redis://host:port/db (нужен пакет redis)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+if FSM_STORAGE.startswith("redis://"):
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(FSM_STORAGE, state_ttl=int(FSM_TTL), data_ttl=int(FSM_TTL))
+elif FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+else:
+    storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
+# Ограничитель частоты ставим перед FSM-middleware: оно читает состояние из хранилища
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(ThrottlingMiddleware())
+dp.update.outer_middleware(dp.fsm)
 router = Router()
+# Кнопки меню и callback-кнопки: поиск обработчика по словарю
+menu = CommandTable()
+menu.setup(router)
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+
+async def collect_outbox():
+    return await db.run(db.count_outbox)
+
+async def collect_fsm_states():
+    return await db.run(db.count_fsm_states)
+
+Gauge("santa_outbox_messages", "Сообщения в очереди по статусу", ("status",), collect_outbox)
+if isinstance(storage, SQLiteStorage):
+    Gauge("santa_fsm_states", "Пользователи в состояниях FSM", ("state",), collect_fsm_states)
+outbox = Outbox(bot)
+scheduler = Scheduler()
+
+async def collect_scheduled_jobs():
+    return {(): len(scheduler)}
+
+Gauge("santa_scheduler_queue", "Записи в куче планировщика", (), collect_scheduled_jobs)
+
+async def collect_db_pages():
+    page_count, free_pages, page_size = await db.run(db.get_db_pages)
+    return {("total",): page_count * page_size, ("free",): free_pages * page_size}
+
+Gauge("santa_db_bytes", "Размер файла БД и свободное место в нём", ("kind",), collect_db_pages)
 
 # === FSM ===
 class Form(StatesGroup):
@@ -42,6 +120,7 @@ class Form(StatesGroup):
     waiting_for_santa_message = State()
     waiting_for_ward_message = State()
     waiting_for_announcement = State()
+    waiting_for_import = State()
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
@@ -52,33 +131,22 @@ def get_main_kb_static():
             [KeyboardButton(text="🆕 Создать игру"), KeyboardButton(text="🚪 Присоединиться")],
             [KeyboardButton(text="🎁 Мои пожелания"), KeyboardButton(text="📜 Пожелания подопечного")],
             [KeyboardButton(text="🎅 Написать Санте"), KeyboardButton(text="👧 Написать подопечному")],
-            [KeyboardButton(text="🚪 Покинуть игру")]
+            [KeyboardButton(text="🎮 Мои игры"), KeyboardButton(text="🚪 Покинуть игру")]
         ],
         resize_keyboard=True
     )
 
-async def get_main_kb(user_id: int) -> ReplyKeyboardMarkup:
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (user_id,))
-    game_row = c.fetchone()
-    conn.close()
-
+@functools.lru_cache(maxsize=None)
+def build_main_kb(is_creator: bool, draw_done: bool) -> ReplyKeyboardMarkup:
+    """Клавиатура для набора флагов; вариантов всего три, строятся один раз"""
     keyboard = [
         [KeyboardButton(text="🆕 Создать игру"), KeyboardButton(text="🚪 Присоединиться")],
         [KeyboardButton(text="🎁 Мои пожелания"), KeyboardButton(text="📜 Пожелания подопечного")],
         [KeyboardButton(text="🎅 Написать Санте"), KeyboardButton(text="👧 Написать подопечному")],
-        [KeyboardButton(text="🚪 Покинуть игру")]
+        [KeyboardButton(text="🎮 Мои игры"), KeyboardButton(text="🚪 Покинуть игру")]
     ]
 
-    if game_row:
-        game_code = game_row[0]
-        conn = sqlite3.connect("santa.db")
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM participants WHERE game_code = ? AND ward_of IS NOT NULL LIMIT 1", (game_code,))
-        draw_done = c.fetchone() is not None
-        conn.close()
-
+    if is_creator:
         if not draw_done:
          keyboard.insert(1, [KeyboardButton(text="🎲 Жеребьёвка")])
         keyboard.insert(1, [KeyboardButton(text="👥 Список участников")])
@@ -87,6 +155,164 @@ async def get_main_kb(user_id: int) -> ReplyKeyboardMarkup:
 
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
+# user_id -> (game_code созданной игры или None, draw_done)
+# В режиме кластера сброс виден только процессу, который изменил данные.
+# Жеребьёвка по расписанию и удаление заброшенных игр выполняются в ingress,
+# поэтому воркеры показывают прежнее меню (кнопку «🎲 Жеребьёвка», удалённую
+# игру) не дольше MENU_CACHE_TTL; сами обработчики проверяют состояние по БД.
+menu_cache = TTLCache(ttl=MENU_CACHE_TTL)
+
+def invalidate_menu(user_id: int):
+    menu_cache.pop(user_id)
+
+def invalidate_menu_for_game(game_code: str):
+    menu_cache.invalidate_where(lambda flags: flags[0] == game_code)
+
+async def get_main_kb(user_id: int) -> ReplyKeyboardMarkup:
+    flags = menu_cache.get(user_id)
+    if is_missing(flags):
+        game_code = await db.run(db.get_creator_game, user_id)
+        draw_done = bool(game_code) and await db.run(db.is_draw_done, game_code)
+        flags = (game_code, draw_done)
+        menu_cache.set(user_id, flags)
+
+    game_code, draw_done = flags
+    return build_main_kb(bool(game_code), draw_done)
+
+# user_id -> запись из db.get_participant:
+# (game_code, santa_id, ward_id, wish, ward_full_name, ward_username, ward_wish).
+# Кэшируются только записи после жеребьёвки: пары уже не меняются, а изменения
+# пожеланий, выход из игры и удаление игры сбрасывают записи сразу. В режиме
+# кластера изменения из других процессов видны не позже PARTICIPANT_CACHE_TTL.
+participant_cache = TTLCache(ttl=PARTICIPANT_CACHE_TTL, maxsize=PARTICIPANT_CACHE_SIZE)
+
+async def get_participant(user_id: int):
+    record = participant_cache.get(user_id)
+    if is_missing(record):
+        record = await db.run(db.get_participant, user_id)
+        if record and record[2]:
+            participant_cache.set(user_id, record)
+    return record
+
+def invalidate_participant(user_id: int):
+    participant_cache.pop(user_id)
+
+def invalidate_participants_for_game(game_code: str):
+    participant_cache.invalidate_where(lambda record: record[0] == game_code)
+
+# === ПОСТРАНИЧНЫЕ СПИСКИ ===
+PAGE_SIZE = 20
+MESSAGE_LIMIT = 4096
+FIELD_LIMIT = 500  # длинные имена и пожелания в списках обрезаются
+
+def clip(text: str, limit: int = FIELD_LIMIT) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def tg_len(text: str) -> int:
+    """Длина в единицах UTF-16, как её считает Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+def format_participant_row(row) -> str:
+    _, full_name, username, wish = row
+    name = html.escape(clip(full_name or "Без имени"))
+    if username:
+        name += f" (@{html.escape(username)})"
+    wish_text = html.escape(clip(wish.strip())) if wish and wish.strip() else "— не указаны"
+    return f"• {name}\n  🎁 {wish_text}\n\n"
+
+def format_user_row(row) -> str:
+    _, uid, name, username, game_code = row
+    name_display = html.escape(clip(name or f"ID{uid}"))
+    if username:
+        name_display += f" (@{html.escape(username)})"
+    return f"• {name_display}\n  Игра: <code>{game_code}</code>\n\n"
+
+def format_game_row(row) -> str:
+    game_code, creator_id, participant_count = row
+    return (f"• Код: <code>{game_code}</code> | Создатель: <code>{creator_id}</code>"
+            f" | Участников: {participant_count or 0}\n")
+
+def format_stats(game_code: str, stats) -> str:
+    participant_count, wishes_set, draw_done, gifts_bought, created_at = stats
+    created = datetime.datetime.fromtimestamp(created_at).strftime("%d.%m.%Y")
+    return (
+        f"📊 Игра <b>{game_code}</b> (создана {created})\n\n"
+        f"👥 Участников: {participant_count}\n"
+        f"🎁 Указали пожелания: {wishes_set} из {participant_count}\n"
+        f"🎲 Жеребьёвка: {'проведена' if draw_done else 'не проведена'}\n"
+        f"🛍 Купили подарки: {gifts_bought} из {participant_count}"
+    )
+
+CALLBACK_DATA_LIMIT = 64  # байт в callback_data
+
+def participant_cursor(row) -> str:
+    """Ключ сортировки (full_name, user_id) для callback_data: "user_id:обрезано:имя".
+
+    Имя обрезается по байтам, чтобы уложиться в лимит callback_data.
+    """
+    user_id, full_name = row[0], row[1] or ""
+    head = f"{user_id}:"
+    budget = CALLBACK_DATA_LIMIT - len(f"pg:p:a:{head}0:".encode())
+    name = full_name.encode()[:budget].decode("utf-8", "ignore")
+    return f"{head}{int(name != full_name)}:{name}"
+
+def parse_participant_cursor(cursor: str, backward: bool) -> Tuple[str, int]:
+    user_id, cut, name = cursor.split(":", 2)
+    if cut == "1" and backward:
+        # От обрезанного имени назад: берём верхнюю границу всех имён с этим
+        # началом — строки могут повториться, но не пропадут
+        name += "\U0010ffff"
+    return name, int(user_id)
+
+# вид списка -> (выборка страницы, формат строки, заголовок, курсор строки, разбор курсора)
+LISTINGS = {
+    "p": (db.get_participants_page, format_participant_row,
+          lambda game_code: f"📋 Участники игры <b>{game_code}</b>:\n\n",
+          participant_cursor, parse_participant_cursor),
+    "u": (db.get_users_page, format_user_row, lambda _: "👥 Список пользователей:\n\n",
+          lambda row: str(row[0]), lambda cursor, _: int(cursor)),
+    "g": (db.get_games_page, format_game_row, lambda _: "🎮 Список игр:\n\n",
+          lambda row: row[0], lambda cursor, _: cursor),
+}
+
+async def render_listing(kind: str, scope: Optional[str] = None, after=None, before=None):
+    """Текст страницы списка и кнопки ◀ / ▶; (None, None), если строк нет.
+
+    Страница содержит столько строк, сколько помещается в одно сообщение,
+    остальные переходят на соседнюю страницу — ничего не теряется.
+    """
+    fetch, format_row, header, cursor, _ = LISTINGS[kind]
+    args = (scope,) if scope is not None else ()
+    rows, has_more = await db.run(fetch, *args, after=after, before=before, limit=PAGE_SIZE)
+    if not rows:
+        return None, None
+
+    header_text = header(scope)
+    budget = MESSAGE_LIMIT - tg_len(header_text)
+    lines = [format_row(row) for row in rows]
+    backward = before is not None
+    order = range(len(lines) - 1, -1, -1) if backward else range(len(lines))
+    kept = []
+    for i in order:
+        budget -= tg_len(lines[i])
+        if budget < 0 and kept:
+            has_more = True
+            break
+        kept.append(i)
+    kept.sort()
+    rows = [rows[i] for i in kept]
+    text = header_text + "".join(lines[i] for i in kept)
+
+    has_prev = has_more if backward else after is not None
+    has_next = True if backward else has_more
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="◀", callback_data=f"pg:{kind}:b:{cursor(rows[0])}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="▶", callback_data=f"pg:{kind}:a:{cursor(rows[-1])}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, kb
+
 def get_gift_confirmation_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -99,19 +325,13 @@ def get_gift_confirmation_kb():
 
 @router.message(Command("start"))
 async def cmd_start(message: Message):
-    from database import init_db
-    init_db()
     await message.answer("🎄 Добро пожаловать в игру «Тайный Дед Мороз»!", reply_markup=await get_main_kb(message.from_user.id))
 
-@router.message(lambda m: m.text == "🆕 Создать игру")
+@menu.button("🆕 Создать игру")
 async def create_game_handler(message: Message):
-    from database import create_game
-    # 🔒 Проверка: уже есть игра?
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM games WHERE creator_id = ?", (message.from_user.id,))
-    if c.fetchone():
-        conn.close()
+    # 🔒 Код выделяется вместе с проверкой: у создателя может быть только одна игра
+    game_code = await db.run(db.create_game, message.from_user.id)
+    if not game_code:
         await message.answer(
             "❌ Вы уже создали игру.\n\n"
             "Сначала удалите её через кнопку «🗑 Удалить игру», "
@@ -119,17 +339,15 @@ async def create_game_handler(message: Message):
             reply_markup=await get_main_kb(message.from_user.id)
         )
         return
-    conn.close()
 
-    game_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    create_game(game_code, message.from_user.id)
+    invalidate_menu(message.from_user.id)
     await message.answer(
         f"✅ Игра создана! Код для участников:\n\n<b>{game_code}</b>\n\nПоделись этим кодом, чтобы друзья присоединились!\n\nчтобы принять участие в своей игре, нажми кнопку <b>🚪 Присоединиться</b>",
         parse_mode="HTML",
         reply_markup=await get_main_kb(message.from_user.id)
     )
 
-@router.message(lambda m: m.text == "🚪 Присоединиться")
+@menu.button("🚪 Присоединиться")
 async def join_game_start(message: Message, state: FSMContext):
     await message.answer("Введите код игры:", reply_markup=ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="❌ Отмена")]], resize_keyboard=True
@@ -142,26 +360,27 @@ async def join_game_process(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Отменено.", reply_markup=await get_main_kb(message.from_user.id))
         return
-    from database import join_game
-    success = join_game(
+    success = await db.run(
+        db.join_game,
         user_id=message.from_user.id,
         username=message.from_user.username or str(message.from_user.id),
         full_name=message.from_user.full_name,
         game_code=message.text.strip().upper()
     )
     if success:
+        invalidate_participant(message.from_user.id)
         await message.answer(
-            f"✅ Вы присоединились к игре!\n\nТеперь в меню нажмите кнопку\n\n🎁<b>Мои пожелания</b>\n\nи задайте свои пожелания.", parse_mode="HTML",
+            f"✅ Вы присоединились к игре!\n\nТеперь в меню нажмите кнопку\n\n🎁<b>Мои пожелания</b>\n\nи задайте свои пожелания.\n\nИгра стала активной — переключаться между играми можно кнопкой «🎮 Мои игры».", parse_mode="HTML",
             reply_markup=await get_main_kb(message.from_user.id)
         )
     else:
         await message.answer("❌ Вы уже участвуете или код неверный.", reply_markup=await get_main_kb(message.from_user.id))
     await state.clear()
 
-@router.message(lambda m: m.text == "🎁 Мои пожелания")
+@menu.button("🎁 Мои пожелания")
 async def wish_start_or_edit(message: Message, state: FSMContext):
-    from database import get_wish
-    current_wish = get_wish(message.from_user.id)
+    record = await get_participant(message.from_user.id)
+    current_wish = record[3] if record else ""
 
     if current_wish and current_wish.strip():
         # Пожелание уже есть — показываем и спрашиваем, менять ли
@@ -192,29 +411,22 @@ async def wish_save(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Отменено.", reply_markup=await get_main_kb(message.from_user.id))
         return
-    from database import set_wish
-    set_wish(message.from_user.id, message.text)
+    santa_id = await db.run(db.set_wish, message.from_user.id, message.text)
+    invalidate_participant(message.from_user.id)
+    if santa_id:
+        invalidate_participant(santa_id)
     await message.answer("✅ Пожелания сохранены!", reply_markup=await get_main_kb(message.from_user.id))
     await state.clear()
 
-@router.message(lambda m: m.text == "📜 Пожелания подопечного")
+@menu.button("📜 Пожелания подопечного")
 async def show_ward_wish(message: Message):
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("""
-        SELECT p.ward_of, p2.full_name, p2.username, p2.wish
-        FROM participants p
-        LEFT JOIN participants p2 ON p.ward_of = p2.user_id
-        WHERE p.user_id = ?
-    """, (message.from_user.id,))
-    row = c.fetchone()
-    conn.close()
-
-    if not row or not row[0]:
+    record = await get_participant(message.from_user.id)
+
+    if not record or not record[2]:
         await message.answer("❌ Жеребьёвка ещё не проведена.", reply_markup=await get_main_kb(message.from_user.id))
         return
 
-    ward_id, full_name, username, wish = row
+    _, _, ward_id, _, full_name, username, wish = record
     name_display = full_name or f"ID{ward_id}"
     if username:
         name_display += f" (@{username})"
@@ -228,18 +440,14 @@ async def show_ward_wish(message: Message):
         reply_markup=get_gift_confirmation_kb()
     )
 
-@router.message(lambda m: m.text == "📣 Отправить объявление")
+@menu.button("📣 Отправить объявление")
 async def start_announcement(message: Message, state: FSMContext):
     user_id = message.from_user.id
 
     # Проверим, что пользователь — создатель
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (user_id,))
-    game_row = c.fetchone()
-    conn.close()
+    game_code = await db.run(db.get_creator_game, user_id)
 
-    if not game_row:
+    if not game_code:
         await message.answer("❌ Эта функция доступна только создателю игры.")
         return
 
@@ -252,7 +460,7 @@ async def start_announcement(message: Message, state: FSMContext):
     )
     await state.set_state(Form.waiting_for_announcement)
     # Сохраним код игры в состоянии, чтобы знать, кому рассылать
-    await state.update_data(game_code=game_row[0])
+    await state.update_data(game_code=game_code)
 
 @router.message(Form.waiting_for_announcement)
 async def send_announcement(message: Message, state: FSMContext):
@@ -271,57 +479,45 @@ async def send_announcement(message: Message, state: FSMContext):
         return
 
     # Получаем всех участников этой игры
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM participants WHERE game_code = ?", (game_code,))
-    user_ids = [row[0] for row in c.fetchall()]
-    conn.close()
+    user_ids = await db.run(db.get_participants, game_code)
 
     if not user_ids:
         await message.answer("📭 В игре нет участников.", reply_markup=ReplyKeyboardRemove())
         await state.clear()
         return
 
-    # Рассылаем объявление
-    success = 0
-    for uid in user_ids:
-        try:
-            await bot.send_message(
-                uid,
-                f"🔔 <b>Объявление от организатора игры {game_code}:</b>\n\n{announcement_text}",
-                parse_mode="HTML"
-            )
-            success += 1
-        except Exception as e:
-            print(f"Не удалось отправить {uid}: {e}")
+    # Ставим объявление в очередь, прогресс воркер показывает в одном сообщении
+    text = f"🔔 <b>Объявление от организатора игры {game_code}:</b>\n\n{announcement_text}"
+    job_id = f"announce:{message.chat.id}:{message.message_id}"
+    status = await message.answer("📤 Рассылка начата...")
+    queued = await outbox.enqueue(
+        [(uid, text, "HTML", f"{job_id}:{uid}") for uid in user_ids],
+        job_id=job_id,
+        status_message=status
+    )
 
     await message.answer(
-        f"✅ Объявление отправлено {success} из {len(user_ids)} участников.",
+        f"✅ Объявление поставлено в очередь для {queued} из {len(user_ids)} участников.",
         reply_markup=await get_main_kb(message.from_user.id)
     )
     await state.clear()
 
-@router.message(lambda m: m.text == "🗑 Удалить игру")
+@menu.button("🗑 Удалить игру")
 async def confirm_delete_game(message: Message):
     user_id = message.from_user.id
 
     # Найдём игру, которую создал пользователь
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (user_id,))
-    game_row = c.fetchone()
-    conn.close()
+    game_code = await db.run(db.get_creator_game, user_id)
 
-    if not game_row:
+    if not game_code:
         await message.answer("❌ Вы не создавали игру.")
         return
 
-    game_code = game_row[0]
-
     # Отправляем подтверждение с инлайн-кнопками
     await message.answer(
         f"⚠️ Вы уверены, что хотите удалить игру <b>{game_code}</b>?\n\n"
-        "Все участники и данные будут безвозвратно удалены.",
+        "Все участники и данные будут удалены. Если жеребьёвка уже прошла, "
+        "итоги игры сохранятся в архиве.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -331,7 +527,7 @@ async def confirm_delete_game(message: Message):
         ])
     )
 
-@router.callback_query(lambda c: c.data.startswith("delgame_yes_"))
+@menu.callback(prefix="delgame_yes_")
 async def handle_delete_game_confirm(callback: types.CallbackQuery):
     await callback.answer("игра удалена.")
 
@@ -341,13 +537,9 @@ async def handle_delete_game_confirm(callback: types.CallbackQuery):
         if not game_code:
             raise ValueError("Пустой код игры")
 
-        conn = sqlite3.connect("santa.db")
-        c = conn.cursor()
-        c.execute("DELETE FROM participants WHERE game_code = ?", (game_code,))
-        c.execute("DELETE FROM games WHERE game_code = ?", (game_code,))
-        deleted = c.rowcount > 0
-        conn.commit()
-        conn.close()
+        deleted = await db.run(db.delete_game, game_code)
+        invalidate_menu_for_game(game_code)
+        invalidate_participants_for_game(game_code)
 
         if deleted:
             await callback.message.edit_text(
@@ -356,50 +548,47 @@ async def handle_delete_game_confirm(callback: types.CallbackQuery):
             )
         else:
             await callback.message.edit_text("❌ Игра не найдена.")
-    except Exception as e:
-        print(f"Ошибка удаления игры: {e}")
+    except Exception:
+        logging.exception(f"Ошибка удаления игры ({callback.data}) от {callback.from_user.id}")
+        HANDLER_ERRORS.inc("handle_delete_game_confirm")
         await callback.message.edit_text("⚠️ Ошибка при удалении игры.")
 
 
-@router.callback_query(lambda c: c.data == "delgame_cancel")
+@menu.callback("delgame_cancel")
 async def handle_delete_game_cancel(callback: types.CallbackQuery):
     await callback.answer("отменено.")
     await callback.message.edit_text(f"↩️ Удаление отменено.")
 
-@router.callback_query(lambda c: c.data == "gift_bought")
+@menu.callback("gift_bought")
 async def handle_gift_bought(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT ward_of FROM participants WHERE user_id = ?", (user_id,))
-    ward_row = c.fetchone()
-    conn.close()
+    record = await get_participant(user_id)
+    game_code, _, ward_id = record[:3] if record else (None, None, None)
 
-    if not ward_row or not ward_row[0]:
+    if not ward_id:
         await callback.answer("Ошибка: подопечный не найден.", show_alert=True)
         return
 
-    ward_id = ward_row[0]
-    try:
-        await bot.send_message(
-            ward_id,
-            "🎅 <b>Хорошие новости!</b>\n\n"
-            "Ваш Санта уже купил для вас подарок! 🎁\n"
-            "Осталось дождаться вручения!",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Не удалось отправить подопечному {ward_id}: {e}")
+    await db.run(db.mark_gift_bought, user_id)
+
+    await outbox.send(
+        ward_id,
+        "🎅 <b>Хорошие новости!</b>\n\n"
+        "Ваш Санта уже купил для вас подарок! 🎁\n"
+        "Осталось дождаться вручения!",
+        parse_mode="HTML",
+        dedup_key=f"gift:{game_code}:{user_id}:{ward_id}"
+    )
 
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.message.answer("✅ Отлично! Подопечный получил уведомление.", reply_markup=await get_main_kb(user_id))
 
-@router.callback_query(lambda c: c.data == "gift_cancel")
+@menu.callback("gift_cancel")
 async def handle_gift_cancel(callback: types.CallbackQuery):
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.message.answer("↩️ Возврат в главное меню.", reply_markup=await get_main_kb(callback.from_user.id))
 
-@router.callback_query(lambda c: c.data == "edit_wish_yes")
+@menu.callback("edit_wish_yes")
 async def handle_edit_wish_yes(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.message.answer(
@@ -411,16 +600,15 @@ async def handle_edit_wish_yes(callback: types.CallbackQuery, state: FSMContext)
     )
     await state.set_state(Form.waiting_for_wish)
 
-@router.callback_query(lambda c: c.data == "edit_wish_no")
+@menu.callback("edit_wish_no")
 async def handle_edit_wish_no(callback: types.CallbackQuery):
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.message.answer("↩️ Возврат в главное меню.", reply_markup=await get_main_kb(callback.from_user.id))
 
-@router.message(lambda m: m.text == "🎅 Написать Санте")
+@menu.button("🎅 Написать Санте")
 async def to_santa_start(message: Message, state: FSMContext):
-    from database import get_santa_id
-    santa_id = get_santa_id(message.from_user.id)
-    if not santa_id:
+    record = await get_participant(message.from_user.id)
+    if not record or not record[1]:
         await message.answer("❌ Жеребьёвка ещё не проведена.", reply_markup=await get_main_kb(message.from_user.id))
         return
     await message.answer("Напишите сообщение своему Санте:", reply_markup=ReplyKeyboardMarkup(
@@ -434,22 +622,23 @@ async def to_santa_send(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Отменено.", reply_markup=await get_main_kb(message.from_user.id))
         return
-    from database import get_santa_id
-    santa_id = get_santa_id(message.from_user.id)
+    record = await get_participant(message.from_user.id)
+    santa_id = record[1] if record else None
     if santa_id:
-        try:
-            await bot.send_message(santa_id, f"📬 Ваш подопечный прислал сообщение:\n\n<i>{message.text}</i>", parse_mode="HTML")
-            await message.answer("✅ Сообщение отправлено Санте!")
-        except:
-            await message.answer("⚠️ Не удалось отправить сообщение.")
+        await outbox.send(
+            santa_id,
+            f"📬 Ваш подопечный прислал сообщение:\n\n<i>{message.text}</i>",
+            parse_mode="HTML",
+            dedup_key=f"msg:{message.chat.id}:{message.message_id}"
+        )
+        await message.answer("✅ Сообщение отправлено Санте!")
     await state.clear()
     await message.answer("Возврат в меню.", reply_markup=await get_main_kb(message.from_user.id))
 
-@router.message(lambda m: m.text == "👧 Написать подопечному")
+@menu.button("👧 Написать подопечному")
 async def to_ward_start(message: Message, state: FSMContext):
-    from database import get_ward_id
-    ward_id = get_ward_id(message.from_user.id)
-    if not ward_id:
+    record = await get_participant(message.from_user.id)
+    if not record or not record[2]:
         await message.answer("❌ Жеребьёвка ещё не проведена.", reply_markup=await get_main_kb(message.from_user.id))
         return
     await message.answer("Напишите сообщение своему подопечному:", reply_markup=ReplyKeyboardMarkup(
@@ -463,135 +652,478 @@ async def to_ward_send(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Отменено.", reply_markup=await get_main_kb(message.from_user.id))
         return
-    from database import get_ward_id
-    ward_id = get_ward_id(message.from_user.id)
+    record = await get_participant(message.from_user.id)
+    ward_id = record[2] if record else None
     if ward_id:
-        try:
-            await bot.send_message(ward_id, f"🎅 Ваш Санта прислал сообщение:\n\n<i>{message.text}</i>", parse_mode="HTML")
-            await message.answer("✅ Сообщение отправлено подопечному!")
-        except:
-            await message.answer("⚠️ Не удалось отправить сообщение.")
+        await outbox.send(
+            ward_id,
+            f"🎅 Ваш Санта прислал сообщение:\n\n<i>{message.text}</i>",
+            parse_mode="HTML",
+            dedup_key=f"msg:{message.chat.id}:{message.message_id}"
+        )
+        await message.answer("✅ Сообщение отправлено подопечному!")
     await state.clear()
     await message.answer("Возврат в меню.", reply_markup=await get_main_kb(message.from_user.id))
 
-@router.message(lambda m: m.text == "🚪 Покинуть игру")
+@menu.button("🚪 Покинуть игру")
 async def leave_game_button(message: Message):
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM participants WHERE user_id = ?", (message.from_user.id,))
-    changed = c.rowcount > 0
-    conn.commit()
-    conn.close()
-    if changed:
+    game_code = await db.run(db.leave_game, message.from_user.id)
+    if game_code:
+        invalidate_participants_for_game(game_code)
         await message.answer("✅ Вы покинули игру.", reply_markup=get_main_kb_static())
     else:
         await message.answer("❌ Вы не участвуете ни в одной игре.", reply_markup=get_main_kb_static())
 
 @router.message(Command("leave"))
 async def leave_game_command(message: Message):
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM participants WHERE user_id = ?", (message.from_user.id,))
-    changed = c.rowcount > 0
-    conn.commit()
-    conn.close()
-    if changed:
+    game_code = await db.run(db.leave_game, message.from_user.id)
+    if game_code:
+        invalidate_participants_for_game(game_code)
         await message.answer("✅ Вы покинули игру.", reply_markup=get_main_kb_static())
     else:
         await message.answer("❌ Вы не участвуете ни в одной игре.", reply_markup=get_main_kb_static())
 
-@router.message(lambda m: m.text == "👥 Список участников")
+def get_games_kb(games) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for game_code, active in games:
+        builder.button(text=f"✅ {game_code}" if active else game_code, callback_data=f"setgame:{game_code}")
+    builder.adjust(3)
+    return builder.as_markup()
+
+@menu.button("🎮 Мои игры")
+async def show_my_games(message: Message):
+    games = await db.run(db.get_user_games, message.from_user.id)
+    if not games:
+        await message.answer("❌ Вы не участвуете ни в одной игре.", reply_markup=await get_main_kb(message.from_user.id))
+        return
+    await message.answer(
+        "🎮 Ваши игры. Кнопки меню (пожелания, подопечный, сообщения) работают "
+        "в активной игре, отмеченной ✅. Выберите другую, чтобы переключиться:",
+        reply_markup=get_games_kb(games)
+    )
+
+@router.message(Command("games"))
+async def games_command(message: Message):
+    await show_my_games(message)
+
+@menu.callback(prefix="setgame:")
+async def handle_set_game(callback: types.CallbackQuery):
+    game_code = callback.data.split(":", 1)[1]
+    if not await db.run(db.set_active_game, callback.from_user.id, game_code):
+        await callback.answer("❌ Вы больше не участвуете в этой игре.", show_alert=True)
+        return
+    invalidate_participant(callback.from_user.id)
+    await callback.answer(f"Активная игра: {game_code}")
+    games = await db.run(db.get_user_games, callback.from_user.id)
+    await callback.message.edit_reply_markup(reply_markup=get_games_kb(games))
+
+@menu.button("👥 Список участников")
 async def show_participants(message: Message):
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (message.from_user.id,))
-    game_row = c.fetchone()
-    if not game_row:
+    game_code = await db.run(db.get_creator_game, message.from_user.id)
+    if not game_code:
         await message.answer("❌ Эта функция доступна только создателю игры.")
         return
-    game_code = game_row[0]
-    c.execute("""
-        SELECT full_name, username, wish
-        FROM participants
-        WHERE game_code = ?
-        ORDER BY full_name
-    """, (game_code,))
-    participants = c.fetchall()
-    conn.close()
-    if not participants:
+    text, kb = await render_listing("p", game_code)
+    if not text:
         await message.answer("📭 В игре пока нет участников.")
         return
-    text = f"📋 Участники игры <b>{game_code}</b>:\n\n"
-    for full_name, username, wish in participants:
-        name = full_name or "Без имени"
-        if username:
-            name += f" (@{username})"
-        wish_text = wish.strip() if wish and wish.strip() else "— не указаны"
-        text += f"• {name}\n  🎁 {wish_text}\n\n"
-    if len(text) > 4096:
-        text = text[:4093] + "..."
-    await message.answer(text, parse_mode="HTML")
-
-@router.message(lambda m: m.text == "🎲 Жеребьёвка")
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@menu.callback(prefix="pg:")
+async def handle_listing_page(callback: types.CallbackQuery):
+    _, kind, direction, cursor = callback.data.split(":", 3)
+    scope = None
+    if kind == "p":
+        scope = await db.run(db.get_creator_game, callback.from_user.id)
+        if not scope:
+            await callback.answer("❌ Эта функция доступна только создателю игры.", show_alert=True)
+            return
+    elif kind not in LISTINGS or not is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    cursor = LISTINGS[kind][4](cursor, direction == "b")
+    text, kb = await render_listing(
+        kind,
+        scope,
+        after=cursor if direction == "a" else None,
+        before=cursor if direction == "b" else None
+    )
+    if not text:
+        await callback.answer("📭 Здесь больше никого нет.")
+        return
+    await callback.answer()
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+
+def draw_notification(game_code: str, santa_id: int, ward_id: int, full_name: Optional[str],
+                      username: Optional[str], wish: Optional[str]) -> Tuple:
+    """Сообщение Санте о подопечном; строится внутри транзакции жеребьёвки"""
+    name_display = full_name or f"ID{ward_id}"
+    if username:
+        name_display += f" (@{username})"
+    wish_text = wish.strip() if wish and wish.strip() else "не указал(а) пожеланий."
+    return (
+        santa_id,
+        f"🎅 <b>Жеребьёвка завершена!</b>\n\n"
+        f"Ваш подопечный: <b>{name_display}</b>\n\n"
+        f"🎁 Пожелания:\n<i>{wish_text}</i>",
+        "HTML",
+        f"draw:{game_code}:{santa_id}"
+    )
+
+async def run_draw(game_code: str) -> Tuple[str, int]:
+    """Жеребьёвка: пары и уведомления Сантам записываются одной транзакцией.
+
+    Возвращает (результат db.assign_pairs, число уведомлений).
+    """
+    result, queued = await db.run(db.assign_pairs, game_code, notification=draw_notification)
+    if result != db.DRAW_OK:
+        return result, 0
+    outbox.wake()
+    invalidate_menu_for_game(game_code)
+    invalidate_participants_for_game(game_code)
+    await scheduler.cancel(game_code, "draw")
+    return result, queued
+
+DRAW_FAILED_TEXT = (
+    "❌ Не удалось провести жеребьёвку: нужно минимум 3 участника, "
+    "а исключения (/exclude) должны оставлять хотя бы один вариант."
+)
+
+@menu.button("🎲 Жеребьёвка")
 async def draw_via_button(message: Message):
-    from database import assign_pairs
     user_id = message.from_user.id
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (user_id,))
-    game_row = c.fetchone()
-    if not game_row:
+    game_code = await db.run(db.get_creator_game, user_id)
+    if not game_code:
         await message.answer("❌ Только создатель может запустить жеребьёвку.")
         return
-    game_code = game_row[0]
-    c.execute("SELECT 1 FROM participants WHERE game_code = ? AND ward_of IS NOT NULL LIMIT 1", (game_code,))
-    if c.fetchone():
-        await message.answer("✅ Жеребьёвка уже проведена!")
+    # Проведена ли уже жеребьёвка, проверяет assign_pairs в своей транзакции
+    result, queued = await run_draw(game_code)
+    if result == db.DRAW_ALREADY_DONE:
+        # Меню могло устареть (жеребьёвка по расписанию в другом процессе) — обновляем
+        invalidate_menu(user_id)
+        await message.answer("✅ Жеребьёвка уже проведена!", reply_markup=await get_main_kb(user_id))
         return
-    success = assign_pairs(game_code)
-    if not success:
-        await message.answer("❌ Недостаточно участников (минимум 3).")
+    if result == db.DRAW_IMPOSSIBLE:
+        await message.answer(DRAW_FAILED_TEXT)
         return
-    c.execute("SELECT user_id, ward_of FROM participants WHERE game_code = ?", (game_code,))
-    assignments = c.fetchall()
-    conn.close()
-    success_count = 0
-    for santa_id, ward_id in assignments:
-        if not ward_id:
-            continue
-        conn2 = sqlite3.connect("santa.db")
-        c2 = conn2.cursor()
-        c2.execute("SELECT full_name, username, wish FROM participants WHERE user_id = ?", (ward_id,))
-        ward_data = c2.fetchone()
-        conn2.close()
-        if ward_data:
-            full_name, username, wish = ward_data
-            name_display = full_name or f"ID{ward_id}"
-            if username:
-                name_display += f" (@{username})"
-            wish_text = wish.strip() if wish and wish.strip() else "не указал(а) пожеланий."
-            try:
-                await bot.send_message(
-                    santa_id,
-                    f"🎅 <b>Жеребьёвка завершена!</b>\n\n"
-                    f"Ваш подопечный: <b>{name_display}</b>\n\n"
-                    f"🎁 Пожелания:\n<i>{wish_text}</i>",
-                    parse_mode="HTML"
-                )
-                success_count += 1
-            except Exception as e:
-                logging.error(f"Ошибка отправки Санте {santa_id}: {e}")
-    await message.answer(f"✅ Жеребьёвка проведена! Уведомления отправлены {success_count} участникам.")
+    await message.answer(f"✅ Жеребьёвка проведена! Уведомления отправляются {queued} участникам.")
 
 @router.message(Command("draw"))
 async def draw_handler(message: Message):
     await draw_via_button(message)
 
+@router.message(Command("stats"))
+async def show_stats(message: Message):
+    game_code = await db.run(db.get_creator_game, message.from_user.id)
+    if not game_code:
+        await message.answer("❌ Эта функция доступна только создателю игры.")
+        return
+    stats = await db.run(db.get_game_stats, game_code)
+    await message.answer(format_stats(game_code, stats), parse_mode="HTML")
+
+@router.message(Command("exclude"))
+async def exclude_pair(message: Message):
+    game_code = await db.run(db.get_creator_game, message.from_user.id)
+    if not game_code:
+        await message.answer("❌ Эта функция доступна только создателю игры.")
+        return
+    parts = message.text.split()
+    if len(parts) != 3:
+        await message.answer(
+            "Использование: /exclude <ник_или_ID> <ник_или_ID>\n\n"
+            "Эти участники не будут дарить подарки друг другу."
+        )
+        return
+    user_a = await db.run(db.find_participant, game_code, parts[1])
+    user_b = await db.run(db.find_participant, game_code, parts[2])
+    if not user_a or not user_b or user_a == user_b:
+        await message.answer("❌ Участники не найдены в вашей игре.")
+        return
+    await db.run(db.add_exclusion, game_code, user_a, user_b)
+    await message.answer("✅ Эти участники не будут дарить подарки друг другу.")
+
+# === ОТЛОЖЕННЫЕ ЗАДАЧИ ===
+# вид задачи -> (слово в /schedule, описание)
+JOB_KINDS = {
+    "draw": ("draw", "🎲 Автоматическая жеребьёвка"),
+    "wish_reminder": ("wishes", "🎁 Напоминание о пожеланиях"),
+    "gift_day": ("gifts", "📅 Напоминание о дне обмена подарками"),
+}
+JOB_BY_WORD = {word: kind for kind, (word, _) in JOB_KINDS.items()}
+
+def format_job_time(run_at: float) -> str:
+    return datetime.datetime.fromtimestamp(run_at, BOT_TIMEZONE).strftime("%d.%m.%Y %H:%M")
+
+def parse_job_time(text: str) -> Optional[float]:
+    """«ДД.ММ.ГГГГ ЧЧ:ММ» или «ДД.ММ ЧЧ:ММ» (ближайшая такая дата) в BOT_TIMEZONE"""
+    now = datetime.datetime.now(BOT_TIMEZONE)
+    for fmt in ("%d.%m.%Y %H:%M", "%d.%m %H:%M"):
+        try:
+            when = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%d.%m %H:%M":
+            when = when.replace(year=now.year)
+            if when.replace(tzinfo=BOT_TIMEZONE) < now:
+                when = when.replace(year=now.year + 1)
+        return when.replace(tzinfo=BOT_TIMEZONE).timestamp()
+    return None
+
+async def notify_creator(game_code: str, text: str, dedup_key: str):
+    creator_id = await db.run(db.get_creator_id, game_code)
+    if creator_id:
+        await outbox.send(creator_id, text, dedup_key=dedup_key)
+
+@scheduler.handler("draw")
+async def scheduled_draw(job_id: int, game_code: str, payload: Optional[str]):
+    result, queued = await run_draw(game_code)
+    if result == db.DRAW_ALREADY_DONE:
+        return
+    if result == db.DRAW_IMPOSSIBLE:
+        text = "⏰ Автоматическая жеребьёвка не состоялась.\n\n" + DRAW_FAILED_TEXT
+    else:
+        text = f"⏰ Автоматическая жеребьёвка проведена! Уведомления отправляются {queued} участникам."
+    await notify_creator(game_code, text, f"job:{job_id}:creator")
+
+@scheduler.handler("wish_reminder")
+async def remind_wishes(job_id: int, game_code: str, payload: Optional[str]):
+    targets = await db.run(db.get_reminder_targets, game_code)
+    text = (f"🔔 Напоминание из игры <b>{game_code}</b>: вы ещё не указали пожелания.\n"
+            "Нажмите «🎁 Мои пожелания», чтобы Санта знал, что вам подарить.")
+    queued = await outbox.enqueue(
+        [(user_id, text, "HTML", f"job:{job_id}:{user_id}") for user_id, has_wish, _ in targets if not has_wish],
+        job_id=f"job:{job_id}"
+    )
+    logging.info(f"Напоминание о пожеланиях в игре {game_code}: {queued} участникам")
+
+@scheduler.handler("gift_day")
+async def remind_gift_day(job_id: int, game_code: str, payload: Optional[str]):
+    targets = await db.run(db.get_reminder_targets, game_code)
+    messages = []
+    for user_id, _, gift_bought in targets:
+        text = f"📅 <b>Сегодня обмен подарками</b> в игре <b>{game_code}</b>!"
+        if not gift_bought:
+            text += "\n\n🛍 Вы ещё не отметили, что купили подарок подопечному."
+        messages.append((user_id, text, "HTML", f"job:{job_id}:{user_id}"))
+    queued = await outbox.enqueue(messages, job_id=f"job:{job_id}")
+    logging.info(f"Напоминание о дне обмена в игре {game_code}: {queued} участникам")
+
+async def idle_game_deleted(game_code: str, creator_id: int):
+    """Заброшенная игра удалена обслуживанием: сбросить кэши и сообщить создателю"""
+    invalidate_menu_for_game(game_code)
+    invalidate_participants_for_game(game_code)
+    await outbox.send(
+        creator_id,
+        f"🗑 Игра {game_code} удалена: жеребьёвка так и не прошла, а в игре "
+        f"{maintenance.GAME_IDLE_TTL_DAYS:g} дн. никто не вступал и не менял пожелания.",
+        dedup_key=f"idle:{game_code}:{creator_id}"
+    )
+
+@scheduler.recurring("maintenance", maintenance.MAINTENANCE_INTERVAL)
+async def scheduled_maintenance(job_id: int, game_code: str, payload: Optional[str]):
+    await maintenance.run_maintenance(on_game_deleted=idle_game_deleted)
+
+SCHEDULE_HELP = (
+    "Использование:\n"
+    "/schedule draw ДД.ММ.ГГГГ ЧЧ:ММ — автоматическая жеребьёвка\n"
+    "/schedule wishes ДД.ММ.ГГГГ ЧЧ:ММ — напомнить тем, кто не указал пожелания\n"
+    "/schedule gifts ДД.ММ.ГГГГ ЧЧ:ММ — напомнить о дне обмена подарками\n"
+    "/schedule cancel draw|wishes|gifts — отменить\n\n"
+    "Год можно не указывать. Время — {timezone}."
+)
+
+@router.message(Command("schedule"))
+async def schedule_command(message: Message):
+    """Отложенные задачи своей игры; без аргументов — список"""
+    game_code = await db.run(db.get_creator_game, message.from_user.id)
+    if not game_code:
+        await message.answer("❌ Эта функция доступна только создателю игры.")
+        return
+    parts = message.text.split(maxsplit=2)
+    if len(parts) == 1:
+        jobs = await db.run(db.get_game_jobs, game_code)
+        lines = [f"{JOB_KINDS[kind][1]}: {format_job_time(run_at)}" for kind, run_at in jobs if kind in JOB_KINDS]
+        text = "🗓 Запланировано:\n" + "\n".join(lines) if lines else "🗓 Ничего не запланировано."
+        await message.answer(text + "\n\n" + SCHEDULE_HELP.format(timezone=BOT_TIMEZONE.key))
+        return
+
+    if parts[1] == "cancel" and len(parts) == 3 and parts[2].strip() in JOB_BY_WORD:
+        kind = JOB_BY_WORD[parts[2].strip()]
+        cancelled = await scheduler.cancel(game_code, kind)
+        await message.answer(f"✅ {JOB_KINDS[kind][1]}: отменено." if cancelled else "Такой задачи нет.")
+        return
+    kind = JOB_BY_WORD.get(parts[1])
+    run_at = parse_job_time(parts[2].strip()) if kind and len(parts) == 3 else None
+    if run_at is None:
+        await message.answer(SCHEDULE_HELP.format(timezone=BOT_TIMEZONE.key))
+        return
+    if run_at <= time.time():
+        await message.answer("❌ Это время уже прошло.")
+        return
+    if kind == "draw" and await db.run(db.is_draw_done, game_code):
+        await message.answer("✅ Жеребьёвка уже проведена!")
+        return
+    await scheduler.schedule(kind, game_code, run_at)
+    await message.answer(f"✅ {JOB_KINDS[kind][1]}: {format_job_time(run_at)} ({BOT_TIMEZONE.key}).")
+
+def format_import_report(game_code: str, report: dict) -> str:
+    lines = [
+        f"📥 Импорт в игру <b>{game_code}</b>:\n",
+        f"✅ Добавлено: {report['added']}",
+        f"🔁 Дубликатов (пропущены): {report['duplicates']}",
+        f"⚠️ Ошибок в строках: {report['errors']}",
+    ]
+    if report["duplicate_samples"]:
+        samples = ", ".join(f"<code>{user_id}</code>" for user_id in report["duplicate_samples"])
+        lines.append(f"\nДубликаты: {samples}" + (" …" if report["duplicates"] > len(report["duplicate_samples"]) else ""))
+    if report["error_samples"]:
+        lines.append("\nОшибки:")
+        lines.extend(f"• строка {line_no}: {html.escape(clip(error, 200))}" for line_no, error in report["error_samples"])
+    if report["fatal"]:
+        lines.append(f"\n❌ Импорт прерван: {html.escape(report['fatal'])}")
+    return "\n".join(lines)
+
+async def send_export(message: Message, game_code: str, fmt: str, archived: Optional[bytes] = None,
+                      full: bool = False):
+    export = GameExport(game_code, fmt, archived, full)
+    await message.answer_document(export, caption=f"📤 Участники игры {game_code}" + (" (архив)" if archived else ""))
+    logging.info(f"Экспорт игры {game_code} ({fmt}) для {message.from_user.id}: {export.rows} строк")
+
+def parse_export_format(parts) -> Optional[str]:
+    fmt = parts[0].lower() if parts else "csv"
+    return fmt if fmt in EXPORT_FORMATS else None
+
+@router.message(Command("export"))
+async def export_game(message: Message):
+    """Выгрузка участников своей игры без пар: /export [csv|jsonl]"""
+    game_code = await db.run(db.get_creator_game, message.from_user.id)
+    if not game_code:
+        await message.answer("❌ Эта функция доступна только создателю игры.")
+        return
+    fmt = parse_export_format(message.text.split()[1:])
+    if not fmt:
+        await message.answer("Использование: /export [csv|jsonl]")
+        return
+    await send_export(message, game_code, fmt)
+
+@router.message(Command("import"))
+async def import_start(message: Message, state: FSMContext):
+    """Массовое добавление участников: создатель — в свою игру, админ — в любую"""
+    parts = message.text.split()
+    if len(parts) > 1 and is_admin(message.from_user.id):
+        game_code = parts[1].strip().upper()
+    else:
+        game_code = await db.run(db.get_creator_game, message.from_user.id)
+        if not game_code:
+            await message.answer("❌ Эта функция доступна только создателю игры.")
+            return
+    stats = await db.run(db.get_game_stats, game_code)
+    if not stats:
+        await message.answer(f"❌ Игра <code>{game_code}</code> не найдена.", parse_mode="HTML")
+        return
+    if stats[2]:
+        await message.answer("❌ Жеребьёвка уже проведена — добавлять участников поздно.")
+        return
+
+    await message.answer(
+        "📎 Пришлите файл со списком участников (до 20 МБ):\n\n"
+        "• CSV: <code>user_id,full_name,username</code> (заголовок необязателен)\n"
+        "• JSON: массив объектов или JSON Lines с полями "
+        "<code>user_id</code>, <code>full_name</code>, <code>username</code>\n\n"
+        "Участники, которые уже есть в игре, будут пропущены.",
+        parse_mode="HTML",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="❌ Отмена")]],
+            resize_keyboard=True
+        )
+    )
+    await state.set_state(Form.waiting_for_import)
+    await state.update_data(game_code=game_code)
+
+@router.message(Form.waiting_for_import)
+async def import_upload(message: Message, state: FSMContext):
+    if message.text == "❌ Отмена":
+        await state.clear()
+        await message.answer("Отменено.", reply_markup=await get_main_kb(message.from_user.id))
+        return
+    document = message.document
+    if document is None:
+        await message.answer("📎 Пришлите файл CSV или JSON, либо нажмите «❌ Отмена».")
+        return
+    if document.file_size and document.file_size > importer.IMPORT_MAX_FILE_SIZE:
+        await message.answer("❌ Файл больше 20 МБ — разбейте его на части.")
+        return
+
+    data = await state.get_data()
+    game_code = data.get("game_code")
+    await state.clear()
+    status = await message.answer("⏳ Загружаю и проверяю файл...")
+    # Файл скачивается на диск по частям и читается построчно, целиком в памяти не держится
+    suffix = os.path.splitext(document.file_name or "")[1].lower()
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        report = await importer.import_file(path, game_code)
+    except Exception:
+        # Состояние уже сброшено — без ответа пользователь остался бы без клавиатуры
+        logging.exception(f"Импорт в игру {game_code} от {message.from_user.id} не удался")
+        HANDLER_ERRORS.inc("import_upload")
+        await status.edit_text("⚠️ Не удалось загрузить или обработать файл. Попробуйте ещё раз: /import")
+        await message.answer("Импорт прерван.", reply_markup=await get_main_kb(message.from_user.id))
+        return
+    finally:
+        os.remove(path)
+    logging.info(
+        f"Импорт в игру {game_code} от {message.from_user.id}: добавлено {report['added']}, "
+        f"дубликатов {report['duplicates']}, ошибок {report['errors']}"
+    )
+    await status.edit_text(format_import_report(game_code, report), parse_mode="HTML")
+    await message.answer("Готово.", reply_markup=await get_main_kb(message.from_user.id))
+
 # === ЗАПУСК ===
 dp.include_router(router)
+background_tasks = []
+runners = []
+
+async def on_startup():
+    """Один раз при запуске: схема БД, соединения пула, фоновые задачи"""
+    await db.run(db.init_db)
+    await db.warm_pool()
+    for is_creator in (False, True):
+        for draw_done in (False, True):
+            build_main_kb(is_creator, draw_done)
+    if BOT_MODE != "worker":  # в кластере очередь и планировщик работают в ingress
+        background_tasks.append(asyncio.create_task(outbox.run()))
+        background_tasks.append(asyncio.create_task(scheduler.run()))
+    # В режиме webhook /metrics не отдаётся на публичном адресе — отдельный сервер на METRICS_HOST
+    if METRICS_PORT and BOT_MODE in ("polling", "webhook"):
+        runners.append(await start_metrics_server())
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    for runner in runners:
+        await runner.cleanup()
+    runners.clear()
+    await storage.close()
+    db.close_pool()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
 
 async def main():
-    await dp.start_polling(bot)
+    if BOT_MODE == "cluster":
+        from cluster import run_cluster
+        await run_cluster(bot, outbox, scheduler, dp.resolve_used_update_types())
+    elif BOT_MODE in ("webhook", "worker"):
+        from webhook import run_webhook
+        await run_webhook(dp, bot, register=BOT_MODE == "webhook")
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 # === АДМИНСКИЕ КОМАНДЫ ===
 ВАШ_TELEGRAM_ID = 5194912828  # ← ЗАМЕНИ НА СВОЙ!
@@ -603,18 +1135,11 @@ def is_admin(user_id: int) -> bool:
 async def admin_game_list(message: Message):
     if not is_admin(message.from_user.id):
         return
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT game_code, creator_id FROM games")
-    games = c.fetchall()
-    conn.close()
-    if not games:
+    text, kb = await render_listing("g")
+    if not text:
         await message.answer("📭 Нет активных игр.")
         return
-    text = "🎮 Список игр:\n\n"
-    for game_code, creator_id in games:
-        text += f"• Код: <code>{game_code}</code> | Создатель: <code>{creator_id}</code>\n"
-    await message.answer(text, parse_mode="HTML")
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 @router.message(Command("admin_del_game"))
 async def admin_del_game(message: Message):
@@ -625,41 +1150,105 @@ async def admin_del_game(message: Message):
         await message.answer("Использование: /admin_del_game <код_игры>")
         return
     game_code = parts[1].strip().upper()
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    # Удаляем участников игры
-    c.execute("DELETE FROM participants WHERE game_code = ?", (game_code,))
-    # Удаляем саму игру
-    c.execute("DELETE FROM games WHERE game_code = ?", (game_code,))
-    deleted = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    # Удаляем участников и саму игру
+    deleted = await db.run(db.delete_game, game_code)
+    invalidate_menu_for_game(game_code)
+    invalidate_participants_for_game(game_code)
     if deleted:
         await message.answer(f"✅ Игра <code>{game_code}</code> удалена.", parse_mode="HTML")
     else:
         await message.answer(f"❌ Игра <code>{game_code}</code> не найдена.", parse_mode="HTML")
 
+@router.message(Command("admin_export"))
+async def admin_export(message: Message):
+    """Выгрузка любой игры, в том числе из архива: /admin_export <код> [csv|jsonl]"""
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    fmt = parse_export_format(parts[2:])
+    if len(parts) < 2 or not fmt:
+        await message.answer("Использование: /admin_export <код_игры> [csv|jsonl]")
+        return
+    game_code = parts[1].strip().upper()
+    if await db.run(db.get_game_stats, game_code):
+        await send_export(message, game_code, fmt, full=True)
+        return
+    archived = await db.run(db.get_archived_game, game_code)
+    if not archived:
+        await message.answer(f"❌ Игра <code>{game_code}</code> не найдена.", parse_mode="HTML")
+        return
+    await send_export(message, game_code, fmt, archived=archived[4])
+
+@router.message(Command("admin_archive"))
+async def admin_archive(message: Message):
+    """Переносит в архив игры после жеребьёвки, созданные больше N дней назад"""
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    try:
+        days = float(parts[1]) if len(parts) > 1 else ARCHIVE_AFTER_DAYS
+    except ValueError:
+        await message.answer("Использование: /admin_archive [дней]")
+        return
+    before = datetime.datetime.now().timestamp() - days * 86400
+    archived = 0
+    while True:
+        game_codes = await db.run(db.get_finished_games, before, PAGE_SIZE)
+        if not game_codes:
+            break
+        # Каждая игра — своя транзакция, между ними писатель обслуживает остальных
+        for game_code in game_codes:
+            if await db.run(db.delete_game, game_code):
+                archived += 1
+            invalidate_menu_for_game(game_code)
+            invalidate_participants_for_game(game_code)
+    logging.info(f"Архивировано игр: {archived} (созданы больше {days:g} дн. назад)")
+    await message.answer(f"📦 Перенесено в архив игр: {archived}")
+
+@router.message(Command("admin_maintenance"))
+async def admin_maintenance(message: Message):
+    """Внеочередной проход обслуживания БД"""
+    if not is_admin(message.from_user.id):
+        return
+    status = await message.answer("🧹 Обслуживание БД...")
+    report = await maintenance.run_maintenance(on_game_deleted=idle_game_deleted)
+    text = (
+        f"🧹 Обслуживание БД завершено\n\n"
+        f"🗑 Заброшенных игр удалено: {report.get('games_purged', 0)} "
+        f"(участников: {report.get('participants_purged', 0)})\n"
+        f"💾 Освобождено: {report['reclaimed_bytes'] / 2**20:.1f} МБ, "
+        f"размер БД: {report['db_bytes'] / 2**20:.1f} МБ\n"
+        f"⏱ vacuum {report['vacuum_s']} с, analyze {report['analyze_s']} с"
+    )
+    if report["vacuum_required"]:
+        text += "\n\n⚠️ Место не возвращается: файл создан до auto_vacuum. Один раз выполните /admin_vacuum."
+    await status.edit_text(text)
+
+@router.message(Command("admin_vacuum"))
+async def admin_vacuum(message: Message):
+    """Однократный полный VACUUM: включает возврат места в плановом обслуживании"""
+    if not is_admin(message.from_user.id):
+        return
+    status = await message.answer("🧹 Полный VACUUM: запись в БД приостановлена до его окончания...")
+    report = await maintenance.full_vacuum()
+    if not report["converted"]:
+        await status.edit_text("✅ auto_vacuum уже включён, полный VACUUM не нужен.")
+        return
+    await status.edit_text(
+        f"✅ Полный VACUUM завершён за {report['full_vacuum_s']} с\n"
+        f"💾 Освобождено: {report['reclaimed_bytes'] / 2**20:.1f} МБ, "
+        f"размер БД: {report['db_bytes'] / 2**20:.1f} МБ"
+    )
+
 @router.message(Command("admin_user_list"))
 async def admin_user_list(message: Message):
     if not is_admin(message.from_user.id):
         return
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    c.execute("SELECT user_id, full_name, username, game_code FROM participants")
-    users = c.fetchall()
-    conn.close()
-    if not users:
+    text, kb = await render_listing("u")
+    if not text:
         await message.answer("📭 Нет участников.")
         return
-    text = "👥 Список пользователей:\n\n"
-    for uid, name, username, game_code in users:
-        name_display = name or f"ID{uid}"
-        if username:
-            name_display += f" (@{username})"
-        text += f"• {name_display}\n  Игра: <code>{game_code}</code>\n\n"
-    if len(text) > 4096:
-        text = text[:4093] + "..."
-    await message.answer(text, parse_mode="HTML")
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 @router.message(Command("admin_del_user"))
 async def admin_del_user(message: Message):
@@ -670,30 +1259,61 @@ async def admin_del_user(message: Message):
         await message.answer("Использование: /admin_del_user <ник_или_ID>")
         return
     target = parts[1].strip()
-    conn = sqlite3.connect("santa.db")
-    c = conn.cursor()
-    deleted = False
-    # Попробуем как username (без @)
-    username = target.lstrip('@')
-    c.execute("DELETE FROM participants WHERE username = ?", (username,))
-    if c.rowcount > 0:
-        deleted = True
-    else:
-        # Попробуем как user_id (цифры)
-        try:
-            user_id = int(target)
-            c.execute("DELETE FROM participants WHERE user_id = ?", (user_id,))
-            if c.rowcount > 0:
-                deleted = True
-        except ValueError:
-            pass
-    conn.commit()
-    conn.close()
-    if deleted:
+    game_codes = await db.run(db.delete_user, target)
+    if game_codes:
+        # Меню от участия не зависит (только от созданной игры), а в записях
+        # участников этих игр мог остаться удалённый подопечный
+        for game_code in set(game_codes):
+            invalidate_participants_for_game(game_code)
         await message.answer(f"✅ Пользователь <code>{target}</code> удалён.", parse_mode="HTML")
     else:
         await message.answer(f"❌ Пользователь <code>{target}</code> не найден.", parse_mode="HTML")
 
+@router.message(Command("admin_stats"))
+async def admin_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) < 2:
+        await message.answer("Использование: /admin_stats <код_игры>")
+        return
+    game_code = parts[1].strip().upper()
+    stats = await db.run(db.get_game_stats, game_code)
+    if not stats:
+        await message.answer(f"❌ Игра <code>{game_code}</code> не найдена.", parse_mode="HTML")
+        return
+    await message.answer(format_stats(game_code, stats), parse_mode="HTML")
+
+@router.message(Command("admin_check_stats"))
+async def admin_check_stats(message: Message):
+    """Пересчитывает статистику всех игр; с аргументом fix исправляет расхождения"""
+    if not is_admin(message.from_user.id):
+        return
+    fix = message.text.split()[1:] == ["fix"]
+    mismatches = await db.run(db.check_game_stats, fix)
+    if not mismatches:
+        await message.answer("✅ Статистика игр совпадает с пересчётом.")
+        return
+    lines = [f"<code>{code}</code>: {saved} → {actual}" for code, saved, actual in mismatches[:PAGE_SIZE]]
+    if len(mismatches) > PAGE_SIZE:
+        lines.append(f"… и ещё {len(mismatches) - PAGE_SIZE}")
+    status = "исправлено" if fix else "для исправления: /admin_check_stats fix"
+    await message.answer(
+        f"⚠️ Расхождений: {len(mismatches)} ({status})\n"
+        "(участники, пожелания, жеребьёвка, подарки)\n\n" + "\n".join(lines),
+        parse_mode="HTML"
+    )
+
+@router.message(Command("admin_cache_stats"))
+async def admin_cache_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    lines = []
+    for title, cache in (("Кэш меню", menu_cache), ("Кэш участников", participant_cache)):
+        stats = cache.stats()
+        lines.append(f"🗂 {title}: записей {stats['size']}, попаданий {stats['hits']}, промахов {stats['misses']}")
+    await message.answer("\n".join(lines))
+
 @router.message(Command("admin_alarm"))
 async def admin_alarm(message: Message):
     # 🔒 Проверка: только админ
@@ -709,28 +1329,23 @@ async def admin_alarm(message: Message):
     announcement_text = parts[1]
 
     # 📢 Получаем всех участников
-    from database import get_all_participants
-    user_ids = get_all_participants()
+    user_ids = await db.run(db.get_all_participants)
 
     if not user_ids:
         await message.answer("📭 Нет участников для уведомления.")
         return
 
-    # 📩 Рассылаем сообщение
-    success = 0
-    for user_id in user_ids:
-        try:
-            await bot.send_message(
-                user_id,
-                f"🔔 <b>Объявление от организатора:</b>\n\n{announcement_text}",
-                parse_mode="HTML"
-            )
-            success += 1
-        except Exception as e:
-            # Например, пользователь заблокировал бота
-            print(f"Не удалось отправить {user_id}: {e}")
+    # 📩 Ставим сообщение в очередь (лимиты Telegram и блокировки учитывает воркер)
+    text = f"🔔 <b>Объявление от организатора:</b>\n\n{announcement_text}"
+    job_id = f"alarm:{message.chat.id}:{message.message_id}"
+    status = await message.answer("📤 Рассылка начата...")
+    queued = await outbox.enqueue(
+        [(uid, text, "HTML", f"{job_id}:{uid}") for uid in user_ids],
+        job_id=job_id,
+        status_message=status
+    )
 
-    await message.answer(f"✅ Объявление отправлено {success} из {len(user_ids)} участников.")
+    await message.answer(f"✅ Объявление поставлено в очередь для {queued} из {len(user_ids)} участников.")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+
+from metrics import MESSAGES_SENT
+
+# === НАСТРОЙКИ ===
+# Telegram разрешает ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+RETRY = "retry"
+
+class RateLimiter:
+    """Token bucket на весь бот плюс минимальный интервал между сообщениями в один чат.
+
+    При RetryAfter от Telegram все отправки ставятся на паузу.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.per_chat_interval = per_chat_interval
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next: Dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _wait_chat(self, chat_id: int):
+        now = time.monotonic()
+        next_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_at) + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+
+    async def acquire(self, chat_id: int):
+        await self._wait_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Один лимитер на процесс: лимиты Telegram считаются на бота, а не на рассылку
+limiter = RateLimiter()
+
+async def send_once(bot: Bot, chat_id: int, text: str, **kwargs) -> str:
+    """Одна попытка отправки с учётом лимитов.
+
+    Возвращает SENT, BLOCKED, FAILED или RETRY (если попытку стоит повторить позже).
+    """
+    status = await _send_once(bot, chat_id, text, **kwargs)
+    MESSAGES_SENT.inc(status)
+    return status
+
+async def _send_once(bot: Bot, chat_id: int, text: str, **kwargs) -> str:
+    await limiter.acquire(chat_id)
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+        return SENT
+    except TelegramRetryAfter as e:
+        logging.warning(f"Flood limit, пауза {e.retry_after} с (чат {chat_id})")
+        limiter.pause(e.retry_after)
+        return RETRY
+    except TelegramForbiddenError:
+        # Пользователь заблокировал бота — повторять бессмысленно
+        return BLOCKED
+    except TelegramNetworkError as e:
+        logging.warning(f"Сетевая ошибка при отправке {chat_id}: {e}")
+        return RETRY
+    except TelegramAPIError as e:
+        logging.error(f"Не удалось отправить {chat_id}: {e}")
+        return FAILED
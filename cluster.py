@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sys
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import ClientConnectorError, ClientError, ClientSession, ClientTimeout, web
+from aiogram import Bot
+
+import database as db
+from metrics import METRICS_PORT, start_metrics_server
+from outbox import Outbox
+from scheduler import Scheduler
+from webhook import WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL, health, wait_for_signal
+
+# === НАСТРОЙКИ ===
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "4"))
+CLUSTER_INGRESS = os.getenv("CLUSTER_INGRESS", "polling")  # откуда брать обновления: polling или webhook
+CLUSTER_BASE_PORT = int(os.getenv("CLUSTER_BASE_PORT", "8090"))  # воркер i слушает CLUSTER_BASE_PORT + i
+CLUSTER_IN_FLIGHT = int(os.getenv("CLUSTER_IN_FLIGHT", "100"))  # обновлений в обработке на воркер
+POLL_TIMEOUT = 30
+READY_TIMEOUT = 30.0
+WORKER_RESTART_DELAY = 1.0
+# Воркер, который падает быстрее WORKER_MIN_UPTIME столько раз подряд, не
+# перезапускается: кластер останавливается с ошибкой
+WORKER_MAX_RESTARTS = 5
+WORKER_MIN_UPTIME = 60.0
+
+def shard_key(update: dict) -> int:
+    """user_id отправителя, иначе id чата, иначе update_id"""
+    for event in update.values():
+        if isinstance(event, dict):
+            user = event.get("from") or event.get("user")
+            if user:
+                return user["id"]
+            chat = event.get("chat") or (event.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+    return update.get("update_id", 0)
+
+class Ingress:
+    """Раздаёт обновления воркерам по shard_key.
+
+    Обновления одного пользователя всегда попадают в один воркер и
+    передаются строго по очереди: следующее — только после того, как воркер
+    обработал предыдущее. Так сохраняются порядок и состояние FSM (кэш
+    хранилища у каждого пользователя в одном процессе), а разные
+    пользователи обрабатываются параллельно.
+    """
+
+    def __init__(self, ports: List[int], secret: str, on_delivered: Callable[[], None]):
+        self.ports = ports
+        self.secret = secret
+        self.on_delivered = on_delivered
+        self._semaphores = [asyncio.Semaphore(CLUSTER_IN_FLIGHT) for _ in ports]
+        # shard_key -> доставка последнего обновления пользователя
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._http: Optional[ClientSession] = None
+
+    async def start(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=None))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + READY_TIMEOUT
+        for port in self.ports:
+            while True:
+                try:
+                    async with self._http.get(f"http://127.0.0.1:{port}/health") as response:
+                        if response.status == 200:
+                            break
+                except ClientError:
+                    pass
+                if loop.time() > deadline:
+                    raise RuntimeError(f"Воркер на порту {port} не запустился за {READY_TIMEOUT:.0f} с")
+                await asyncio.sleep(0.2)
+
+    def dispatch(self, update: dict):
+        key = shard_key(update)
+        task = asyncio.create_task(self._deliver(key, update, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._tails.get(key) is t and self._tails.pop(key))
+
+    async def _deliver(self, key: int, update: dict, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        worker = key % len(self.ports)
+        loop = asyncio.get_running_loop()
+        async with self._semaphores[worker]:
+            deadline = loop.time() + READY_TIMEOUT
+            while True:
+                try:
+                    async with self._http.post(
+                        f"http://127.0.0.1:{self.ports[worker]}{WEBHOOK_PATH}",
+                        json=update,
+                        headers={"X-Telegram-Bot-Api-Secret-Token": self.secret},
+                    ) as response:
+                        await response.read()
+                        if response.status != 200:
+                            logging.error(f"Воркер {worker} ответил {response.status} на обновление {update.get('update_id')}")
+                    break
+                except ClientConnectorError as e:
+                    # Соединение не установлено — воркер перезапускается, обновление он ещё не видел
+                    if loop.time() > deadline:
+                        logging.error(f"Воркер {worker} недоступен, обновление {update.get('update_id')} пропущено: {e}")
+                        break
+                    await asyncio.sleep(0.5)
+                except ClientError as e:
+                    logging.error(f"Воркер {worker} не принял обновление {update.get('update_id')}: {e}")
+                    break
+        self.on_delivered()
+
+    async def close(self):
+        """Дожидается доставки уже принятых обновлений"""
+        while self._tails:
+            await asyncio.gather(*list(self._tails.values()), return_exceptions=True)
+        if self._http is not None:
+            await self._http.close()
+
+async def spawn_worker(port: int, secret: str) -> asyncio.subprocess.Process:
+    """Запускает bot.py в режиме worker на порту"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    env = dict(
+        os.environ,
+        BOT_MODE="worker",
+        WEBAPP_HOST="127.0.0.1",
+        WEBAPP_PORT=str(port),
+        WEBHOOK_SECRET=secret,
+    )
+    # Отдельная сессия: Ctrl+C получает только ingress и сам останавливает воркеры
+    return await asyncio.create_subprocess_exec(sys.executable, script, env=env, start_new_session=True)
+
+async def supervise_worker(workers: List[asyncio.subprocess.Process], i: int, port: int, secret: str):
+    """Перезапускает воркер i, если он завершился; пока он поднимается,
+    Ingress повторяет доставку его обновлений"""
+    loop = asyncio.get_running_loop()
+    crashes = 0
+    while True:
+        started = loop.time()
+        code = await workers[i].wait()
+        crashes = crashes + 1 if loop.time() - started < WORKER_MIN_UPTIME else 1
+        if crashes > WORKER_MAX_RESTARTS:
+            raise RuntimeError(f"Воркер на порту {port} падает сразу после запуска (код {code}), перезапуски прекращены")
+        logging.error(f"Воркер на порту {port} завершился с кодом {code}, перезапуск")
+        await asyncio.sleep(WORKER_RESTART_DELAY)
+        workers[i] = await spawn_worker(port, secret)
+
+async def poll_updates(bot: Bot, ingress: Ingress, allowed_updates: List[str]):
+    """Long polling без разбора обновлений: воркерам уходит исходный JSON"""
+    url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+    offset = None
+    async with ClientSession(timeout=ClientTimeout(total=POLL_TIMEOUT + 10)) as http:
+        while True:
+            params = {"timeout": POLL_TIMEOUT, "allowed_updates": json.dumps(allowed_updates)}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                async with http.post(url, data=params) as response:
+                    payload = await response.json()
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.error(f"getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not payload.get("ok"):
+                logging.error(f"getUpdates: {payload.get('description')}")
+                await asyncio.sleep(1)
+                continue
+            for update in payload["result"]:
+                offset = update["update_id"] + 1
+                ingress.dispatch(update)
+
+def create_ingress_app(ingress: Ingress) -> web.Application:
+    async def receive(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        ingress.dispatch(await request.json())
+        return web.Response()
+
+    # /metrics на публичном адресе не отдаётся — отдельный сервер на METRICS_HOST
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.router.add_get("/health", health)
+    return app
+
+async def run_cluster(bot: Bot, outbox: Outbox, scheduler: Scheduler, allowed_updates: List[str]):
+    """Ingress: получает обновления и раздаёт их CLUSTER_WORKERS процессам.
+
+    Воркеры работают с той же БД (WAL) и хранят FSM в ней же. Очередь
+    исходящих сообщений отправляет только ingress, поэтому общий лимит
+    Telegram на бота соблюдается. Планировщик тоже работает только здесь:
+    задачи, поставленные воркерами, он подхватывает после доставки обновлений.
+    """
+    if CLUSTER_INGRESS == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise ValueError("Для CLUSTER_INGRESS=webhook нужны переменные окружения WEBHOOK_URL и WEBHOOK_SECRET!")
+    # Миграции — до запуска воркеров, чтобы они не выполнялись параллельно
+    await db.run(db.init_db)
+    await db.warm_pool()
+
+    secret = secrets.token_urlsafe(32)  # воркеры принимают обновления только от ingress
+    ports = [CLUSTER_BASE_PORT + i for i in range(CLUSTER_WORKERS)]
+    workers = [await spawn_worker(port, secret) for port in ports]
+    supervisors = [asyncio.create_task(supervise_worker(workers, i, port, secret)) for i, port in enumerate(ports)]
+    def on_delivered():
+        outbox.wake()
+        scheduler.wake()
+
+    ingress = Ingress(ports, secret, on_delivered=on_delivered)
+    outbox_task = asyncio.create_task(outbox.run())
+    scheduler_task = asyncio.create_task(scheduler.run())
+    poller = None
+    runner = None
+    metrics_runner = None
+    try:
+        await ingress.start()
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server()
+        if CLUSTER_INGRESS == "webhook":
+            runner = web.AppRunner(create_ingress_app(ingress))
+            await runner.setup()
+            await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+            )
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(poll_updates(bot, ingress, allowed_updates))
+        logging.info(f"Кластер: {CLUSTER_WORKERS} воркеров, обновления через {CLUSTER_INGRESS}")
+        # Работаем до сигнала; ошибка надзора за воркерами останавливает кластер
+        stop = asyncio.create_task(wait_for_signal())
+        done, _ = await asyncio.wait([stop, *supervisors], return_when=asyncio.FIRST_COMPLETED)
+        stop.cancel()
+        for task in done:
+            task.result()
+    finally:
+        logging.info("Остановка кластера: дожидаемся обработки принятых обновлений")
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        if runner is not None:
+            await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await ingress.close()
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        for worker in workers:
+            if worker.returncode is None:
+                worker.terminate()
+        await asyncio.gather(*(worker.wait() for worker in workers))
+        outbox_task.cancel()
+        scheduler_task.cancel()
+        await asyncio.gather(outbox_task, scheduler_task, return_exceptions=True)
+        await bot.session.close()
+        db.close_pool()
@@ -1,19 +1,283 @@
+import asyncio
+import functools
+import json
+import os
+import secrets
 import sqlite3
-import random
-from typing import Optional, List, Tuple
+import string
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, List, Tuple
 
-DB_PATH = "santa.db"
+import draw
+from metrics import DB_LATENCY, GAME_CODE_COLLISIONS
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
+DB_PATH = os.getenv("DB_PATH", "santa.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))  # секунды ожидания блокировки
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))  # 1 — каждая запись своей транзакцией
+# inline — прежняя схема для сравнения в loadtest.py: новое соединение на каждый
+# вызов прямо в event loop, без пула и писателя
+DB_EXECUTOR = os.getenv("DB_EXECUTOR", "pool")
+# Жеребьёвка избегает пар из игр, архивированных за столько дней; 0 — не учитывать
+DRAW_AVOID_REPEAT_DAYS = float(os.getenv("DRAW_AVOID_REPEAT_DAYS", "400"))
+
+# === ПУЛ СОЕДИНЕНИЙ ===
+# Каждый поток пула держит своё долгоживущее соединение, а sqlite3
+# кэширует подготовленные выражения внутри соединения (cached_statements).
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _configure(conn: sqlite3.Connection):
+    # Свободные страницы возвращает incremental_vacuum. Для нового файла режим
+    # действует сразу, для существующего — после одного VACUUM (enable_incremental_vacuum)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL: читатели не блокируют писателя и наоборот; режим запоминается в файле БД
+    conn.execute("PRAGMA journal_mode = WAL")
+    # В режиме WAL синхронизация NORMAL не нарушает целостность, fsync — только на checkpoint
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+
+def get_conn() -> sqlite3.Connection:
+    """Соединение текущего потока (создаётся один раз)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # timeout — это busy_timeout: ждём блокировку вместо "database is locked"
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=256)
+        _configure(conn)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="santa-db")
+    return _executor
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД, не блокируя event loop.
+
+    Чтения идут в пул, функции с @writer — через единственного писателя.
+    """
+    start = time.perf_counter()
+    try:
+        if DB_EXECUTOR == "inline":
+            return _run_inline(func, *args, **kwargs)
+        mode = getattr(func, "db_writer", None)
+        if mode is not None:
+            return await _submit_write(functools.partial(func, *args, **kwargs), mode == "exclusive")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+    finally:
+        DB_LATENCY.observe(time.perf_counter() - start, func.__name__)
+
+def _run_inline(func, *args, **kwargs):
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    _local.conn = conn
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.conn = None
+        conn.close()
+
+async def warm_pool():
+    """Заранее открывает соединения во всех потоках пула"""
+    if DB_EXECUTOR == "inline":
+        return
+    barrier = threading.Barrier(DB_POOL_SIZE)
+
+    def touch():
+        get_conn().execute("SELECT 1")
+        try:
+            # Держим поток занятым, чтобы следующая задача ушла в новый поток
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+
+    await asyncio.gather(*(run(touch) for _ in range(DB_POOL_SIZE)))
+
+def close_pool():
+    """Останавливает писателя и пул, закрывает все соединения"""
+    global _executor, _writer_executor, _writer_task
+    if _writer_task is not None:
+        _writer_task.cancel()
+        _writer_task = None
+    for executor in (_writer_executor, _executor):
+        if executor is not None:
+            executor.shutdown(wait=True)
+    _executor = _writer_executor = None
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    if hasattr(_local, "conn"):
+        del _local.conn
+
+# === ПИСАТЕЛЬ ===
+# SQLite допускает одного писателя, поэтому все записи выполняются в отдельном
+# потоке по очереди. Пока идёт одна транзакция, новые записи копятся в очереди
+# и следующей пачкой попадают в общую транзакцию (group commit): один fsync на
+# пачку вместо одного на запись. Каждая запись внутри пачки — в своём SAVEPOINT,
+# так что ошибка одной не откатывает остальные.
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+_writer_executor: Optional[ThreadPoolExecutor] = None
+
+def writer(exclusive: bool = False):
+    """Помечает функцию как пишущую.
+
+    exclusive — функция сама управляет транзакцией (BEGIN IMMEDIATE) и
+    выполняется отдельно от пачек.
+    """
+    def decorator(func):
+        func.db_writer = "exclusive" if exclusive else "group"
+        return func
+    return decorator
+
+class _GroupConnection:
+    """Соединение, которое видят функции внутри пачки: commit откладывается
+    до конца пачки, rollback откатывает только текущую запись"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def cursor(self) -> sqlite3.Cursor:
+        return self._conn.cursor()
+
+    def execute(self, *args) -> sqlite3.Cursor:
+        return self._conn.execute(*args)
+
+    @property
+    def total_changes(self) -> int:
+        return self._conn.total_changes
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._conn.execute("ROLLBACK TO write_item")
+
+def _apply_alone(calls: list) -> List[Tuple]:
+    # Незавершённая транзакция (ошибка после неявного BEGIN, return без commit)
+    # откатывается: иначе следующий BEGIN писателя падал бы навсегда
+    conn = get_conn()
+    try:
+        result = calls[0]()
+    except Exception as e:
+        conn.rollback()
+        return [(False, e)]
+    if conn.in_transaction:
+        conn.rollback()
+    return [(True, result)]
+
+def _apply_group(calls: list) -> List[Tuple]:
+    """Выполняет записи одной транзакцией; [(успех, результат или исключение)]"""
+    if len(calls) == 1:
+        return _apply_alone(calls)
+    conn = get_conn()
+    results = []
+    conn.execute("BEGIN IMMEDIATE")
+    _local.conn = _GroupConnection(conn)
+    try:
+        for call in calls:
+            conn.execute("SAVEPOINT write_item")
+            try:
+                results.append((True, call()))
+            except Exception as e:
+                conn.execute("ROLLBACK TO write_item")
+                results.append((False, e))
+            conn.execute("RELEASE write_item")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _local.conn = conn
+    return results
+
+async def _submit_write(call, exclusive: bool):
+    global _write_queue, _writer_task, _writer_executor
+    if _writer_task is None or _writer_task.done():
+        if _writer_executor is None:
+            _writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="santa-db-writer")
+        _write_queue = asyncio.Queue()
+        _writer_task = asyncio.create_task(_writer_loop(_write_queue, _writer_executor))
+    future = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((call, exclusive, future))
+    return await future
+
+async def _writer_loop(queue: asyncio.Queue, executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < DB_WRITE_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # Подряд идущие обычные записи — одна группа, exclusive — каждая отдельно
+        groups: List[list] = []
+        for item in batch:
+            if item[1] or not groups or groups[-1][0][1]:
+                groups.append([item])
+            else:
+                groups[-1].append(item)
+
+        for group in groups:
+            calls = [call for call, _, _ in group]
+            apply = _apply_alone if group[0][1] else _apply_group
+            try:
+                results = await loop.run_in_executor(executor, apply, calls)
+            except Exception as e:
+                results = [(False, e)] * len(group)
+            for (_, _, future), (ok, value) in zip(group, results):
+                if future.done():  # ожидающий уже отменён
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+# Непустое пожелание: одинаково в SQL и в Python
+WISH_BLANK = " \t\n\r"
+HAS_WISH = "TRIM(COALESCE(wish, ''), ' ' || char(9, 10, 13)) != ''"
+
+def has_wish(wish: Optional[str]) -> bool:
+    return bool(wish and wish.strip(WISH_BLANK))
+
+# Статистика игр, посчитанная заново по participants (для миграции и проверки)
+GAME_STATS_SQL = f"""
+    SELECT g.game_code,
+           COUNT(p.user_id),
+           COALESCE(SUM({HAS_WISH}), 0),
+           COALESCE(MAX(p.ward_of IS NOT NULL), 0),
+           COALESCE(SUM(p.gift_bought), 0)
+    FROM games g
+    LEFT JOIN participants p ON p.game_code = g.game_code
+    GROUP BY g.game_code
+"""
+
+# === МИГРАЦИИ ===
+# Упорядоченный список (версия, SQL-выражения). Каждая миграция выполняется
+# один раз в отдельной транзакции, применённые версии хранятся в schema_version.
+MIGRATIONS = [
+    (1, [
+        """
         CREATE TABLE IF NOT EXISTS games (
             game_code TEXT PRIMARY KEY,
             creator_id INTEGER NOT NULL
         )
-    """)
-    c.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS participants (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -23,123 +287,1127 @@ def init_db():
             santa_of INTEGER,  -- кому дарит (ward)
             ward_of INTEGER    -- от кого получает (santa)
         )
-    """)
-    conn.commit()
-    conn.close()
+        """,
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_participants_game_code ON participants (game_code)",
+        # Частичный индекс: только участники игр, где жеребьёвка уже проведена
+        "CREATE INDEX IF NOT EXISTS idx_participants_drawn ON participants (game_code) WHERE ward_of IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_participants_username ON participants (username)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_games_creator_id ON games (creator_id)",
+    ]),
+    (3, [
+        # Исходящие сообщения: переживают перезапуск и дорассылаются фоновым воркером
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            dedup_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_job ON outbox (job_id, status)",
+        """
+        CREATE TABLE IF NOT EXISTS outbox_jobs (
+            job_id TEXT PRIMARY KEY,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (4, [
+        # Пары, которые не должны дарить друг другу (например, супруги)
+        """
+        CREATE TABLE IF NOT EXISTS draw_exclusions (
+            game_code TEXT NOT NULL,
+            santa_id INTEGER NOT NULL,
+            ward_id INTEGER NOT NULL,
+            PRIMARY KEY (game_code, santa_id, ward_id)
+        )
+        """,
+    ]),
+    (5, [
+        # Состояния FSM (data — компактный JSON)
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+    ]),
+    (6, [
+        # Постраничный вывод участников игры по имени; заменяет индекс по одному game_code
+        "CREATE INDEX IF NOT EXISTS idx_participants_game_name ON participants (game_code, full_name, user_id)",
+        "DROP INDEX IF EXISTS idx_participants_game_code",
+    ]),
+    (7, [
+        # Участие во многих играх: ключ (game_code, user_id) вместо user_id.
+        # SQLite не меняет первичный ключ на месте, поэтому таблица пересобирается.
+        """
+        CREATE TABLE participants_new (
+            game_code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            full_name TEXT,
+            wish TEXT,
+            santa_of INTEGER,  -- кто дарит этому участнику в этой игре
+            ward_of INTEGER,   -- кому дарит этот участник в этой игре
+            PRIMARY KEY (game_code, user_id)
+        )
+        """,
+        """
+        INSERT INTO participants_new (game_code, user_id, username, full_name, wish, santa_of, ward_of)
+        SELECT game_code, user_id, username, full_name, wish, santa_of, ward_of FROM participants
+        """,
+        "DROP TABLE participants",
+        "ALTER TABLE participants_new RENAME TO participants",
+        # Все игры пользователя — по префиксу user_id
+        "CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id, game_code)",
+        "CREATE INDEX IF NOT EXISTS idx_participants_game_name ON participants (game_code, full_name, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_participants_drawn ON participants (game_code) WHERE ward_of IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_participants_username ON participants (username)",
+        # Игра, с которой сейчас работает пользователь (кнопки меню действуют в ней)
+        """
+        CREATE TABLE IF NOT EXISTS active_games (
+            user_id INTEGER PRIMARY KEY,
+            game_code TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_active_games_game_code ON active_games (game_code)",
+        "INSERT INTO active_games (user_id, game_code) SELECT user_id, game_code FROM participants",
+    ]),
+    (8, [
+        "ALTER TABLE participants ADD COLUMN gift_bought INTEGER NOT NULL DEFAULT 0",
+        # Счётчики по игре, которые меняются в тех же транзакциях, что и participants
+        """
+        CREATE TABLE IF NOT EXISTS game_stats (
+            game_code TEXT PRIMARY KEY,
+            participant_count INTEGER NOT NULL DEFAULT 0,
+            wishes_set INTEGER NOT NULL DEFAULT 0,
+            draw_done INTEGER NOT NULL DEFAULT 0,
+            gifts_bought INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        """,
+        # Для существующих игр время создания неизвестно — берём время миграции
+        f"""
+        INSERT INTO game_stats (game_code, participant_count, wishes_set, draw_done, gifts_bought, created_at)
+        SELECT *, CAST(strftime('%s', 'now') AS REAL) FROM ({GAME_STATS_SQL})
+        """,
+        # is_draw_done читает game_stats.draw_done
+        "DROP INDEX IF EXISTS idx_participants_drawn",
+    ]),
+    (9, [
+        # Завершённые игры: участники сжатыми JSON Lines (колонки ARCHIVE_COLUMNS)
+        """
+        CREATE TABLE IF NOT EXISTS archived_games (
+            game_code TEXT PRIMARY KEY,
+            creator_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            archived_at REAL NOT NULL,
+            participant_count INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+        """,
+        # Пары прошлых игр — чтобы не выпадал тот же подопечный, что в прошлый раз
+        """
+        CREATE TABLE IF NOT EXISTS past_pairs (
+            santa_id INTEGER NOT NULL,
+            ward_id INTEGER NOT NULL,
+            archived_at REAL NOT NULL,
+            PRIMARY KEY (santa_id, ward_id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (10, [
+        # Отложенные задачи игр: не больше одной задачи каждого вида на игру.
+        # AUTOINCREMENT — id только растут, новые задачи ищутся по id > последнего.
+        """
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            game_code TEXT NOT NULL,
+            run_at REAL NOT NULL,
+            payload TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (game_code, kind)
+        )
+        """,
+    ]),
+    (11, [
+        # Время последнего действия в игре (вступление, пожелание, импорт):
+        # заброшенными считаются игры без действий, а не просто старые
+        "ALTER TABLE game_stats ADD COLUMN last_activity REAL NOT NULL DEFAULT 0",
+        "UPDATE game_stats SET last_activity = created_at",
+        # Поиск заброшенных (get_idle_games) и завершённых (get_finished_games) игр
+        "CREATE INDEX IF NOT EXISTS idx_game_stats_draw_activity ON game_stats (draw_done, last_activity)",
+        "CREATE INDEX IF NOT EXISTS idx_game_stats_draw_created ON game_stats (draw_done, created_at)",
+        # Очистка устаревших пар (purge_past_pairs)
+        "CREATE INDEX IF NOT EXISTS idx_past_pairs_archived_at ON past_pairs (archived_at)",
+        # Очистка отправленных сообщений (purge_outbox)
+        "CREATE INDEX IF NOT EXISTS idx_outbox_finished ON outbox (created_at) WHERE status != 'pending'",
+    ]),
+]
 
-def create_game(game_code: str, creator_id: int):
-    conn = sqlite3.connect(DB_PATH)
+# Подзапрос активной игры пользователя; вместе с первичным ключом participants
+# (game_code, user_id) даёт поиск по составному ключу без сканирования
+ACTIVE_GAME = "(SELECT game_code FROM active_games WHERE user_id = ?)"
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
     c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO games (game_code, creator_id) VALUES (?, ?)", (game_code, creator_id))
-    conn.commit()
-    conn.close()
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)")
+    c.execute("SELECT MAX(version) FROM schema_version")
+    return c.fetchone()[0] or 0
+
+@writer(exclusive=True)
+def init_db():
+    conn = get_conn()
+    c = conn.cursor()
+    current = get_schema_version(conn)
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            c.execute("BEGIN")
+            for sql in statements:
+                c.execute(sql)
+            c.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
+GAME_CODE_ALPHABET = string.ascii_uppercase + string.digits
+GAME_CODE_LENGTH = 6
+
+def generate_game_code() -> str:
+    return ''.join(secrets.choice(GAME_CODE_ALPHABET) for _ in range(GAME_CODE_LENGTH))
+
+@writer()
+def create_game(creator_id: int, attempts: int = 10) -> Optional[str]:
+    """Создаёт игру с новым уникальным кодом и возвращает код.
+
+    Уникальность гарантирует первичный ключ: при совпадении кода пробуем
+    другой. None — у пользователя уже есть игра.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    for _ in range(attempts):
+        game_code = generate_game_code()
+        try:
+            c.execute("INSERT INTO games (game_code, creator_id) VALUES (?, ?)", (game_code, creator_id))
+            now = time.time()
+            c.execute("INSERT INTO game_stats (game_code, created_at, last_activity) VALUES (?, ?, ?)",
+                      (game_code, now, now))
+            conn.commit()
+            return game_code
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            c.execute("SELECT 1 FROM games WHERE creator_id = ?", (creator_id,))
+            if c.fetchone():
+                return None
+            GAME_CODE_COLLISIONS.inc()
+    raise RuntimeError(f"Не удалось подобрать свободный код игры за {attempts} попыток")
+
+@writer()
 def join_game(user_id: int, username: str, full_name: str, game_code: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+    """Добавляет пользователя в игру и делает её активной.
+
+    False — игры с таким кодом нет или пользователь уже в ней участвует.
+    """
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT 1 FROM participants WHERE user_id = ?", (user_id,))
-    if c.fetchone():
-        conn.close()
-        return False  # уже участвует
     c.execute("""
-        INSERT OR IGNORE INTO participants 
-        (user_id, username, full_name, game_code, wish, santa_of, ward_of)
-        VALUES (?, ?, ?, ?, '', NULL, NULL)
+        INSERT OR IGNORE INTO participants (game_code, user_id, username, full_name, wish, santa_of, ward_of)
+        SELECT game_code, ?, ?, ?, '', NULL, NULL FROM games WHERE game_code = ?
     """, (user_id, username, full_name, game_code))
+    if c.rowcount == 0:
+        conn.rollback()
+        return False
+    c.execute("UPDATE game_stats SET participant_count = participant_count + 1, last_activity = ? WHERE game_code = ?",
+              (time.time(), game_code))
+    _set_active(c, user_id, game_code)
     conn.commit()
-    conn.close()
     return True
 
-def set_wish(user_id: int, wish: str):
-    conn = sqlite3.connect(DB_PATH)
+# Наименьший лимит переменных в запросе среди версий SQLite (до 3.32 — 999)
+SQL_MAX_VARIABLES = 999
+
+@writer()
+def import_participants(game_code: str, rows: List[Tuple]) -> Optional[List[int]]:
+    """Добавляет пачку (user_id, username, full_name) в игру одной транзакцией.
+
+    Возвращает user_id пропущенных дубликатов — уже участвующих в игре или
+    повторившихся в пачке. Активной игра становится только у тех, у кого
+    активной ещё нет. None — игры нет или жеребьёвка уже проведена.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT draw_done FROM game_stats WHERE game_code = ?", (game_code,))
+    row = c.fetchone()
+    if row is None or row[0]:
+        return None
+
+    new_rows = {}
+    duplicates = []
+    for row in rows:
+        if row[0] in new_rows:
+            duplicates.append(row[0])
+        else:
+            new_rows[row[0]] = row
+    # Пачка любого размера: IN-список дробится под лимит переменных SQLite
+    user_ids = list(new_rows)
+    for i in range(0, len(user_ids), SQL_MAX_VARIABLES - 1):
+        chunk = user_ids[i:i + SQL_MAX_VARIABLES - 1]
+        c.execute(f"""
+            SELECT user_id FROM participants
+            WHERE game_code = ? AND user_id IN ({','.join('?' * len(chunk))})
+        """, (game_code, *chunk))
+        for (user_id,) in c.fetchall():
+            duplicates.append(user_id)
+            del new_rows[user_id]
+    if not new_rows:
+        return duplicates
+
+    c.executemany("""
+        INSERT INTO participants (game_code, user_id, username, full_name, wish, santa_of, ward_of)
+        VALUES (?, ?, ?, ?, '', NULL, NULL)
+    """, [(game_code, *row) for row in new_rows.values()])
+    c.executemany("INSERT OR IGNORE INTO active_games (user_id, game_code) VALUES (?, ?)",
+                  [(user_id, game_code) for user_id in new_rows])
+    c.execute("UPDATE game_stats SET participant_count = participant_count + ?, last_activity = ? WHERE game_code = ?",
+              (len(new_rows), time.time(), game_code))
+    conn.commit()
+    return duplicates
+
+def _set_active(c: sqlite3.Cursor, user_id: int, game_code: str):
+    c.execute("""
+        INSERT INTO active_games (user_id, game_code) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET game_code = excluded.game_code
+    """, (user_id, game_code))
+
+def _repair_active(c: sqlite3.Cursor, where: str, params: tuple):
+    """Переключает active_games, указывающие на игры без участия, на последнюю
+    оставшуюся игру пользователя; если игр не осталось — удаляет запись"""
+    c.execute(f"""
+        UPDATE active_games SET game_code = COALESCE((
+            SELECT p.game_code FROM participants p
+            WHERE p.user_id = active_games.user_id
+            ORDER BY p.rowid DESC LIMIT 1
+        ), '')
+        WHERE {where} AND NOT EXISTS (
+            SELECT 1 FROM participants p
+            WHERE p.game_code = active_games.game_code AND p.user_id = active_games.user_id
+        )
+    """, params)
+    c.execute("DELETE FROM active_games WHERE game_code = ''")
+
+@writer()
+def set_active_game(user_id: int, game_code: str) -> bool:
+    """Делает игру активной; False — пользователь в ней не участвует"""
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("UPDATE participants SET wish = ? WHERE user_id = ?", (wish, user_id))
+    c.execute("SELECT 1 FROM participants WHERE game_code = ? AND user_id = ?", (game_code, user_id))
+    if not c.fetchone():
+        return False
+    _set_active(c, user_id, game_code)
     conn.commit()
-    conn.close()
+    return True
+
+def get_user_games(user_id: int) -> List[Tuple]:
+    """(game_code, is_active) всех игр пользователя"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT game_code, game_code = {ACTIVE_GAME}
+        FROM participants WHERE user_id = ?
+        ORDER BY game_code
+    """, (user_id, user_id))
+    return [(code, bool(active)) for code, active in c.fetchall()]
 
-def get_wish(user_id: int) -> str:
-    conn = sqlite3.connect(DB_PATH)
+@writer()
+def set_wish(user_id: int, wish: str) -> Optional[int]:
+    """Пожелание в активной игре пользователя; возвращает его Санту (чьи
+    сведения о подопечном устарели) или None"""
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT wish FROM participants WHERE user_id = ?", (user_id,))
+    c.execute(f"""
+        SELECT game_code, santa_of, {HAS_WISH} FROM participants
+        WHERE game_code = {ACTIVE_GAME} AND user_id = ?
+    """, (user_id, user_id))
     row = c.fetchone()
-    conn.close()
-    return row[0] if row else ""
+    if row is None:
+        return None
+    game_code, santa_id, had_wish = row
+    c.execute("UPDATE participants SET wish = ? WHERE game_code = ? AND user_id = ?", (wish, game_code, user_id))
+    delta = has_wish(wish) - bool(had_wish)
+    c.execute("UPDATE game_stats SET wishes_set = wishes_set + ?, last_activity = ? WHERE game_code = ?",
+              (delta, time.time(), game_code))
+    conn.commit()
+    return santa_id
 
 def is_creator(user_id: int, game_code: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT creator_id FROM games WHERE game_code = ?", (game_code,))
     row = c.fetchone()
-    conn.close()
     return row and row[0] == user_id
 
 def get_participants(game_code: str) -> List[int]:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT user_id FROM participants WHERE game_code = ?", (game_code,))
     users = [r[0] for r in c.fetchall()]
-    conn.close()
     return users
 
-def assign_pairs(game_code: str) -> bool:
-    users = get_participants(game_code)
-    if len(users) < 3:
-        return False
+# Результаты assign_pairs
+DRAW_OK = "ok"
+DRAW_ALREADY_DONE = "already_done"
+DRAW_IMPOSSIBLE = "impossible"
 
-    shuffled = users[:]
-    for _ in range(100):  # максимум 100 попыток
-        random.shuffle(shuffled)
-        # Проверяем, что никто не дарит себе
-        if all(santa != ward for santa, ward in zip(users, shuffled)):
-            break
-    else:
-        return False  # не удалось развести
+@writer(exclusive=True)
+def assign_pairs(game_code: str, seed: Optional[int] = None,
+                 notification: Optional[Callable[..., Tuple]] = None) -> Tuple[str, int]:
+    """Жеребьёвка игры: (результат, число уведомлений в очереди).
 
-    conn = sqlite3.connect(DB_PATH)
+    Результат — DRAW_OK, DRAW_ALREADY_DONE или DRAW_IMPOSSIBLE (меньше 3
+    участников или исключения не позволяют развести). notification(game_code,
+    santa_id, ward_id, full_name, username, wish) строит сообщение Санте
+    (chat_id, text, parse_mode, dedup_key); сообщения ставятся в outbox той же
+    транзакцией, что и пары, — после сбоя не бывает пар без уведомлений.
+    """
+    conn = get_conn()
     c = conn.cursor()
-    for santa, ward in zip(users, shuffled):
-        c.execute("UPDATE participants SET ward_of = ? WHERE user_id = ?", (ward, santa))
-        c.execute("UPDATE participants SET santa_of = ? WHERE user_id = ?", (santa, ward))
-    conn.commit()
-    conn.close()
-    return True
+    # Проверка, чтение участников и запись пар — одна транзакция: две
+    # одновременные жеребьёвки не перезапишут пары друг друга
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT draw_done FROM game_stats WHERE game_code = ?", (game_code,))
+        row = c.fetchone()
+        if row and row[0]:
+            conn.rollback()
+            return DRAW_ALREADY_DONE, 0
+
+        c.execute("SELECT user_id FROM participants WHERE game_code = ?", (game_code,))
+        users = [r[0] for r in c.fetchall()]
+        if len(users) < 3:
+            conn.rollback()
+            return DRAW_IMPOSSIBLE, 0
+
+        c.execute("SELECT santa_id, ward_id FROM draw_exclusions WHERE game_code = ?", (game_code,))
+        exclusions = c.fetchall()
+        ward_of = None
+        if DRAW_AVOID_REPEAT_DAYS > 0:
+            # Сначала пробуем без прошлогодних пар; если так развести нельзя — только с исключениями
+            c.execute("""
+                SELECT pp.santa_id, pp.ward_id FROM past_pairs pp
+                JOIN participants s ON s.game_code = ? AND s.user_id = pp.santa_id
+                JOIN participants w ON w.game_code = ? AND w.user_id = pp.ward_id
+                WHERE pp.archived_at > ?
+            """, (game_code, game_code, time.time() - DRAW_AVOID_REPEAT_DAYS * 86400))
+            past = c.fetchall()
+            if past:
+                ward_of = draw.assign(users, exclusions=exclusions + past, seed=seed)
+        if ward_of is None:
+            ward_of = draw.assign(users, exclusions=exclusions, seed=seed)
+        if ward_of is None:
+            conn.rollback()
+            return DRAW_IMPOSSIBLE, 0  # исключения не позволяют развести
+
+        santa_of = {ward: santa for santa, ward in ward_of.items()}
+        c.executemany(
+            "UPDATE participants SET ward_of = ?, santa_of = ? WHERE game_code = ? AND user_id = ?",
+            [(ward, santa_of[santa], game_code, santa) for santa, ward in ward_of.items()]
+        )
+        c.execute("UPDATE game_stats SET draw_done = 1 WHERE game_code = ?", (game_code,))
+        queued = 0
+        if notification is not None:
+            queued = _enqueue(c, f"draw:{game_code}",
+                              [notification(game_code, *row) for row in get_draw_results(game_code)])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return DRAW_OK, queued
 
-def get_ward_id(user_id: int) -> Optional[int]:
-    conn = sqlite3.connect(DB_PATH)
+def is_draw_done(game_code: str) -> bool:
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT ward_of FROM participants WHERE user_id = ?", (user_id,))
+    c.execute("SELECT draw_done FROM game_stats WHERE game_code = ?", (game_code,))
     row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return bool(row and row[0])
 
-def get_santa_id(user_id: int) -> Optional[int]:
-    conn = sqlite3.connect(DB_PATH)
+def get_all_participants() -> list:
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT santa_of FROM participants WHERE user_id = ?", (user_id,))
+    c.execute("SELECT DISTINCT user_id FROM participants")
+    user_ids = [row[0] for row in c.fetchall()]
+    return user_ids
+
+def get_creator_game(user_id: int) -> Optional[str]:
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT game_code FROM games WHERE creator_id = ?", (user_id,))
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
-def get_game_code_by_user(user_id: int) -> Optional[str]:
-    conn = sqlite3.connect(DB_PATH)
+def get_creator_id(game_code: str) -> Optional[int]:
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT game_code FROM participants WHERE user_id = ?", (user_id,))
+    c.execute("SELECT creator_id FROM games WHERE game_code = ?", (game_code,))
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
-def is_draw_done(game_code: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+@writer(exclusive=True)
+def delete_game(game_code: str, idle_before: Optional[float] = None) -> bool:
+    """Удаляет игру; игра после жеребьёвки сначала переносится в архив.
+
+    idle_before — удалить, только если игра всё ещё без жеребьёвки и
+    с idle_before в ней ничего не происходило (очистка заброшенных игр).
+    """
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT 1 FROM participants WHERE game_code = ? AND ward_of IS NOT NULL LIMIT 1", (game_code,))
-    result = c.fetchone() is not None
-    conn.close()
-    return result
+    # Архив и удаление — одна транзакция: участники не меняются между ними
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        if idle_before is not None and not _is_idle(c, game_code, idle_before):
+            conn.rollback()
+            return False
+        c.execute("SELECT draw_done FROM game_stats WHERE game_code = ?", (game_code,))
+        row = c.fetchone()
+        if row and row[0]:
+            _archive_game(c, game_code)
+        c.execute("DELETE FROM participants WHERE game_code = ?", (game_code,))
+        c.execute("DELETE FROM draw_exclusions WHERE game_code = ?", (game_code,))
+        c.execute("DELETE FROM scheduled_jobs WHERE game_code = ?", (game_code,))
+        c.execute("DELETE FROM game_stats WHERE game_code = ?", (game_code,))
+        c.execute("DELETE FROM games WHERE game_code = ?", (game_code,))
+        deleted = c.rowcount > 0
+        _repair_active(c, "game_code = ?", (game_code,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
 
-def get_all_participants() -> list:
-    conn = sqlite3.connect(DB_PATH)
+def _delete_participants(c: sqlite3.Cursor, where: str, params: tuple) -> int:
+    """Удаляет участия и вычитает их из game_stats; возвращает число удалённых"""
+    c.execute(f"""
+        SELECT game_code, COUNT(*), SUM({HAS_WISH}), SUM(gift_bought)
+        FROM participants WHERE {where} GROUP BY game_code
+    """, params)
+    removed = c.fetchall()
+    c.execute(f"DELETE FROM participants WHERE {where}", params)
+    deleted = c.rowcount
+    c.executemany("""
+        UPDATE game_stats SET participant_count = participant_count - ?, wishes_set = wishes_set - ?,
+                              gifts_bought = gifts_bought - ?
+        WHERE game_code = ?
+    """, [(count, wishes, gifts, game_code) for game_code, count, wishes, gifts in removed])
+    return deleted
+
+@writer()
+def leave_game(user_id: int) -> Optional[str]:
+    """Выход из активной игры; активной становится последняя из оставшихся.
+
+    Возвращает код покинутой игры или None, если пользователь нигде не участвует.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT game_code FROM active_games WHERE user_id = ?", (user_id,))
+    row = c.fetchone()
+    if row is None or not _delete_participants(c, "game_code = ? AND user_id = ?", (row[0], user_id)):
+        return None
+    _repair_active(c, "user_id = ?", (user_id,))
+    conn.commit()
+    return row[0]
+
+def get_participant(user_id: int) -> Optional[Tuple]:
+    """Запись пользователя в активной игре одним запросом:
+    (game_code, santa_id, ward_id, wish, ward_full_name, ward_username, ward_wish)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT p.game_code, p.santa_of, p.ward_of, p.wish, w.full_name, w.username, w.wish
+        FROM participants p
+        LEFT JOIN participants w ON w.game_code = p.game_code AND w.user_id = p.ward_of
+        WHERE p.game_code = {ACTIVE_GAME} AND p.user_id = ?
+    """, (user_id, user_id))
+    return c.fetchone()
+
+def _keyset_page(sql: str, params: list, order_by: str, cursor_sql: str,
+                 after=None, before=None, limit: int = 20) -> Tuple[List[Tuple], bool]:
+    """Страница по ключу сортировки (keyset-пагинация).
+
+    after/before — ключ крайней строки соседней страницы (значение или кортеж
+    для составного ключа); cursor_sql — условие с плейсхолдером {op} для сравнения. Возвращает строки в порядке сортировки
+    и признак того, что в направлении листания есть ещё строки.
+    """
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT user_id FROM participants")
+    descending = before is not None
+    if after is not None or before is not None:
+        sql += " AND " + cursor_sql.format(op="<" if descending else ">")
+        cursor = before if descending else after
+        params = params + list(cursor if isinstance(cursor, tuple) else (cursor,))
+    direction = "DESC" if descending else "ASC"
+    sql += " ORDER BY " + ", ".join(f"{col} {direction}" for col in order_by.split(", "))
+    c.execute(sql + " LIMIT ?", params + [limit + 1])
+    rows = c.fetchmany(limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if descending:
+        rows.reverse()
+    return rows, has_more
+
+def get_participants_page(game_code: str, after: Optional[Tuple[str, int]] = None,
+                          before: Optional[Tuple[str, int]] = None,
+                          limit: int = 20) -> Tuple[List[Tuple], bool]:
+    """(user_id, full_name, username, wish) участников игры, по имени.
+
+    Курсор — сам ключ сортировки (full_name, user_id), а не ссылка на строку:
+    страница открывается, даже если крайний участник уже вышел из игры.
+    """
+    return _keyset_page(
+        "SELECT user_id, full_name, username, wish FROM participants WHERE game_code = ?",
+        [game_code],
+        "full_name, user_id",
+        "(full_name, user_id) {op} (?, ?)",
+        after, before, limit,
+    )
+
+def get_users_page(after: Optional[int] = None, before: Optional[int] = None,
+                   limit: int = 20) -> Tuple[List[Tuple], bool]:
+    """(rowid, user_id, full_name, username, game_code) всех участий; курсор — rowid"""
+    return _keyset_page(
+        "SELECT rowid, user_id, full_name, username, game_code FROM participants WHERE 1",
+        [], "rowid", "rowid {op} ?", after, before, limit,
+    )
+
+def get_games_page(after: Optional[str] = None, before: Optional[str] = None,
+                   limit: int = 20) -> Tuple[List[Tuple], bool]:
+    """(game_code, creator_id, participant_count) всех игр; курсор — game_code"""
+    return _keyset_page(
+        """
+        SELECT g.game_code, g.creator_id, s.participant_count
+        FROM games g LEFT JOIN game_stats s ON s.game_code = g.game_code
+        WHERE 1
+        """,
+        [], "g.game_code", "g.game_code {op} ?", after, before, limit,
+    )
+
+def get_draw_results(game_code: str) -> List[Tuple]:
+    """(santa_id, ward_id, full_name, username, wish) по всем парам игры одним запросом"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT p.user_id, p.ward_of, w.full_name, w.username, w.wish
+        FROM participants p
+        JOIN participants w ON w.game_code = p.game_code AND w.user_id = p.ward_of
+        WHERE p.game_code = ?
+    """, (game_code,))
+    return c.fetchall()
+
+@writer()
+def delete_user(target: str) -> List[str]:
+    """Удаляет пользователя из всех игр по username (с @ или без) либо по user_id.
+
+    Возвращает коды игр, из которых он удалён; пустой список — не найден.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    # Попробуем как username (без @)
+    username = target.lstrip('@')
+    c.execute("SELECT DISTINCT user_id FROM participants WHERE username = ?", (username,))
     user_ids = [row[0] for row in c.fetchall()]
-    conn.close()
-    return user_ids
\ No newline at end of file
+    if not user_ids and target.isdigit():
+        # Попробуем как user_id (цифры)
+        user_ids = [int(target)]
+    game_codes = []
+    for user_id in user_ids:
+        c.execute("SELECT game_code FROM participants WHERE user_id = ?", (user_id,))
+        game_codes += [row[0] for row in c.fetchall()]
+        _delete_participants(c, "user_id = ?", (user_id,))
+        c.execute("DELETE FROM active_games WHERE user_id = ?", (user_id,))
+    conn.commit()
+    return game_codes
+
+# === СТАТИСТИКА ИГР ===
+
+@writer()
+def mark_gift_bought(user_id: int) -> bool:
+    """Отмечает, что пользователь купил подарок в активной игре (один раз)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        UPDATE participants SET gift_bought = 1
+        WHERE game_code = {ACTIVE_GAME} AND user_id = ? AND gift_bought = 0 AND ward_of IS NOT NULL
+    """, (user_id, user_id))
+    if c.rowcount == 0:
+        conn.rollback()
+        return False
+    c.execute(f"UPDATE game_stats SET gifts_bought = gifts_bought + 1 WHERE game_code = {ACTIVE_GAME}", (user_id,))
+    conn.commit()
+    return True
+
+def get_game_stats(game_code: str) -> Optional[Tuple]:
+    """(participant_count, wishes_set, draw_done, gifts_bought, created_at)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT participant_count, wishes_set, draw_done, gifts_bought, created_at
+        FROM game_stats WHERE game_code = ?
+    """, (game_code,))
+    return c.fetchone()
+
+@writer(exclusive=True)
+def check_game_stats(fix: bool = False) -> List[Tuple]:
+    """Пересчитывает статистику всех игр с нуля и сравнивает с game_stats.
+
+    Возвращает расхождения (game_code, сохранённые, фактические), где счётчики —
+    (participant_count, wishes_set, draw_done, gifts_bought) или None, если
+    строки нет. fix=True записывает фактические значения.
+
+    draw_done не сбрасывается: после жеребьёвки все участники с парами могут
+    выйти из игры, но повторной жеребьёвки быть не должно.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT game_code, participant_count, wishes_set, draw_done, gifts_bought FROM game_stats")
+    stored = {row[0]: row[1:] for row in c.fetchall()}
+    c.execute(GAME_STATS_SQL)
+    mismatches = []
+    for game_code, *actual in c.fetchall():
+        saved = stored.pop(game_code, None)
+        if saved is not None:
+            actual[2] = max(actual[2], saved[2])
+        if saved != tuple(actual):
+            mismatches.append((game_code, saved, tuple(actual)))
+    # Оставшиеся строки относятся к играм, которых уже нет
+    mismatches.extend((game_code, saved, None) for game_code, saved in stored.items())
+
+    if fix and mismatches:
+        now = time.time()
+        for game_code, _, actual in mismatches:
+            if actual is None:
+                c.execute("DELETE FROM game_stats WHERE game_code = ?", (game_code,))
+                continue
+            c.execute("""
+                INSERT INTO game_stats (game_code, participant_count, wishes_set, draw_done, gifts_bought,
+                                        created_at, last_activity)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (game_code) DO UPDATE SET
+                    participant_count = excluded.participant_count, wishes_set = excluded.wishes_set,
+                    draw_done = MAX(draw_done, excluded.draw_done), gifts_bought = excluded.gifts_bought
+            """, (game_code, *actual, now, now))
+        conn.commit()
+    return mismatches
+
+# === АРХИВ И ЭКСПОРТ ===
+
+# Порядок колонок в архиве и в полном экспорте (админ)
+ARCHIVE_COLUMNS = ("user_id", "username", "full_name", "wish", "ward_id", "gift_bought")
+EXPORT_SQL = "SELECT user_id, username, full_name, wish, ward_of, gift_bought FROM participants"
+# Экспорт для организатора — без пар и отметок о подарках: кто кому дарит, остаётся тайной
+PUBLIC_COLUMNS = ARCHIVE_COLUMNS[:4]
+PUBLIC_EXPORT_SQL = "SELECT user_id, username, full_name, wish FROM participants"
+
+def _archive_game(c: sqlite3.Cursor, game_code: str):
+    """Сжимает участников игры в archived_games и запоминает пары в past_pairs.
+
+    Строки сжимаются по одной, поэтому в памяти — только сжатый результат.
+    """
+    now = time.time()
+    compressor = zlib.compressobj(9)
+    chunks = []
+    count = 0
+    for row in c.connection.execute(f"{EXPORT_SQL} WHERE game_code = ? ORDER BY user_id", (game_code,)):
+        chunks.append(compressor.compress(json.dumps(row, ensure_ascii=False).encode() + b"\n"))
+        count += 1
+    chunks.append(compressor.flush())
+    # Код игры из 6 символов мог достаться новой игре — запись о старой тогда заменяется
+    c.execute("""
+        INSERT OR REPLACE INTO archived_games (game_code, creator_id, created_at, archived_at, participant_count, data)
+        SELECT g.game_code, g.creator_id, s.created_at, ?, ?, ?
+        FROM games g JOIN game_stats s ON s.game_code = g.game_code
+        WHERE g.game_code = ?
+    """, (now, count, b"".join(chunks), game_code))
+    c.execute("""
+        INSERT OR REPLACE INTO past_pairs (santa_id, ward_id, archived_at)
+        SELECT user_id, ward_of, ? FROM participants WHERE game_code = ? AND ward_of IS NOT NULL
+    """, (now, game_code))
+
+def get_finished_games(before: float, limit: int) -> List[str]:
+    """Игры после жеребьёвки, созданные раньше before, — кандидаты в архив"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT game_code FROM game_stats
+        WHERE draw_done = 1 AND created_at < ?
+        ORDER BY created_at LIMIT ?
+    """, (before, limit))
+    return [row[0] for row in c.fetchall()]
+
+def get_export_page(game_code: str, after: Optional[int], limit: int, full: bool = False) -> List[Tuple]:
+    """Страница участников для экспорта по user_id: ARCHIVE_COLUMNS или,
+    без full, PUBLIC_COLUMNS"""
+    conn = get_conn()
+    c = conn.cursor()
+    sql = EXPORT_SQL if full else PUBLIC_EXPORT_SQL
+    c.execute(f"{sql} WHERE game_code = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+              (game_code, after if after is not None else -1, limit))
+    return c.fetchall()
+
+def get_archived_game(game_code: str) -> Optional[Tuple]:
+    """(creator_id, created_at, archived_at, participant_count, data)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT creator_id, created_at, archived_at, participant_count, data
+        FROM archived_games WHERE game_code = ?
+    """, (game_code,))
+    return c.fetchone()
+
+def iter_archived_rows(data: bytes, chunk_size: int = 64 * 1024):
+    """Распаковывает архив по кускам и выдаёт строки участников пачками"""
+    decompressor = zlib.decompressobj()
+    tail = b""
+    for i in range(0, len(data), chunk_size):
+        tail += decompressor.decompress(data[i:i + chunk_size])
+        *lines, tail = tail.split(b"\n")
+        if lines:
+            yield [tuple(json.loads(line)) for line in lines]
+    tail += decompressor.flush()
+    if tail.strip():
+        yield [tuple(json.loads(line)) for line in tail.split(b"\n") if line]
+
+# === ОТЛОЖЕННЫЕ ЗАДАЧИ ===
+
+@writer()
+def schedule_job(kind: str, game_code: str, run_at: float, payload: Optional[str] = None,
+                 attempts: int = 0) -> int:
+    """Ставит задачу вида kind для игры; прежняя задача того же вида заменяется.
+
+    Возвращает id новой задачи.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        INSERT OR REPLACE INTO scheduled_jobs (kind, game_code, run_at, payload, attempts)
+        VALUES (?, ?, ?, ?, ?)
+    """, (kind, game_code, run_at, payload, attempts))
+    job_id = c.lastrowid
+    conn.commit()
+    return job_id
+
+@writer()
+def cancel_jobs(game_code: str, kind: Optional[str] = None) -> int:
+    conn = get_conn()
+    c = conn.cursor()
+    if kind is None:
+        c.execute("DELETE FROM scheduled_jobs WHERE game_code = ?", (game_code,))
+    else:
+        c.execute("DELETE FROM scheduled_jobs WHERE game_code = ? AND kind = ?", (game_code, kind))
+    conn.commit()
+    return c.rowcount
+
+@writer()
+def take_job(job_id: int) -> Optional[Tuple]:
+    """Забирает задачу перед выполнением: (kind, game_code, run_at, payload, attempts).
+
+    None — задачу уже отменили или заменили.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("DELETE FROM scheduled_jobs WHERE id = ? RETURNING kind, game_code, run_at, payload, attempts",
+              (job_id,))
+    rows = c.fetchall()
+    conn.commit()
+    return rows[0] if rows else None
+
+def get_jobs_after(last_id: int) -> List[Tuple]:
+    """(id, run_at) задач, добавленных после last_id"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT id, run_at FROM scheduled_jobs WHERE id > ? ORDER BY id", (last_id,))
+    return c.fetchall()
+
+def get_game_jobs(game_code: str) -> List[Tuple]:
+    """(kind, run_at) задач игры"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT kind, run_at FROM scheduled_jobs WHERE game_code = ? ORDER BY run_at", (game_code,))
+    return c.fetchall()
+
+def get_reminder_targets(game_code: str) -> List[Tuple]:
+    """(user_id, есть ли пожелание, куплен ли подарок) участников игры"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"SELECT user_id, {HAS_WISH}, gift_bought FROM participants WHERE game_code = ?", (game_code,))
+    return c.fetchall()
+
+# === ОБСЛУЖИВАНИЕ ===
+
+def get_idle_games(before: float, limit: int) -> List[Tuple]:
+    """(game_code, creator_id) игр без жеребьёвки, где с before ничего не происходило"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT s.game_code, g.creator_id FROM game_stats s
+        JOIN games g ON g.game_code = s.game_code
+        WHERE s.draw_done = 0 AND s.last_activity < ?
+        ORDER BY s.last_activity LIMIT ?
+    """, (before, limit))
+    return c.fetchall()
+
+def _is_idle(c: sqlite3.Cursor, game_code: str, before: float) -> bool:
+    c.execute("SELECT 1 FROM game_stats WHERE game_code = ? AND draw_done = 0 AND last_activity < ?",
+              (game_code, before))
+    return c.fetchone() is not None
+
+@writer()
+def purge_game_rows(game_code: str, idle_before: float, limit: int) -> Optional[int]:
+    """Удаляет до limit участников заброшенной игры короткой транзакцией (перед
+    delete_game для больших игр); статистика и активные игры остаются согласованными.
+
+    None — игра уже не заброшена (кто-то вступил, провели жеребьёвку) или удалена:
+    между пачками проходят записи пользователей, поэтому проверка — в каждой.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    if not _is_idle(c, game_code, idle_before):
+        return None
+    deleted = _delete_participants(
+        c, "rowid IN (SELECT rowid FROM participants WHERE game_code = ? LIMIT ?)", (game_code, limit)
+    )
+    _repair_active(c, "game_code = ?", (game_code,))
+    conn.commit()
+    return deleted
+
+@writer()
+def purge_past_pairs(before: float, limit: int) -> int:
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM past_pairs WHERE (santa_id, ward_id) IN (
+            SELECT santa_id, ward_id FROM past_pairs WHERE archived_at < ? LIMIT ?
+        )
+    """, (before, limit))
+    deleted = c.rowcount
+    conn.commit()
+    return deleted
+
+def is_incremental_vacuum() -> bool:
+    """Включён ли в файле auto_vacuum=INCREMENTAL"""
+    return get_conn().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def get_db_pages() -> Tuple[int, int, int]:
+    """(page_count, freelist_count, page_size)"""
+    conn = get_conn()
+    return tuple(conn.execute(f"PRAGMA {name}").fetchone()[0]
+                 for name in ("page_count", "freelist_count", "page_size"))
+
+@writer(exclusive=True)
+def enable_incremental_vacuum() -> bool:
+    """Переводит существующий файл в auto_vacuum=INCREMENTAL полным VACUUM.
+
+    Запись в БД стоит всё время VACUUM, поэтому запускается только вручную
+    (/admin_vacuum). False — режим уже включён.
+    """
+    conn = get_conn()
+    if is_incremental_vacuum():
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+@writer(exclusive=True)
+def incremental_vacuum(pages: int) -> int:
+    """Возвращает системе до pages свободных страниц; сколько осталось"""
+    conn = get_conn()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+@writer(exclusive=True)
+def analyze(limit: int):
+    """ANALYZE по выборке до limit строк на индекс — быстро даже на большой БД"""
+    conn = get_conn()
+    conn.execute(f"PRAGMA analysis_limit = {int(limit)}")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+# === ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ===
+
+@writer()
+def enqueue_messages(job_id: str, messages: List[Tuple], status_chat_id: Optional[int] = None,
+                     status_message_id: Optional[int] = None) -> int:
+    """Ставит сообщения (chat_id, text, parse_mode, dedup_key) в очередь.
+
+    Сообщения с уже известным dedup_key пропускаются. Возвращает число добавленных.
+    """
+    conn = get_conn()
+    added = _enqueue(conn.cursor(), job_id, messages, status_chat_id, status_message_id)
+    conn.commit()
+    return added
+
+def _enqueue(c: sqlite3.Cursor, job_id: str, messages: List[Tuple], status_chat_id: Optional[int] = None,
+             status_message_id: Optional[int] = None) -> int:
+    """Вставка сообщений в outbox внутри текущей транзакции"""
+    conn = c.connection
+    now = time.time()
+    before = conn.total_changes
+    c.executemany("""
+        INSERT OR IGNORE INTO outbox (job_id, chat_id, text, parse_mode, dedup_key, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(job_id, chat_id, text, parse_mode, dedup_key, now, now)
+          for chat_id, text, parse_mode, dedup_key in messages])
+    added = conn.total_changes - before
+    c.execute("""
+        INSERT INTO outbox_jobs (job_id, status_chat_id, status_message_id, total) VALUES (?, ?, ?, ?)
+        ON CONFLICT (job_id) DO UPDATE SET total = total + excluded.total
+    """, (job_id, status_chat_id, status_message_id, added))
+    return added
+
+def fetch_due_messages(now: float, limit: int) -> List[Tuple]:
+    """(id, job_id, chat_id, text, parse_mode, attempts) сообщений, которые пора отправить"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, job_id, chat_id, text, parse_mode, attempts
+        FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+    """, (now, limit))
+    return c.fetchall()
+
+def next_due_time() -> Optional[float]:
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'")
+    return c.fetchone()[0]
+
+@writer()
+def finish_messages(updates: List[Tuple]):
+    """Сохраняет результаты отправки: (status, attempts, next_attempt_at, id)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.executemany("UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ? WHERE id = ?", updates)
+    conn.commit()
+
+def get_job_progress(job_id: str) -> Optional[Tuple]:
+    """(status_chat_id, status_message_id, total, {status: count}) задания рассылки"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT status_chat_id, status_message_id, total FROM outbox_jobs WHERE job_id = ?", (job_id,))
+    job = c.fetchone()
+    if not job:
+        return None
+    c.execute("SELECT status, COUNT(*) FROM outbox WHERE job_id = ? GROUP BY status", (job_id,))
+    return job + (dict(c.fetchall()),)
+
+def count_outbox() -> dict:
+    """{(status,): количество} сообщений в очереди"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    return {(status,): count for status, count in c.fetchall()}
+
+@writer()
+def purge_outbox(before: float) -> int:
+    """Удаляет завершённые сообщения, созданные раньше before"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < ? RETURNING job_id", (before,))
+    rows = c.fetchall()
+    deleted = len(rows)
+    # Задания, у которых не осталось сообщений; проверяются только затронутые
+    c.executemany("""
+        DELETE FROM outbox_jobs WHERE job_id = ? AND NOT EXISTS (SELECT 1 FROM outbox WHERE job_id = outbox_jobs.job_id)
+    """, [(job_id,) for job_id in {row[0] for row in rows}])
+    conn.commit()
+    return deleted
+
+# === ИСКЛЮЧЕНИЯ ДЛЯ ЖЕРЕБЬЁВКИ ===
+
+def find_participant(game_code: str, target: str) -> Optional[int]:
+    """user_id участника игры по username (с @ или без) либо по ID"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT user_id FROM participants WHERE game_code = ? AND username = ?",
+              (game_code, target.lstrip('@')))
+    row = c.fetchone()
+    if row:
+        return row[0]
+    if target.isdigit():
+        c.execute("SELECT user_id FROM participants WHERE game_code = ? AND user_id = ?",
+                  (game_code, int(target)))
+        row = c.fetchone()
+        if row:
+            return row[0]
+    return None
+
+@writer()
+def add_exclusion(game_code: str, user_a: int, user_b: int):
+    """Запрещает паре участников дарить друг другу (в обе стороны)"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.executemany(
+        "INSERT OR IGNORE INTO draw_exclusions (game_code, santa_id, ward_id) VALUES (?, ?, ?)",
+        [(game_code, user_a, user_b), (game_code, user_b, user_a)]
+    )
+    conn.commit()
+
+# === ХРАНИЛИЩЕ FSM ===
+
+def load_fsm(key: str) -> Optional[Tuple]:
+    """(state, data_json, updated_at) или None"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,))
+    return c.fetchone()
+
+@writer()
+def save_fsm(rows: List[Tuple]):
+    """Сохраняет пачку (key, state, data_json, updated_at) одной транзакцией.
+
+    Записи без состояния и данных удаляются.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.executemany("DELETE FROM fsm_states WHERE key = ?",
+                  [(key,) for key, state, data, _ in rows if state is None and data is None])
+    c.executemany("""
+        INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                        updated_at = excluded.updated_at
+    """, [row for row in rows if row[1] is not None or row[2] is not None])
+    conn.commit()
+
+def count_fsm_states() -> dict:
+    """{(state,): количество} для активных состояний FSM"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT state, COUNT(*) FROM fsm_states WHERE state IS NOT NULL GROUP BY state")
+    return {(state,): count for state, count in c.fetchall()}
+
+@writer()
+def purge_fsm(before: float) -> int:
+    """Удаляет состояния, не менявшиеся с момента before"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+    deleted = c.rowcount
+    conn.commit()
+    return deleted
@@ -0,0 +1,84 @@
+import inspect
+from typing import Any, Callable, Dict, Optional, Union
+
+from aiogram import Router
+from aiogram.types import CallbackQuery, Message
+
+Handler = Callable[..., Any]
+
+class CommandTable:
+    """Маршрутизация кнопок меню и callback-кнопок через словари.
+
+    Вместо цепочки lambda-фильтров, которые aiogram проверяет по очереди для
+    каждого сообщения, в роутере регистрируется по одному обработчику на тип
+    события, а нужная функция находится поиском в словаре за O(1).
+    """
+
+    def __init__(self):
+        self.texts: Dict[str, Handler] = {}
+        self.callbacks: Dict[str, Handler] = {}
+        # длина префикса -> {префикс: обработчик}
+        self.prefixes: Dict[int, Dict[str, Handler]] = {}
+        self._params: Dict[Handler, Optional[frozenset]] = {}
+
+    def _remember(self, handler: Handler):
+        spec = inspect.getfullargspec(handler)
+        # Обработчику с **kwargs передаём всё, остальным — только то, что он принимает
+        self._params[handler] = None if spec.varkw else frozenset(spec.args[1:] + spec.kwonlyargs)
+
+    def button(self, text: str):
+        def decorator(handler: Handler) -> Handler:
+            self.texts[text] = handler
+            self._remember(handler)
+            return handler
+        return decorator
+
+    def callback(self, data: Optional[str] = None, prefix: Optional[str] = None):
+        def decorator(handler: Handler) -> Handler:
+            if prefix is not None:
+                self.prefixes.setdefault(len(prefix), {})[prefix] = handler
+            else:
+                self.callbacks[data] = handler
+            self._remember(handler)
+            return handler
+        return decorator
+
+    def resolve_text(self, text: Optional[str]) -> Optional[Handler]:
+        return self.texts.get(text) if text else None
+
+    def resolve_callback(self, data: Optional[str]) -> Optional[Handler]:
+        if not data:
+            return None
+        handler = self.callbacks.get(data)
+        if handler is None:
+            for length, handlers in self.prefixes.items():
+                handler = handlers.get(data[:length])
+                if handler is not None:
+                    break
+        return handler
+
+    async def _call(self, handler: Handler, event: Union[Message, CallbackQuery], kwargs: Dict[str, Any]):
+        params = self._params[handler]
+        if params is not None:
+            kwargs = {k: v for k, v in kwargs.items() if k in params}
+        return await handler(event, **kwargs)
+
+    def setup(self, router: Router):
+        """Регистрирует обработчики таблицы в роутере.
+
+        Вызывать до регистрации остальных обработчиков: кнопки меню
+        срабатывают в любом состоянии FSM.
+        """
+        async def text_filter(message: Message):
+            handler = self.resolve_text(message.text)
+            return {"table_handler": handler} if handler else False
+
+        async def callback_filter(callback: CallbackQuery):
+            handler = self.resolve_callback(callback.data)
+            return {"table_handler": handler} if handler else False
+
+        async def dispatch(event, table_handler: Handler, **kwargs):
+            return await self._call(table_handler, event, kwargs)
+
+        router.message.register(dispatch, text_filter)
+        router.callback_query.register(dispatch, callback_filter)
@@ -0,0 +1,88 @@
+import random
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+def derangement(users: List[int], seed: Optional[int] = None) -> Dict[int, int]:
+    """Случайная перестановка без неподвижных точек за O(n) (алгоритм Саттоло).
+
+    Результат — один цикл через всех участников, поэтому никто не дарит себе.
+    Возвращает словарь santa -> ward.
+    """
+    rng = random.Random(seed)
+    wards = users[:]
+    for i in range(len(wards) - 1, 0, -1):
+        j = rng.randrange(i)
+        wards[i], wards[j] = wards[j], wards[i]
+    return dict(zip(users, wards))
+
+def _augment(santa: int, candidates: List[int], free: List[int], forbidden: Set[Tuple[int, int]],
+             ward_of: Dict[int, int], santa_of: Dict[int, int]) -> bool:
+    """Ищет чередующийся путь от свободного Санты до свободного подопечного (BFS).
+
+    candidates — Санты с подопечными в порядке просмотра. Граф почти полный,
+    поэтому вместо перебора соседей каждой вершины просматриваются ещё не
+    посещённые Санты: каждый либо посещается, либо остаётся из-за запрета,
+    и один поиск стоит O(n + посещённые * запреты), а не O(n²).
+    """
+    prev: Dict[int, int] = {}
+    unvisited = candidates
+    queue = deque([santa])
+    while queue:
+        u = queue.popleft()
+        for w in free:
+            if w != u and (u, w) not in forbidden:
+                # Нашли свободного подопечного — перекидываем пары вдоль пути
+                free.remove(w)
+                while True:
+                    old = ward_of.get(u)
+                    ward_of[u] = w
+                    santa_of[w] = u
+                    if u == santa:
+                        return True
+                    w, u = old, prev[u]
+        rest = []
+        for v in unvisited:
+            w = ward_of[v]
+            if v == santa or w == u or (u, w) in forbidden:
+                rest.append(v)
+            else:
+                prev[v] = u
+                queue.append(v)
+        unvisited = rest
+    return False
+
+def assign(users: List[int], exclusions: Iterable[Tuple[int, int]] = (),
+           seed: Optional[int] = None) -> Optional[Dict[int, int]]:
+    """Распределение santa -> ward с учётом запрещённых пар (santa, ward).
+
+    Сначала строится цикл Саттоло, затем пары, нарушающие запреты,
+    переназначаются поиском увеличивающих путей в двудольном графе.
+    Возвращает None, если распределение невозможно.
+    """
+    if len(users) < 2:
+        return None
+    rng = random.Random(seed)
+    forbidden = set(exclusions)
+    ward_of = derangement(users, seed=rng.randrange(2 ** 32))
+    if not forbidden:
+        return ward_of
+
+    santa_of: Dict[int, int] = {}
+    for santa in list(ward_of):
+        ward = ward_of[santa]
+        if (santa, ward) in forbidden:
+            del ward_of[santa]
+        else:
+            santa_of[ward] = santa
+
+    free = [ward for ward in users if ward not in santa_of]
+    for santa in users:
+        if santa in ward_of:
+            continue
+        # Просмотр с случайного места: перемешивание всех n на каждый поиск дороже самого поиска
+        candidates = list(ward_of)
+        k = rng.randrange(max(len(candidates), 1))
+        candidates = candidates[k:] + candidates[:k]
+        if not _augment(santa, candidates, free, forbidden, ward_of, santa_of):
+            return None
+    return ward_of
@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+import os
+from typing import AsyncGenerator, AsyncIterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import InputFile
+
+import database as db
+
+# === НАСТРОЙКИ ===
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_FORMATS = ("csv", "jsonl")
+
+async def iter_pages(game_code: str, archived: Optional[bytes] = None,
+                     full: bool = False) -> AsyncIterator[List[Tuple]]:
+    """Участники игры пачками: из живой таблицы по страницам или из архива"""
+    if archived is not None:
+        for rows in db.iter_archived_rows(archived):
+            yield rows
+        return
+    after = None
+    while True:
+        rows = await db.run(db.get_export_page, game_code, after, EXPORT_PAGE_SIZE, full)
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+def encode(rows: List[Tuple], fmt: str, columns: Tuple[str, ...] = db.ARCHIVE_COLUMNS) -> bytes:
+    if fmt == "jsonl":
+        return "".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+        ).encode()
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue().encode()
+
+class GameExport(InputFile):
+    """Файл выгрузки, который формируется по страницам прямо во время отправки.
+
+    Целиком файл не собирается ни в памяти, ни на диске: aiohttp отправляет
+    куски по мере того, как они прочитаны из БД. CSV с BOM и заголовком
+    открывается в Excel и подходит для /import. Пары и отметки о подарках
+    попадают только в полную выгрузку (full, архив).
+    """
+
+    def __init__(self, game_code: str, fmt: str = "csv", archived: Optional[bytes] = None, full: bool = False):
+        super().__init__(filename=f"santa_{game_code}.{fmt}")
+        self.game_code = game_code
+        self.fmt = fmt
+        self.archived = archived
+        self.full = full or archived is not None
+        self.columns = db.ARCHIVE_COLUMNS if self.full else db.PUBLIC_COLUMNS
+        self.rows = 0
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        if self.fmt == "csv":
+            yield "\ufeff".encode() + encode([self.columns], "csv")
+        async for rows in iter_pages(self.game_code, self.archived, self.full):
+            self.rows += len(rows)
+            yield encode(rows, self.fmt, self.columns)
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import database as db
+
+# === НАСТРОЙКИ ===
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+# Сколько держать в памяти неизменённую запись после последнего обращения
+FSM_CACHE_IDLE = 600.0
+PURGE_INTERVAL = 600.0
+
+class _Entry:
+    __slots__ = ("state", "data", "updated_at", "touched_at", "dirty")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+        self.touched_at = time.monotonic()
+        self.dirty = False
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в той же SQLite-базе, что и игры.
+
+    Чтения обслуживаются из кэша в памяти, изменения копятся и записываются
+    пачками раз в FSM_FLUSH_INTERVAL секунд (write-behind). Состояния, не
+    менявшиеся дольше ttl, считаются брошенными и удаляются.
+    """
+
+    def __init__(self, ttl: float = FSM_TTL, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries: Dict[str, _Entry] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+            key.business_connection_id or "", key.destiny,
+        ))
+
+    async def _get_entry(self, key: StorageKey) -> _Entry:
+        skey = self._key(key)
+        entry = self._entries.get(skey)
+        if entry is None:
+            row = await db.run(db.load_fsm, skey)
+            entry = self._entries.get(skey)  # могли загрузить параллельно
+            if entry is None:
+                if row and row[2] >= time.time() - self.ttl:
+                    state, data, updated_at = row
+                    entry = _Entry(state, json.loads(data) if data else {}, updated_at)
+                else:
+                    entry = _Entry(None, {}, time.time())
+                self._entries[skey] = entry
+        entry.touched_at = time.monotonic()
+        return entry
+
+    def _mark_dirty(self, entry: _Entry):
+        entry.updated_at = time.time()
+        entry.dirty = True
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._get_entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._get_entry(key)
+        entry.data = data.copy()
+        self._mark_dirty(entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_entry(key)).data.copy()
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией.
+
+        Флаг dirty снимается до записи: изменение, пришедшее во время неё,
+        снова пометит запись. Если запись не удалась, флаги возвращаются,
+        и изменения уйдут следующим flush.
+        """
+        rows = []
+        saved = []
+        for skey, entry in self._entries.items():
+            if entry.dirty:
+                data = json.dumps(entry.data, ensure_ascii=False, separators=(",", ":")) if entry.data else None
+                rows.append((skey, entry.state, data, entry.updated_at))
+                saved.append(entry)
+                entry.dirty = False
+        if not rows:
+            return
+        try:
+            await db.run(db.save_fsm, rows)
+        except BaseException:
+            for entry in saved:
+                entry.dirty = True
+            raise
+
+        # Выгружаем из памяти давно не используемые записи
+        idle_before = time.monotonic() - FSM_CACHE_IDLE
+        for skey in [k for k, e in self._entries.items() if not e.dirty and e.touched_at < idle_before]:
+            del self._entries[skey]
+
+        if time.time() - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = time.time()
+            purged = await db.run(db.purge_fsm, time.time() - self.ttl)
+            if purged:
+                logging.info(f"FSM: удалено {purged} брошенных состояний")
+
+    async def _flush_loop(self):
+        while any(entry.dirty for entry in self._entries.values()):
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось сохранить состояния FSM: {e}")
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
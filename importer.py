@@ -0,0 +1,195 @@
+import asyncio
+import csv
+import json
+import os
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import database as db
+
+# === НАСТРОЙКИ ===
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # больше Bot API не даёт скачать
+REPORT_SAMPLES = 10  # сколько ошибок и дубликатов показывать в отчёте
+
+CHUNK_SIZE = 64 * 1024
+USERNAME_RE = re.compile(r"[A-Za-z0-9_]{5,32}")
+NAME_LIMIT = 256
+_SEPARATORS = re.compile(r"[\s,]*")
+
+# Допустимые названия колонок / ключей
+USER_ID_KEYS = ("user_id", "id")
+NAME_KEYS = ("full_name", "name")
+USERNAME_KEYS = ("username",)
+
+class ImportAborted(ValueError):
+    """Импорт дальше продолжать нельзя"""
+
+def _iter_csv(f) -> Iterator[Tuple[int, Any]]:
+    reader = csv.reader(f)
+    header: Optional[List[str]] = None
+    for row in reader:
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if header is None and reader.line_num == 1 and not row[0].strip().lstrip("-").isdigit():
+            header = [cell.strip().lower() for cell in row]
+            continue
+        yield reader.line_num, dict(zip(header, row)) if header else row
+
+def _iter_json_lines(f) -> Iterator[Tuple[int, Any]]:
+    for line_no, line in enumerate(f, 1):
+        if line.strip():
+            try:
+                yield line_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, ValueError(f"некорректный JSON: {e.msg}")
+
+def _iter_json_array(f) -> Iterator[Tuple[int, Any]]:
+    """Элементы JSON-массива по одному: в памяти только текущий кусок файла"""
+    decoder = json.JSONDecoder()
+    buf = f.read(CHUNK_SIZE).lstrip()
+    if not buf.startswith("["):
+        raise ValueError("ожидался JSON-массив")
+    pos = 1
+    index = 0
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            if pos >= len(buf):
+                raise json.JSONDecodeError("конец куска", buf, pos)
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Запись участника занимает сотни байт: если целый кусок не
+            # разбирается, файл испорчен — не копим буфер до конца файла
+            if len(buf) - pos > CHUNK_SIZE:
+                raise ValueError("JSON-массив содержит ошибку")
+            more = f.read(CHUNK_SIZE)
+            if not more:
+                raise ValueError("JSON-массив оборван или содержит ошибку")
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        index += 1
+        yield index, item
+
+def read_records(path: str) -> Iterator[Tuple[int, Any]]:
+    """(номер строки или элемента, запись) из CSV, JSON-массива или JSON Lines"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        f.seek(0)
+        if path.endswith(".jsonl") or head == "{":
+            yield from _iter_json_lines(f)
+        elif path.endswith(".json") or head == "[":
+            yield from _iter_json_array(f)
+        else:
+            yield from _iter_csv(f)
+
+def _field(record: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    for key in keys:
+        value = record.get(key)
+        if value not in (None, ""):
+            return value
+    return None
+
+def validate(record: Any) -> Tuple[int, str, str]:
+    """(user_id, username, full_name) или ValueError с причиной"""
+    if isinstance(record, Exception):
+        raise record
+    if isinstance(record, list):  # CSV без заголовка: user_id, full_name, username
+        record = dict(zip(("user_id", "full_name", "username"), record))
+    if not isinstance(record, dict):
+        raise ValueError("ожидался объект с user_id и full_name")
+
+    raw_id = _field(record, USER_ID_KEYS)
+    try:
+        user_id = int(str(raw_id).strip())
+    except ValueError:
+        raise ValueError(f"некорректный user_id: {raw_id!r}")
+    if user_id <= 0:
+        raise ValueError(f"некорректный user_id: {raw_id!r}")
+
+    full_name = str(_field(record, NAME_KEYS) or "").strip()
+    if not full_name:
+        raise ValueError("не указано имя")
+    if len(full_name) > NAME_LIMIT:
+        raise ValueError(f"имя длиннее {NAME_LIMIT} символов")
+
+    username = str(_field(record, USERNAME_KEYS) or "").strip().lstrip("@")
+    if username and not USERNAME_RE.fullmatch(username):
+        raise ValueError(f"некорректный username: {username!r}")
+    # Как в join_game: без username храним ID
+    return user_id, username or str(user_id), full_name
+
+def _parse_batches(path: str, batch_size: int) -> Iterator[Tuple[List[Tuple], List[Tuple[int, str]], Optional[str]]]:
+    """(проверенные строки, ошибки (номер, причина), фатальная ошибка) пачками.
+
+    Пачка отдаётся, когда в ней batch_size записей, включая ошибочные. Если
+    файл оборван или испорчен, последняя пачка несёт то, что успели
+    прочитать, и причину.
+    """
+    batch: List[Tuple] = []
+    errors: List[Tuple[int, str]] = []
+    try:
+        for line_no, record in read_records(path):
+            try:
+                batch.append(validate(record))
+            except ValueError as e:
+                errors.append((line_no, str(e)))
+            if len(batch) + len(errors) >= batch_size:
+                yield batch, errors, None
+                batch, errors = [], []
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        yield batch, errors, str(e)
+        return
+    yield batch, errors, None
+
+async def import_file(path: str, game_code: str, batch_size: int = IMPORT_BATCH_SIZE) -> Dict[str, Any]:
+    """Читает файл потоком и добавляет участников пачками по batch_size.
+
+    Разбор и проверка идут в потоке, event loop не блокируется. Уже
+    добавленные пачки остаются в игре, даже если дальше файл оборван.
+    """
+    report: Dict[str, Any] = {
+        "added": 0,
+        "duplicates": 0,
+        "duplicate_samples": [],
+        "errors": 0,
+        "error_samples": [],
+        "fatal": None,
+    }
+
+    async def flush(batch: List[Tuple]):
+        duplicates = await db.run(db.import_participants, game_code, batch)
+        if duplicates is None:
+            raise ImportAborted("игра удалена или жеребьёвка уже проведена")
+        report["added"] += len(batch) - len(duplicates)
+        report["duplicates"] += len(duplicates)
+        free = REPORT_SAMPLES - len(report["duplicate_samples"])
+        report["duplicate_samples"].extend(duplicates[:max(free, 0)])
+
+    loop = asyncio.get_running_loop()
+    batches = _parse_batches(path, batch_size)
+    try:
+        while True:
+            item = await loop.run_in_executor(None, next, batches, None)
+            if item is None:
+                break
+            batch, errors, fatal = item
+            report["errors"] += len(errors)
+            free = REPORT_SAMPLES - len(report["error_samples"])
+            report["error_samples"].extend(errors[:max(free, 0)])
+            if batch:
+                await flush(batch)
+            if fatal:
+                # Файл оборван или испорчен: то, что успели прочитать, уже добавлено
+                report["fatal"] = fatal
+                break
+    except ImportAborted as e:
+        report["fatal"] = str(e)
+    finally:
+        batches.close()
+    return report
@@ -0,0 +1,813 @@
+"""Нагрузочное тестирование бота без настоящего Telegram.
+
+Поднимает локальный фейковый Bot API (getUpdates/sendMessage/editMessageText
+с настраиваемой задержкой и ответами 429), запускает бота против него и
+прогоняет сценарий: создание игр, вступление, пожелания, жеребьёвка,
+объявления. В конце печатает отчёт в JSON (пропускная способность, p50/p99
+по шагам, время работы с БД), который можно сравнивать между коммитами.
+
+    python loadtest.py --games 100 --players 10
+    python loadtest.py --mode webhook --rate-limit-prob 0.05 --output bench_output.txt
+    python loadtest.py --mode webhook --replay updates.jsonl
+
+Сравнить с прежней работой с БД (новое соединение на каждый вызов прямо в
+event loop): DB_EXECUTOR=inline. Около 1000 одновременных обновлений:
+
+    python loadtest.py --games 90 --players 10
+    DB_EXECUTOR=inline python loadtest.py --games 90 --players 10
+
+Режим contention нагружает только database.py: --writers параллельных
+писателей делают по --writes записей (вступление в игру, затем пожелания).
+Сравнить group commit с записью по одной: DB_WRITE_BATCH=1.
+
+    python loadtest.py --mode contention --writers 100 --writes 50
+
+Режим cluster запускает bot.py отдельным процессом (BOT_MODE=cluster) с
+--workers воркерами против того же фейкового Bot API:
+
+    for n in 1 2 4 8; do python loadtest.py --mode cluster --workers $n; done
+
+Режим import проверяет массовый импорт участников: генерирует файл на
+--rows строк (доля --duplicates повторяет уже встречавшиеся user_id) и
+загружает его в новую игру через importer.py.
+
+    python loadtest.py --mode import --rows 100000 --format csv
+
+Режим startup запускает bot.py отдельным процессом (polling) и измеряет
+холодный старт — от запуска процесса до ответа на первый /start, — а затем
+задержку /start: --starts новых пользователей по одному и те же
+пользователи повторно.
+
+    python loadtest.py --mode startup --starts 500
+
+Режим routing сравнивает стоимость маршрутизации одного обновления: таблица
+CommandTable (поиск в словаре) против прежней цепочки lambda-фильтров
+(m.text == ..., c.data.startswith(...)). Обработчики пустые, обновления
+прогоняются через Dispatcher.feed_update без сети и БД.
+
+    python loadtest.py --mode routing --updates 20000
+
+Режим draw измеряет жеребьёвку на играх из --sizes участников: draw.assign
+отдельно (медиана по --repeat запускам) и assign_pairs целиком — чтение,
+запись пар и уведомления в outbox одной транзакцией. Участники разбиты на
+пары, которым запрещено дарить друг другу, и у каждого есть прошлогодний
+подопечный, которого повторять нельзя. Для сравнения там же запускается
+прежний алгоритм — перемешивание до 100 раз, пока никто не дарит себе
+(rejection_sampling), — без запретов и с теми же запретами.
+
+    python loadtest.py --mode draw --sizes 10,1000,100000
+
+Режим codes заполняет таблицу games --existing играми и создаёт ещё
+--creates игр параллельно через create_game: пропускная способность,
+задержка и число повторов из-за занятого кода.
+
+    python loadtest.py --mode codes --existing 1000000 --creates 20000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "loadtest"
+
+class FakeBotAPI:
+    """Минимальный Bot API: принимает запросы бота и отдаёт ему обновления"""
+
+    def __init__(self, latency: float = 0.0, rate_limit_prob: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.inbox: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        self._message_id = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _message(self, chat_id: int, text: Optional[str]) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "Santa"},
+            "text": text or "",
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getupdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "sendmessage" and random.random() < self.rate_limit_prob:
+            self.rate_limited += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if method in ("sendmessage", "editmessagetext", "editmessagereplymarkup"):
+            chat_id = int(params.get("chat_id", 0))
+            text = params.get("text")
+            if text is not None:
+                self.inbox[chat_id].put_nowait(text)
+            return web.json_response({"ok": True, "result": self._message(chat_id, text)})
+        if method == "getme":
+            return web.json_response({"ok": True, "result": {
+                "id": 123456, "is_bot": True, "first_name": "Santa", "username": "santa_loadtest_bot",
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    async def _get_updates(self, params: dict) -> List[dict]:
+        timeout = float(params.get("timeout", 0) or 0)
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout or 0.01)
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        limit = int(params.get("limit", 100) or 100)
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+class Driver:
+    """Имитирует пользователей: отправляет обновления и ждёт ответов бота"""
+
+    def __init__(self, api: FakeBotAPI, mode: str, webhook_url: Optional[str] = None,
+                 reply_timeout: float = 30.0):
+        self.api = api
+        self.mode = mode
+        self.webhook_url = webhook_url
+        self.reply_timeout = reply_timeout
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.updates_sent = 0
+        self._update_id = 0
+        self._http: Optional[ClientSession] = None
+
+    async def __aenter__(self):
+        self._http = ClientSession()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._http.close()
+
+    def _update(self, user_id: int, text: str) -> dict:
+        self._update_id += 1
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                         "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+
+    async def push(self, update: dict):
+        self.updates_sent += 1
+        if self.mode == "webhook":
+            async with self._http.post(
+                self.webhook_url, json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            ) as response:
+                await response.read()
+        else:
+            self.api.updates.put_nowait(update)
+
+    async def step(self, name: str, user_id: int, text: str, expect: str) -> Optional[str]:
+        """Отправляет текст от пользователя и ждёт ответ, содержащий expect"""
+        inbox = self.api.inbox[user_id]
+        start = time.perf_counter()
+        await self.push(self._update(user_id, text))
+        deadline = start + self.reply_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            try:
+                reply = await asyncio.wait_for(inbox.get(), max(remaining, 0.001))
+            except asyncio.TimeoutError:
+                self.errors[f"{name}: timeout"] += 1
+                return None
+            # Уведомления из очереди (жеребьёвка, объявления) приходят вперемешку с ответами
+            if expect in reply:
+                self.latencies[name].append(time.perf_counter() - start)
+                return reply
+
+    async def play_game(self, organizer: int, players: List[int]):
+        reply = await self.step("create_game", organizer, "🆕 Создать игру", "Игра создана")
+        if not reply:
+            return
+        code = reply.split("<b>", 1)[1].split("</b>", 1)[0]
+
+        async def join_and_wish(user_id: int):
+            await self.step("join_button", user_id, "🚪 Присоединиться", "Введите код игры")
+            if not await self.step("join_game", user_id, code, "Вы присоединились"):
+                return
+            await self.step("wish_button", user_id, "🎁 Мои пожелания", "Напишите, что бы")
+            await self.step("set_wish", user_id, f"Подарок для {user_id}", "Пожелания сохранены")
+
+        await asyncio.gather(*(join_and_wish(u) for u in [organizer] + players))
+        await self.step("draw", organizer, "🎲 Жеребьёвка", "Жеребьёвка проведена")
+        await self.step("announce_button", organizer, "📣 Отправить объявление", "Введите текст объявления")
+        await self.step("announce", organizer, "Встречаемся в пятницу!", "поставлено в очередь")
+
+    async def replay(self, path: str, concurrency: int):
+        """Отправляет записанные обновления (по одному JSON на строку) как есть"""
+        with open(path, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+        queue = iter(updates)
+
+        async def worker():
+            for update in queue:
+                start = time.perf_counter()
+                try:
+                    await self.push(update)
+                except Exception as e:
+                    self.errors[f"replay: {type(e).__name__}"] += 1
+                    continue
+                self.latencies["replay"].append(time.perf_counter() - start)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def wait_outbox(timeout: float) -> tuple:
+    """Ждёт, пока outbox-воркер разошлёт очередь: объявления и итоги жеребьёвки
+    уходят через outbox, и без этого sends и api_calls занижены.
+
+    Возвращает (секунд ожидания, сколько сообщений так и осталось в очереди).
+    """
+    import database as db
+    start = time.perf_counter()
+    while True:
+        pending = (await db.run(db.count_outbox)).get(("pending",), 0)
+        if not pending or time.perf_counter() - start > timeout:
+            return time.perf_counter() - start, pending
+        await asyncio.sleep(0.1)
+
+def build_report(args, driver: Driver, api: FakeBotAPI, elapsed: float) -> dict:
+    import metrics
+
+    db_calls = sum(series[-1] for series in metrics.DB_LATENCY.values.values())
+    db_time = sum(series[-2] for series in metrics.DB_LATENCY.values.values())
+    return {
+        "revision": git_revision(),
+        "mode": args.mode,
+        "games": args.games,
+        "players_per_game": args.players,
+        "api_latency_ms": args.latency * 1000,
+        "rate_limit_prob": args.rate_limit_prob,
+        "db_executor": os.getenv("DB_EXECUTOR", "pool"),
+        "duration_s": round(elapsed, 3),
+        "updates": driver.updates_sent,
+        "updates_per_s": round(driver.updates_sent / elapsed, 1) if elapsed else 0.0,
+        "steps": {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            }
+            for name, values in driver.latencies.items()
+        },
+        "db": {
+            "calls": int(db_calls),
+            "total_s": round(db_time, 3),
+            "mean_ms": round(db_time / db_calls * 1000, 3) if db_calls else 0.0,
+        },
+        "handler_errors": {labels[0]: int(v) for labels, v in metrics.HANDLER_ERRORS.values.items()},
+        "sends": {labels[0]: int(v) for labels, v in metrics.MESSAGES_SENT.values.items()},
+        "api_calls": dict(api.calls),
+        "rate_limited": api.rate_limited,
+        "errors": dict(driver.errors),
+    }
+
+async def run(args) -> dict:
+    api = FakeBotAPI(latency=args.latency, rate_limit_prob=args.rate_limit_prob)
+    api_runner = web.AppRunner(api.app())
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", args.api_port).start()
+
+    # Бот читает настройки при импорте, поэтому импортируем его после подготовки окружения
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import bot as santa
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    santa.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.api_port}"))
+
+    if args.mode == "cluster":
+        return await run_cluster(args, api, api_runner)
+
+    bot_runner = None
+    polling = None
+    if args.mode == "webhook":
+        from webhook import create_app
+        bot_runner = web.AppRunner(create_app(santa.dp, santa.bot))
+        await bot_runner.setup()
+        await web.TCPSite(bot_runner, "127.0.0.1", args.webhook_port).start()
+    else:
+        polling = asyncio.create_task(santa.dp.start_polling(santa.bot, handle_signals=False, polling_timeout=1))
+        await asyncio.sleep(0.5)
+
+    webhook_url = f"http://127.0.0.1:{args.webhook_port}{os.environ['WEBHOOK_PATH']}"
+    async with Driver(api, args.mode, webhook_url, reply_timeout=args.reply_timeout) as driver:
+        start = time.perf_counter()
+        if args.replay:
+            await driver.replay(args.replay, args.concurrency)
+        else:
+            base = 10_000_000
+            games = []
+            for g in range(args.games):
+                organizer = base + g * (args.players + 1)
+                games.append(driver.play_game(organizer, [organizer + i + 1 for i in range(args.players)]))
+            await asyncio.gather(*games)
+        elapsed = time.perf_counter() - start
+        drain_s, pending = await wait_outbox(args.reply_timeout)
+
+    if polling:
+        await santa.dp.stop_polling()
+        await polling
+    if bot_runner:
+        await bot_runner.cleanup()
+    await api_runner.cleanup()
+    report = build_report(args, driver, api, elapsed)
+    report["outbox"] = {"drain_s": round(drain_s, 3), "pending": pending}
+    return report
+
+async def run_cluster(args, api: FakeBotAPI, api_runner: web.AppRunner) -> dict:
+    """Бот в отдельном процессе: ingress с polling и --workers воркеров"""
+    env = dict(
+        os.environ,
+        BOT_MODE="cluster",
+        CLUSTER_WORKERS=str(args.workers),
+        CLUSTER_INGRESS="polling",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+    )
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    process = await asyncio.create_subprocess_exec(sys.executable, script, env=env, stderr=subprocess.DEVNULL)
+    # Ingress начинает опрашивать getUpdates, когда все воркеры готовы
+    while not api.calls["getupdates"]:
+        if process.returncode is not None:
+            raise RuntimeError(f"bot.py завершился с кодом {process.returncode}")
+        await asyncio.sleep(0.1)
+
+    async with Driver(api, "polling", reply_timeout=args.reply_timeout) as driver:
+        start = time.perf_counter()
+        base = 10_000_000
+        games = []
+        for g in range(args.games):
+            organizer = base + g * (args.players + 1)
+            games.append(driver.play_game(organizer, [organizer + i + 1 for i in range(args.players)]))
+        await asyncio.gather(*games)
+        elapsed = time.perf_counter() - start
+        drain_s, pending = await wait_outbox(args.reply_timeout)
+
+    process.send_signal(signal.SIGTERM)
+    await process.wait()
+    await api_runner.cleanup()
+    report = build_report(args, driver, api, elapsed)
+    # Метрики БД и обработчиков остались в процессах бота
+    for key in ("db", "handler_errors", "sends"):
+        report.pop(key)
+    report["outbox"] = {"drain_s": round(drain_s, 3), "pending": pending}
+    report["workers"] = args.workers
+    return report
+
+async def startup(args) -> dict:
+    """Холодный старт bot.py и задержка /start, без параллельной нагрузки"""
+    api = FakeBotAPI(latency=args.latency)
+    api_runner = web.AppRunner(api.app())
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", args.api_port).start()
+
+    env = dict(os.environ, BOT_MODE="polling", TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    base = 20_000_000
+    async with Driver(api, "polling", reply_timeout=args.reply_timeout) as driver:
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(sys.executable, script, env=env, stderr=subprocess.DEVNULL)
+        # Обновление лежит в очереди фейкового API с момента запуска процесса
+        reply = await driver.step("cold_start", base, "/start", "Добро пожаловать")
+        cold_start = time.perf_counter() - start
+        if reply:
+            for user_id in range(base + 1, base + 1 + args.starts):
+                await driver.step("start_new", user_id, "/start", "Добро пожаловать")
+            for user_id in range(base + 1, base + 1 + args.starts):
+                await driver.step("start_repeat", user_id, "/start", "Добро пожаловать")
+        elapsed = time.perf_counter() - start
+        drain_s, pending = await wait_outbox(args.reply_timeout)
+
+    process.send_signal(signal.SIGTERM)
+    await process.wait()
+    await api_runner.cleanup()
+    report = build_report(args, driver, api, elapsed)
+    for key in ("games", "players_per_game", "rate_limit_prob", "db", "handler_errors", "sends"):
+        report.pop(key)
+    report["cold_start_s"] = round(cold_start, 3)
+    report["starts"] = args.starts
+    return report
+
+def routing_updates(texts: List[str], callbacks: List[str], count: int) -> List[dict]:
+    """Смесь обновлений: кнопки меню, /start, callback-кнопки и произвольный текст"""
+    rng = random.Random(42)
+    updates = []
+    for update_id in range(1, count + 1):
+        user = {"id": 1000 + update_id % 100, "is_bot": False, "first_name": "User"}
+        chat = {"id": user["id"], "type": "private"}
+        kind = rng.random()
+        if kind < 0.1:
+            updates.append({"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": "1", "data": rng.choice(callbacks),
+                "message": {"message_id": 1, "date": 0, "chat": chat, "text": "menu"},
+            }})
+            continue
+        if kind < 0.7:
+            text = rng.choice(texts)
+        elif kind < 0.8:
+            text = "/start"
+        else:
+            text = f"Пожелание {update_id}"  # не совпадает ни с одной кнопкой
+        updates.append({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "chat": chat, "from": user, "text": text,
+        }})
+    return updates
+
+async def routing(args) -> dict:
+    """Маршрутизация обновлений: CommandTable против цепочки lambda-фильтров"""
+    from aiogram import Bot, Dispatcher, Router
+    from aiogram.filters import Command
+    from aiogram.types import Update
+    from bot import menu
+    from dispatch import CommandTable
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    async def noop(event, **kwargs):
+        pass
+
+    # Прежняя схема: по обработчику с lambda-фильтром на каждую кнопку
+    chain = Router()
+    chain.message.register(noop, Command("start"))
+    for text in menu.texts:
+        chain.message.register(noop, lambda m, text=text: m.text == text)
+    for data in menu.callbacks:
+        chain.callback_query.register(noop, lambda c, data=data: c.data == data)
+    for handlers in menu.prefixes.values():
+        for prefix in handlers:
+            chain.callback_query.register(noop, lambda c, prefix=prefix: c.data.startswith(prefix))
+
+    table = CommandTable()
+    for text in menu.texts:
+        table.button(text)(noop)
+    for data in menu.callbacks:
+        table.callback(data)(noop)
+    for handlers in menu.prefixes.values():
+        for prefix in handlers:
+            table.callback(prefix=prefix)(noop)
+    indexed = Router()
+    indexed.message.register(noop, Command("start"))
+    table.setup(indexed)
+
+    callbacks = list(menu.callbacks) + [prefix + "1" for handlers in menu.prefixes.values() for prefix in handlers]
+    raw = routing_updates(list(menu.texts), callbacks, args.updates)
+    bot = Bot(token=TOKEN)
+    report = {
+        "revision": git_revision(),
+        "mode": args.mode,
+        "updates": args.updates,
+        "buttons": len(menu.texts),
+        "callbacks": len(callbacks),
+    }
+    for name, router in (("lambda_chain", chain), ("command_table", indexed)):
+        dp = Dispatcher()
+        dp.include_router(router)
+        updates = [Update.model_validate(update, context={"bot": bot}) for update in raw]
+        for update in updates[:1000]:  # прогрев
+            await dp.feed_update(bot, update)
+        latencies = []
+        for update in updates:
+            start = time.perf_counter()
+            await dp.feed_update(bot, update)
+            latencies.append(time.perf_counter() - start)
+        report[name] = {
+            "mean_us": round(sum(latencies) / len(latencies) * 1e6, 1),
+            "p50_us": round(percentile(latencies, 0.50) * 1e6, 1),
+            "p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        }
+    await bot.session.close()
+    return report
+
+def draw_exclusions(users: List[int], seed: int = 42) -> List[tuple]:
+    """Запреты для жеребьёвки: пары в обе стороны и прошлогодний подопечный"""
+    rng = random.Random(seed)
+    exclusions = []
+    for a, b in zip(users[::2], users[1::2]):
+        exclusions += [(a, b), (b, a)]
+    exclusions += [(user_id, rng.choice(users)) for user_id in users]
+    return exclusions
+
+def rejection_sampling(users: List[int], forbidden: set = frozenset(),
+                       seed: Optional[int] = None) -> tuple:
+    """Прежняя жеребьёвка из assign_pairs, для сравнения: (пары или None, попыток)"""
+    rng = random.Random(seed)
+    shuffled = users[:]
+    for attempt in range(1, 101):  # максимум 100 попыток
+        rng.shuffle(shuffled)
+        if all(santa != ward and (santa, ward) not in forbidden for santa, ward in zip(users, shuffled)):
+            return dict(zip(users, shuffled)), attempt
+    return None, 100
+
+async def draw_benchmark(args) -> dict:
+    """draw.assign и assign_pairs на играх разного размера, без бота"""
+    import database as db
+    import draw
+
+    def notification(game_code, santa_id, ward_id, full_name, username, wish):
+        return santa_id, f"Ваш подопечный: {full_name}", None, f"draw:{game_code}:{santa_id}"
+
+    await db.run(db.init_db)
+    await db.warm_pool()
+    report = {"revision": git_revision(), "mode": args.mode, "sizes": {}}
+    for size in args.sizes:
+        users = list(range(40_000_000, 40_000_000 + size))
+        exclusions = draw_exclusions(users)
+        timings = []
+        for seed in range(args.repeat):
+            start = time.perf_counter()
+            pairs = draw.assign(users, exclusions, seed=seed)
+            timings.append(time.perf_counter() - start)
+            assert pairs is not None
+
+        # Прежний алгоритм: без запретов и с запретами, проверяемыми после перемешивания
+        old = {}
+        forbidden = set(exclusions)
+        for name, rules in (("rejection_sampling", frozenset()), ("rejection_sampling_exclusions", forbidden)):
+            old_timings, attempts, failures = [], [], 0
+            for seed in range(args.repeat):
+                start = time.perf_counter()
+                pairs, attempt = rejection_sampling(users, rules, seed=seed)
+                old_timings.append(time.perf_counter() - start)
+                attempts.append(attempt)
+                failures += pairs is None
+            old[name] = {
+                "p50_ms": round(percentile(old_timings, 0.50) * 1000, 2),
+                "max_ms": round(max(old_timings) * 1000, 2),
+                "mean_attempts": round(sum(attempts) / len(attempts), 1),
+                "failures": failures,
+            }
+
+        game_code = await db.run(db.create_game, size)
+        for i in range(0, size, 500):
+            await db.run(db.import_participants, game_code,
+                         [(u, f"user{u}", f"User {u}") for u in users[i:i + 500]])
+        await asyncio.gather(*(db.run(db.add_exclusion, game_code, a, b)
+                               for a, b in zip(users[::2], users[1::2])))
+        start = time.perf_counter()
+        result, queued = await db.run(db.assign_pairs, game_code, seed=1, notification=notification)
+        elapsed = time.perf_counter() - start
+        report["sizes"][size] = {
+            "assign_p50_ms": round(percentile(timings, 0.50) * 1000, 2),
+            "assign_max_ms": round(max(timings) * 1000, 2),
+            "assign_pairs_ms": round(elapsed * 1000, 2),
+            "result": result,
+            "queued": queued,
+            **old,
+        }
+    db.close_pool()
+    return report
+
+async def code_allocation(args) -> dict:
+    """create_game при --existing уже существующих играх, без бота"""
+    import database as db
+    from metrics import GAME_CODE_COLLISIONS
+
+    def populate(count: int):
+        codes = set()
+        while len(codes) < count:
+            codes.add(db.generate_game_code())
+        conn = db.get_conn()
+        conn.executemany("INSERT INTO games (game_code, creator_id) VALUES (?, ?)",
+                         ((code, -i) for i, code in enumerate(codes, 1)))
+        conn.commit()
+
+    await db.run(db.init_db)
+    start = time.perf_counter()
+    await db.run(populate, args.existing)
+    populate_s = time.perf_counter() - start
+    await db.warm_pool()
+
+    latencies: List[float] = []
+
+    async def create(creator_id: int):
+        start = time.perf_counter()
+        await db.run(db.create_game, creator_id)
+        latencies.append(time.perf_counter() - start)
+
+    collisions = sum(GAME_CODE_COLLISIONS.values.values())
+    start = time.perf_counter()
+    await asyncio.gather(*(create(creator_id) for creator_id in range(1, args.creates + 1)))
+    elapsed = time.perf_counter() - start
+    collisions = sum(GAME_CODE_COLLISIONS.values.values()) - collisions
+    code_space = len(db.GAME_CODE_ALPHABET) ** db.GAME_CODE_LENGTH
+    db.close_pool()
+    return {
+        "revision": git_revision(),
+        "mode": args.mode,
+        "existing_games": args.existing,
+        "populate_s": round(populate_s, 1),
+        "creates": args.creates,
+        "duration_s": round(elapsed, 3),
+        "creates_per_s": round(args.creates / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "collisions": int(collisions),
+        "expected_collisions": round(args.creates * (args.existing + args.creates / 2) / code_space, 1),
+    }
+
+async def contention(args) -> dict:
+    """Параллельные писатели напрямую к database.py, без бота"""
+    import database as db
+
+    await db.run(db.init_db)
+    await db.warm_pool()
+    game_code = await db.run(db.create_game, 1)
+    latencies: List[float] = []
+    errors: Counter = Counter()
+
+    async def write_loop(n: int):
+        user_id = 20_000_000 + n
+        for i in range(args.writes):
+            start = time.perf_counter()
+            try:
+                if i == 0:
+                    await db.run(db.join_game, user_id, f"user{user_id}", f"User {user_id}", game_code)
+                else:
+                    await db.run(db.set_wish, user_id, f"wish {i}")
+            except Exception as e:
+                errors[f"{type(e).__name__}: {e}"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(write_loop(n) for n in range(args.writers)))
+    elapsed = time.perf_counter() - start
+    db.close_pool()
+    return {
+        "revision": git_revision(),
+        "mode": args.mode,
+        "writers": args.writers,
+        "writes_per_writer": args.writes,
+        "write_batch": db.DB_WRITE_BATCH,
+        "synchronous": db.DB_SYNCHRONOUS,
+        "duration_s": round(elapsed, 3),
+        "writes": len(latencies),
+        "writes_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "errors": dict(errors),
+    }
+
+def write_import_file(path: str, fmt: str, rows: int, duplicates: float) -> int:
+    """Файл для импорта; возвращает число уникальных user_id"""
+    rng = random.Random(42)
+    unique = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            f.write("user_id,full_name,username\n")
+        elif fmt == "json":
+            f.write("[\n")
+        for i in range(rows):
+            if unique and rng.random() < duplicates:
+                user_id = 30_000_000 + rng.randrange(unique)
+            else:
+                user_id = 30_000_000 + unique
+                unique += 1
+            name, username = f"Сотрудник {user_id}", f"employee{user_id}"
+            if fmt == "csv":
+                f.write(f"{user_id},{name},{username}\n")
+            else:
+                record = json.dumps({"user_id": user_id, "full_name": name, "username": username},
+                                    ensure_ascii=False)
+                f.write(record + (",\n" if fmt == "json" and i < rows - 1 else "\n"))
+        if fmt == "json":
+            f.write("]\n")
+    return unique
+
+async def import_benchmark(args) -> dict:
+    """Импорт файла на --rows строк в одну игру, без бота"""
+    import database as db
+    import importer
+
+    fd, path = tempfile.mkstemp(suffix=f".{args.format}")
+    os.close(fd)
+    unique = write_import_file(path, args.format, args.rows, args.duplicates)
+    await db.run(db.init_db)
+    await db.warm_pool()
+    game_code = await db.run(db.create_game, 1)
+
+    start = time.perf_counter()
+    result = await importer.import_file(path, game_code)
+    elapsed = time.perf_counter() - start
+    stats = await db.run(db.get_game_stats, game_code)
+    size = os.path.getsize(path)
+    os.remove(path)
+    db.close_pool()
+    return {
+        "revision": git_revision(),
+        "mode": args.mode,
+        "format": args.format,
+        "rows": args.rows,
+        "file_mb": round(size / 2**20, 2),
+        "batch_size": importer.IMPORT_BATCH_SIZE,
+        "duration_s": round(elapsed, 3),
+        "rows_per_s": round(args.rows / elapsed, 1) if elapsed else 0.0,
+        "added": result["added"],
+        "duplicates": result["duplicates"],
+        "errors": result["errors"],
+        "fatal": result["fatal"],
+        "expected_unique": unique,
+        "participant_count": stats[0],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API")
+    parser.add_argument("--mode", choices=("polling", "webhook", "cluster", "contention", "import", "startup", "routing", "draw", "codes"), default="polling")
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--players", type=int, default=10, help="участников в игре помимо организатора")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, секунды")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="доля sendMessage с ответом 429")
+    parser.add_argument("--replay", help="файл с записанными обновлениями (JSON Lines), только для webhook")
+    parser.add_argument("--concurrency", type=int, default=50, help="параллельность при --replay")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8082)
+    parser.add_argument("--workers", type=int, default=4, help="процессов-воркеров в режиме cluster")
+    parser.add_argument("--writers", type=int, default=100, help="параллельных писателей в режиме contention")
+    parser.add_argument("--writes", type=int, default=50, help="записей на писателя в режиме contention")
+    parser.add_argument("--rows", type=int, default=100_000, help="строк в файле для режима import")
+    parser.add_argument("--format", choices=("csv", "json", "jsonl"), default="csv", help="формат файла для режима import")
+    parser.add_argument("--duplicates", type=float, default=0.01, help="доля повторных user_id в режиме import")
+    parser.add_argument("--starts", type=int, default=200, help="пользователей, отправляющих /start, в режиме startup")
+    parser.add_argument("--updates", type=int, default=20_000, help="обновлений в режиме routing")
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10, 1000, 100_000],
+                        help="размеры игр через запятую в режиме draw")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов draw.assign на размер в режиме draw")
+    parser.add_argument("--existing", type=int, default=1_000_000, help="уже существующих игр в режиме codes")
+    parser.add_argument("--creates", type=int, default=20_000, help="создаваемых игр в режиме codes")
+    parser.add_argument("--db", help="путь к БД (по умолчанию — временный файл)")
+    parser.add_argument("--output", help="куда записать отчёт (по умолчанию stdout)")
+    args = parser.parse_args()
+    if args.replay and args.mode != "webhook":
+        parser.error("--replay работает только с --mode webhook")
+
+    tmpdir = tempfile.mkdtemp(prefix="santa-loadtest-")
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["DB_PATH"] = args.db or os.path.join(tmpdir, "santa.db")
+    os.environ["WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    os.environ.setdefault("WEBHOOK_PATH", "/webhook")
+    os.environ.setdefault("FSM_STORAGE", "sqlite")
+
+    benchmark = {"contention": contention, "import": import_benchmark, "startup": startup, "routing": routing, "draw": draw_benchmark, "codes": code_allocation}.get(args.mode, run)
+    report = json.dumps(asyncio.run(benchmark(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    sys.exit(main())
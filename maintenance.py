@@ -0,0 +1,145 @@
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import database as db
+from metrics import DB_RECLAIMED, MAINTENANCE_PURGED, MAINTENANCE_SECONDS
+
+# === НАСТРОЙКИ ===
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", str(6 * 3600)))
+# Игры без жеребьёвки, где столько дней никто не вступал, не менял пожелания
+# и не импортировал участников, удаляются; 0 — не удалять
+GAME_IDLE_TTL_DAYS = float(os.getenv("GAME_IDLE_TTL_DAYS", "90"))
+# Строк на транзакцию при удалении: писатель не занят надолго
+MAINTENANCE_BATCH = int(os.getenv("MAINTENANCE_BATCH", "500"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))
+ANALYZE_LIMIT = int(os.getenv("ANALYZE_LIMIT", "1000"))
+GAMES_PER_PASS = 100
+
+class _Step:
+    """Замеряет шаг обслуживания: метрика и время в отчёте"""
+
+    def __init__(self, report: Dict[str, float], name: str):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        MAINTENANCE_SECONDS.observe(elapsed, self.name)
+        self.report[f"{self.name}_s"] = round(elapsed, 3)
+
+# (код игры, id создателя) -> None; вызывается после удаления заброшенной игры
+GameDeleted = Callable[[str, int], Awaitable[None]]
+
+async def purge_idle_games(on_game_deleted: Optional[GameDeleted] = None) -> Dict[str, int]:
+    """Удаляет игры без жеребьёвки, где GAME_IDLE_TTL_DAYS не было действий.
+
+    Участники удаляются пачками по MAINTENANCE_BATCH, каждая — отдельной
+    записью писателя, так что между пачками проходят записи пользователей.
+    Каждая пачка и само удаление заново проверяют, что игра всё ещё
+    заброшена: если в неё вступили или провели жеребьёвку, игра остаётся.
+    """
+    before = time.time() - GAME_IDLE_TTL_DAYS * 86400
+    games = participants = 0
+    for game_code, creator_id in await db.run(db.get_idle_games, before, GAMES_PER_PASS):
+        while True:
+            deleted = await db.run(db.purge_game_rows, game_code, before, MAINTENANCE_BATCH)
+            if deleted is None:
+                break
+            participants += deleted
+            if deleted < MAINTENANCE_BATCH:
+                break
+        if deleted is None or not await db.run(db.delete_game, game_code, before):
+            continue
+        games += 1
+        if on_game_deleted is not None:
+            await on_game_deleted(game_code, creator_id)
+    MAINTENANCE_PURGED.inc("game", amount=games)
+    MAINTENANCE_PURGED.inc("participant", amount=participants)
+    return {"games": games, "participants": participants}
+
+async def purge_past_pairs() -> int:
+    if db.DRAW_AVOID_REPEAT_DAYS <= 0:
+        return 0
+    before = time.time() - db.DRAW_AVOID_REPEAT_DAYS * 86400
+    purged = 0
+    while True:
+        deleted = await db.run(db.purge_past_pairs, before, MAINTENANCE_BATCH)
+        purged += deleted
+        if deleted < MAINTENANCE_BATCH:
+            break
+    MAINTENANCE_PURGED.inc("past_pair", amount=purged)
+    return purged
+
+async def db_bytes() -> int:
+    page_count, _, page_size = await db.run(db.get_db_pages)
+    return page_count * page_size
+
+async def vacuum() -> int:
+    """Возвращает системе свободные страницы; сколько байт освобождено.
+
+    incremental_vacuum идёт шагами по VACUUM_STEP_PAGES, между шагами
+    писатель выполняет остальные записи. В файле, созданном до включения
+    auto_vacuum, шаги ничего не освобождают — нужен full_vacuum.
+    """
+    before = await db_bytes()
+    _, free_pages, _ = await db.run(db.get_db_pages)
+    while free_pages:
+        remaining = await db.run(db.incremental_vacuum, VACUUM_STEP_PAGES)
+        if remaining >= free_pages:
+            break
+        free_pages = remaining
+    reclaimed = max(0, before - await db_bytes())
+    DB_RECLAIMED.inc(amount=reclaimed)
+    return reclaimed
+
+async def full_vacuum() -> Dict[str, float]:
+    """Однократный перевод файла в auto_vacuum=INCREMENTAL полным VACUUM.
+
+    Писатель занят всё время VACUUM (на большом файле — минуты), поэтому
+    только по команде администратора, не из планового прохода.
+    """
+    report: Dict[str, float] = {}
+    before = await db_bytes()
+    with _Step(report, "full_vacuum"):
+        report["converted"] = await db.run(db.enable_incremental_vacuum)
+    report["reclaimed_bytes"] = max(0, before - await db_bytes())
+    report["db_bytes"] = await db_bytes()
+    DB_RECLAIMED.inc(amount=report["reclaimed_bytes"])
+    logging.info(
+        f"Полный VACUUM: {'выполнен' if report['converted'] else 'не нужен, auto_vacuum уже включён'}, "
+        f"освобождено {report['reclaimed_bytes'] / 2**20:.1f} МБ за {report['full_vacuum_s']} с"
+    )
+    return report
+
+async def run_maintenance(on_game_deleted: Optional[GameDeleted] = None) -> Dict[str, float]:
+    """Один проход обслуживания БД; отчёт пишет в лог и возвращает"""
+    report: Dict[str, float] = {}
+    if GAME_IDLE_TTL_DAYS > 0:
+        with _Step(report, "purge_games"):
+            purged = await purge_idle_games(on_game_deleted)
+        report["games_purged"] = purged["games"]
+        report["participants_purged"] = purged["participants"]
+    with _Step(report, "purge_pairs"):
+        report["past_pairs_purged"] = await purge_past_pairs()
+
+    report["vacuum_required"] = not await db.run(db.is_incremental_vacuum)
+    if report["vacuum_required"]:
+        logging.warning("Обслуживание БД: auto_vacuum не включён, место не возвращается — выполните /admin_vacuum")
+    with _Step(report, "vacuum"):
+        report["reclaimed_bytes"] = 0 if report["vacuum_required"] else await vacuum()
+    with _Step(report, "analyze"):
+        await db.run(db.analyze, ANALYZE_LIMIT)
+
+    report["db_bytes"] = await db_bytes()
+    logging.info(
+        f"Обслуживание БД: удалено игр {report.get('games_purged', 0)}, "
+        f"участников {report.get('participants_purged', 0)}, прошлых пар {report['past_pairs_purged']}; "
+        f"освобождено {report['reclaimed_bytes'] / 2**20:.1f} МБ, размер {report['db_bytes'] / 2**20:.1f} МБ; "
+        f"vacuum {report['vacuum_s']} с, analyze {report['analyze_s']} с"
+    )
+    return report
@@ -0,0 +1,148 @@
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# === НАСТРОЙКИ ===
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — отдельный сервер не запускается
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        # labels -> [счётчики по бакетам..., сумма, количество]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        for labels, series in self.values.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (str(bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+class Gauge:
+    """Значение вычисляется при каждом запросе /metrics"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...],
+                 collect: Callable[[], Awaitable[Dict[Tuple[str, ...], float]]]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.collect = collect
+        REGISTRY.append(self)
+
+    async def render_async(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in (await self.collect()).items():
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+REGISTRY: List[Any] = []
+
+HANDLER_LATENCY = Histogram("santa_handler_seconds", "Время обработки обновления", ("handler",))
+HANDLER_ERRORS = Counter("santa_handler_errors_total", "Исключения в обработчиках", ("handler",))
+DB_LATENCY = Histogram("santa_db_seconds", "Время выполнения функций работы с БД", ("query",))
+MESSAGES_SENT = Counter("santa_messages_total", "Исходящие сообщения по результату", ("status",))
+UPDATES_THROTTLED = Counter("santa_throttled_updates_total", "Обновления, отброшенные ограничителем частоты", ("limit",))
+SCHEDULED_JOBS = Counter("santa_scheduled_jobs_total", "Выполненные отложенные задачи по результату", ("kind", "result"))
+MAINTENANCE_SECONDS = Histogram("santa_maintenance_seconds", "Длительность шагов обслуживания БД", ("step",),
+                                buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+MAINTENANCE_PURGED = Counter("santa_maintenance_purged_total", "Записи, удалённые при обслуживании БД", ("kind",))
+GAME_CODE_COLLISIONS = Counter("santa_game_code_collisions_total", "Повторные попытки create_game из-за занятого кода")
+DB_RECLAIMED = Counter("santa_db_reclaimed_bytes_total", "Место, возвращённое incremental_vacuum")
+
+async def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            try:
+                lines.extend(await metric.render_async())
+            except Exception as e:
+                logging.warning(f"Не удалось собрать метрику {metric.name}: {e}")
+        else:
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого обработчика (inner middleware роутера)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        # Для кнопок из CommandTable настоящий обработчик лежит в table_handler
+        target = data.get("table_handler") or getattr(data.get("handler"), "callback", None)
+        name = getattr(target, "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=await render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> web.AppRunner:
+    """Отдельный HTTP-сервер с /metrics (режимы polling и webhook)"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.types import Message
+
+import database as db
+from broadcast import CONCURRENCY, RETRY, SENT, send_once
+
+# === НАСТРОЙКИ ===
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "3600"))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", str(7 * 24 * 3600)))
+PROGRESS_INTERVAL = float(os.getenv("OUTBOX_PROGRESS_INTERVAL", "3"))
+IDLE_TIMEOUT = 60.0
+PURGE_INTERVAL = 3600.0
+
+def progress_text(total: int, counts: Dict[str, int]) -> str:
+    sent = counts.get(SENT, 0)
+    blocked = counts.get("blocked", 0)
+    failed = counts.get("failed", 0)
+    return (
+        f"📤 Рассылка: {sent + blocked + failed} из {total}\n"
+        f"✅ Доставлено: {sent}\n"
+        f"🚫 Заблокировали бота: {blocked}\n"
+        f"⚠️ Ошибки: {failed}"
+    )
+
+class Outbox:
+    """Долговременная очередь исходящих сообщений.
+
+    Обработчики только ставят сообщения в таблицу outbox, а фоновый воркер
+    их отправляет с учётом лимитов, повторяет с экспоненциальной задержкой и
+    продолжает работу после перезапуска.
+    """
+
+    def __init__(self, bot: Bot, batch_size: int = OUTBOX_BATCH_SIZE, concurrency: int = CONCURRENCY):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_purge = 0.0
+        self._progress_edited: Dict[str, float] = {}
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def enqueue(
+        self,
+        messages: List[Tuple],
+        job_id: Optional[str] = None,
+        status_message: Optional[Message] = None,
+    ) -> int:
+        """Ставит в очередь сообщения (chat_id, text, parse_mode, dedup_key).
+
+        Если передан status_message, воркер будет редактировать его, показывая прогресс.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        added = await db.run(
+            db.enqueue_messages,
+            job_id,
+            messages,
+            status_chat_id=status_message.chat.id if status_message else None,
+            status_message_id=status_message.message_id if status_message else None,
+        )
+        self.wake()
+        return added
+
+    async def send(self, chat_id: int, text: str, parse_mode: Optional[str] = None,
+                   dedup_key: Optional[str] = None) -> int:
+        return await self.enqueue([(chat_id, text, parse_mode, dedup_key)])
+
+    async def run(self):
+        """Цикл воркера; ошибка итерации (например, OperationalError) не
+        останавливает его — повтор с экспоненциальной задержкой"""
+        self._wakeup = asyncio.Event()
+        self._last_purge = 0.0
+        errors = 0
+        while True:
+            try:
+                await self._iterate()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                delay = min(OUTBOX_RETRY_BASE * 2 ** (errors - 1), IDLE_TIMEOUT)
+                logging.exception(f"Очередь сообщений: ошибка воркера ({e}), повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    async def _iterate(self):
+        self._wakeup.clear()
+        if time.time() - self._last_purge > PURGE_INTERVAL:
+            purged = await db.run(db.purge_outbox, time.time() - OUTBOX_RETENTION)
+            if purged:
+                logging.info(f"Очередь сообщений: удалено {purged} старых записей")
+            self._last_purge = time.time()
+
+        batch = await db.run(db.fetch_due_messages, time.time(), self.batch_size)
+        if batch:
+            await self._process(batch)
+            return
+
+        next_due = await db.run(db.next_due_time)
+        timeout = IDLE_TIMEOUT if next_due is None else min(IDLE_TIMEOUT, max(0.0, next_due - time.time()))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _process(self, batch: List[Tuple]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(row):
+            msg_id, job_id, chat_id, text, parse_mode, attempts = row
+            async with semaphore:
+                status = await send_once(self.bot, chat_id, text, parse_mode=parse_mode)
+            attempts += 1
+            if status != RETRY:
+                return status, attempts, time.time(), msg_id
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logging.error(f"Сообщение {msg_id} для {chat_id} не доставлено за {attempts} попыток")
+                return "failed", attempts, time.time(), msg_id
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+            return "pending", attempts, time.time() + delay, msg_id
+
+        updates = await asyncio.gather(*(deliver(row) for row in batch))
+        await db.run(db.finish_messages, updates)
+        for job_id in {row[1] for row in batch}:
+            await self._report_progress(job_id)
+
+    async def _report_progress(self, job_id: str):
+        progress = await db.run(db.get_job_progress, job_id)
+        if not progress:
+            return
+        chat_id, message_id, total, counts = progress
+        if not message_id:
+            return
+        finished = counts.get("pending", 0) == 0
+        now = time.monotonic()
+        if not finished and now - self._progress_edited.get(job_id, 0.0) < PROGRESS_INTERVAL:
+            return
+        self._progress_edited[job_id] = now
+        if finished:
+            self._progress_edited.pop(job_id, None)
+        try:
+            await self.bot.edit_message_text(progress_text(total, counts), chat_id=chat_id, message_id=message_id)
+        except TelegramBadRequest:
+            # "message is not modified" и т.п. — не мешаем рассылке
+            pass
+        except TelegramAPIError as e:
+            logging.warning(f"Не удалось обновить статус рассылки {job_id}: {e}")
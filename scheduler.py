@@ -0,0 +1,152 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import database as db
+from metrics import SCHEDULED_JOBS
+
+# === НАСТРОЙКИ ===
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "3"))
+SCHEDULER_RETRY_DELAY = float(os.getenv("SCHEDULER_RETRY_DELAY", "300"))
+# Дольше не спим даже до далёкой задачи: время задач — по настенным часам,
+# а таймеры asyncio — по монотонным, и после перевода часов они расходятся
+MAX_SLEEP = 3600.0
+REFRESH_DELAY = 1.0  # задачи из других процессов подхватываются не чаще раза в секунду
+
+# (id задачи, код игры, payload) -> None
+JobHandler = Callable[[int, str, Optional[str]], Awaitable[None]]
+
+class Scheduler:
+    """Отложенные задачи игр: автоматическая жеребьёвка и напоминания.
+
+    Задачи хранятся в таблице scheduled_jobs, а в памяти — куча (run_at, id):
+    постановка O(log n), цикл спит ровно до ближайшей задачи и таблицу не
+    опрашивает. При запуске куча заполняется одним запросом, поэтому задачи
+    переживают перезапуск. Отмена и перенос удаляют строку в таблице, а
+    устаревшие записи кучи отбрасываются при выполнении (take_job вернёт None).
+
+    Задача удаляется из таблицы перед выполнением: после падения посреди
+    выполнения она не повторится (повторная жеребьёвка хуже пропущенного
+    напоминания). Ошибка обработчика — повтор через SCHEDULER_RETRY_DELAY.
+
+    Периодические задачи (recurring) не привязаны к игре (game_code = ''):
+    после выполнения задача ставится снова через interval, при запуске
+    ставится, если её нет в таблице.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        self._last_id = 0
+        self._handlers: Dict[str, JobHandler] = {}
+        self._recurring: Dict[str, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def handler(self, kind: str):
+        def decorator(func: JobHandler) -> JobHandler:
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def recurring(self, kind: str, interval: float):
+        def decorator(func: JobHandler) -> JobHandler:
+            self._handlers[kind] = func
+            self._recurring[kind] = interval
+            return func
+        return decorator
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    async def schedule(self, kind: str, game_code: str, run_at: float, payload: Optional[str] = None,
+                       attempts: int = 0) -> int:
+        job_id = await db.run(db.schedule_job, kind, game_code, run_at, payload, attempts)
+        self._push(job_id, run_at)
+        return job_id
+
+    async def cancel(self, game_code: str, kind: Optional[str] = None) -> int:
+        return await db.run(db.cancel_jobs, game_code, kind)
+
+    def _push(self, job_id: int, run_at: float):
+        # В процессе без цикла (воркер кластера) задачу подхватит ingress
+        if self._wakeup is None:
+            return
+        heapq.heappush(self._heap, (run_at, job_id))
+        if self._heap[0][1] == job_id:
+            self._wakeup.set()
+
+    async def refresh(self):
+        """Добавляет в кучу задачи, поставленные после последней известной"""
+        # _last_id двигает только refresh: задача, поставленная в этом процессе,
+        # может попасть в кучу второй раз, но take_job выполнит её один раз
+        for job_id, run_at in await db.run(db.get_jobs_after, self._last_id):
+            self._push(job_id, run_at)
+            self._last_id = job_id
+
+    def wake(self):
+        """Подхватить задачи, поставленные другими процессами (режим кластера)"""
+        if self._wakeup is not None and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(self._refresh_later())
+
+    async def _refresh_later(self):
+        await asyncio.sleep(REFRESH_DELAY)
+        await self.refresh()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        await self.refresh()
+        scheduled = {kind for kind, _ in await db.run(db.get_game_jobs, "")}
+        for kind, interval in self._recurring.items():
+            if kind not in scheduled:
+                await self.schedule(kind, "", time.time() + interval)
+        logging.info(f"Планировщик: задач в очереди {len(self._heap)}")
+        while True:
+            while self._heap and self._heap[0][0] <= time.time():
+                _, job_id = heapq.heappop(self._heap)
+                try:
+                    await self._execute(job_id)
+                except Exception as e:
+                    logging.exception(f"Планировщик: ошибка при выполнении задачи {job_id}: {e}")
+            self._wakeup.clear()
+            timeout = MAX_SLEEP
+            if self._heap:
+                timeout = min(MAX_SLEEP, max(0.0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job_id: int):
+        job = await db.run(db.take_job, job_id)
+        if job is None:
+            return
+        kind, game_code, run_at, payload, attempts = job
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logging.error(f"Задача {job_id}: нет обработчика для вида {kind}")
+            SCHEDULED_JOBS.inc(kind, "unknown")
+            return
+        if kind in self._recurring:
+            try:
+                await handler(job_id, game_code, payload)
+                SCHEDULED_JOBS.inc(kind, "done")
+            except Exception as e:
+                logging.exception(f"Периодическая задача {kind}: {e}")
+                SCHEDULED_JOBS.inc(kind, "failed")
+            await self.schedule(kind, game_code, time.time() + self._recurring[kind], payload)
+            return
+        try:
+            await handler(job_id, game_code, payload)
+            SCHEDULED_JOBS.inc(kind, "done")
+        except Exception as e:
+            attempts += 1
+            if attempts >= SCHEDULER_MAX_ATTEMPTS:
+                logging.exception(f"Задача {kind} игры {game_code} не выполнена за {attempts} попыток: {e}")
+                SCHEDULED_JOBS.inc(kind, "failed")
+                return
+            logging.warning(f"Задача {kind} игры {game_code}: {e}; повтор через {SCHEDULER_RETRY_DELAY:.0f} с")
+            SCHEDULED_JOBS.inc(kind, "retry")
+            await self.schedule(kind, game_code, time.time() + SCHEDULER_RETRY_DELAY, payload, attempts)
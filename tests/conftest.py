@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """Соединение с новой БД во временном каталоге, схема — последней версии"""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "santa.db"))
+    db.init_db()
+    yield db.get_conn()
+    db.close_pool()
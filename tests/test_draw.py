@@ -0,0 +1,72 @@
+import itertools
+import random
+
+import pytest
+
+from draw import assign, derangement
+
+def _feasible(users, forbidden) -> bool:
+    """Перебором: есть ли распределение без подарков себе и запрещённых пар"""
+    return any(
+        all(s != w and (s, w) not in forbidden for s, w in zip(users, wards))
+        for wards in itertools.permutations(users)
+    )
+
+def _check(users, forbidden, pairs):
+    assert sorted(pairs) == sorted(users)
+    assert sorted(pairs.values()) == sorted(users)
+    for santa, ward in pairs.items():
+        assert santa != ward
+        assert (santa, ward) not in forbidden
+
+@pytest.mark.parametrize("n", [2, 3, 5, 50, 1000])
+def test_derangement_is_permutation_without_fixed_points(n):
+    users = list(range(1, n + 1))
+    for seed in range(20):
+        _check(users, set(), derangement(users, seed=seed))
+
+def test_too_few_users():
+    assert assign([]) is None
+    assert assign([1]) is None
+
+@pytest.mark.parametrize("n", [10, 200])
+def test_assign_respects_exclusions(n):
+    users = list(range(1, n + 1))
+    rng = random.Random(n)
+    for seed in range(20):
+        # Каждому запрещено дарить двоим случайным участникам
+        forbidden = {(s, w) for s in users for w in rng.sample(users, 2) if w != s}
+        pairs = assign(users, forbidden, seed=seed)
+        assert pairs is not None
+        _check(users, forbidden, pairs)
+
+def test_seed_is_reproducible():
+    users = list(range(1, 30))
+    forbidden = {(1, 2), (2, 1), (3, 4), (5, 6)}
+    assert assign(users, forbidden, seed=7) == assign(users, forbidden, seed=7)
+    assert assign(users, seed=7) == assign(users, seed=7)
+    results = {tuple(sorted(assign(users, forbidden, seed=seed).items())) for seed in range(10)}
+    assert len(results) > 1
+
+def test_none_only_when_infeasible():
+    # Все наборы запретов на малых играх: ответ совпадает с перебором
+    rng = random.Random(0)
+    for n in range(2, 6):
+        users = list(range(1, n + 1))
+        edges = [(s, w) for s in users for w in users if s != w]
+        for _ in range(300):
+            forbidden = {e for e in edges if rng.random() < 0.4}
+            pairs = assign(users, forbidden, seed=rng.randrange(1000))
+            if _feasible(users, forbidden):
+                assert pairs is not None, (users, forbidden)
+                _check(users, forbidden, pairs)
+            else:
+                assert pairs is None, (users, forbidden)
+
+def test_forbidden_everyone_but_one():
+    # Единственное допустимое распределение — цикл 1 -> 2 -> 3 -> 4 -> 1
+    users = [1, 2, 3, 4]
+    allowed = {(1, 2), (2, 3), (3, 4), (4, 1)}
+    forbidden = {(s, w) for s in users for w in users if s != w} - allowed
+    for seed in range(10):
+        assert assign(users, forbidden, seed=seed) == {1: 2, 2: 3, 3: 4, 4: 1}
@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import database as db
+from fsm_storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+OTHER = StorageKey(bot_id=1, chat_id=20, user_id=20)
+
+def test_state_survives_restart(conn):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=0.01)
+        await storage.set_state(KEY, "Form:waiting_for_wish")
+        await storage.set_data(KEY, {"game": "ABC", "page": 2})
+        await storage.close()
+
+        restarted = SQLiteStorage()
+        assert await restarted.get_state(KEY) == "Form:waiting_for_wish"
+        assert await restarted.get_data(KEY) == {"game": "ABC", "page": 2}
+        await restarted.set_state(KEY, None)
+        await restarted.set_data(KEY, {})
+        await restarted.close()
+
+    asyncio.run(scenario())
+    # Пустое состояние не хранится
+    assert conn.execute("SELECT COUNT(*) FROM fsm_states").fetchone()[0] == 0
+
+def test_expired_state_is_dropped(conn):
+    conn.execute("INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                 (SQLiteStorage._key(KEY), "Form:waiting_for_wish", None, time.time() - 100))
+    conn.commit()
+
+    async def scenario():
+        storage = SQLiteStorage(ttl=10)
+        assert await storage.get_state(KEY) is None
+        await storage.close()
+
+    asyncio.run(scenario())
+
+def test_failed_flush_keeps_changes(conn, monkeypatch):
+    save_fsm = db.save_fsm
+    calls = []
+
+    def flaky_save(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise RuntimeError("disk I/O error")
+        return save_fsm(rows)
+
+    monkeypatch.setattr(db, "save_fsm", flaky_save)
+
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=3600)
+        await storage.set_state(KEY, "Form:waiting_for_wish")
+        with pytest.raises(RuntimeError):
+            await storage.flush()
+        await storage.flush()
+        await storage.close()
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+    assert db.load_fsm(SQLiteStorage._key(KEY))[0] == "Form:waiting_for_wish"
+
+def test_change_during_flush_is_not_lost(conn, monkeypatch):
+    save_fsm = db.save_fsm
+    storage = SQLiteStorage(flush_interval=3600)
+
+    async def scenario():
+        await storage.set_state(KEY, "Form:waiting_for_wish")
+        saving = asyncio.Event()
+        release = asyncio.Event()
+        run = db.run
+
+        async def slow_run(func, *args, **kwargs):
+            if func is save_fsm:
+                saving.set()
+                await release.wait()
+            return await run(func, *args, **kwargs)
+
+        monkeypatch.setattr(db, "run", slow_run)
+        flush = asyncio.create_task(storage.flush())
+        await saving.wait()
+        await storage.set_state(KEY, "Form:waiting_for_announcement")
+        release.set()
+        await flush
+        await storage.close()
+
+    asyncio.run(scenario())
+    assert db.load_fsm(SQLiteStorage._key(KEY))[0] == "Form:waiting_for_announcement"
+
+# === REDIS ===
+
+class FakeRedis:
+    """Минимальный сервер протокола Redis (RESP2) в памяти: GET, SET [EX|PX], DEL.
+
+    Нужен только чтобы проверить FSM_STORAGE=redis:// без настоящего Redis.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"redis://127.0.0.1:{port}/0"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _read_command(self, reader: asyncio.StreamReader) -> list:
+        line = await reader.readline()
+        if not line:
+            return []
+        assert line.startswith(b"*"), line
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    def _get(self, key: bytes):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def _execute(self, name: str, args: list) -> bytes:
+        if name == "GET":
+            value = self._get(args[0])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == "SET":
+            key, value, *options = args
+            self.data[key] = value
+            self.expires.pop(key, None)
+            options = [option.upper() for option in options]
+            for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+                if unit in options:
+                    self.expires[key] = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+            return b"+OK\r\n"
+        if name == "DEL":
+            deleted = sum(self.data.pop(key, None) is not None for key in args)
+            for key in args:
+                self.expires.pop(key, None)
+            return b":%d\r\n" % deleted
+        if name in ("PING", "CLIENT", "SELECT"):
+            return b"+OK\r\n" if name != "PING" else b"+PONG\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if not command:
+                    break
+                name = command[0].decode().upper()
+                self.commands.append(name)
+                writer.write(self._execute(name, command[1:]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def test_redis_storage_is_shared_between_processes():
+    pytest.importorskip("redis", reason="redis ставится из requirements-dev.txt")
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    async def scenario():
+        fake = FakeRedis()
+        url = await fake.start()
+        # Два процесса бота с общим хранилищем
+        first = RedisStorage.from_url(url, state_ttl=60, data_ttl=60)
+        second = RedisStorage.from_url(url, state_ttl=60, data_ttl=60)
+        try:
+            await first.set_state(KEY, "Form:waiting_for_wish")
+            await first.set_data(KEY, {"game": "ABC"})
+            assert await second.get_state(KEY) == "Form:waiting_for_wish"
+            assert await second.get_data(KEY) == {"game": "ABC"}
+            assert await second.get_state(OTHER) is None
+
+            await second.set_state(KEY, None)
+            await second.set_data(KEY, {})
+            assert await first.get_state(KEY) is None
+            assert await first.get_data(KEY) == {}
+            # Состояния живут не дольше FSM_TTL
+            assert all(expires > time.monotonic() for expires in fake.expires.values())
+        finally:
+            await first.close()
+            await second.close()
+            await fake.stop()
+        assert {"GET", "SET", "DEL"} <= set(fake.commands)
+
+    asyncio.run(scenario())
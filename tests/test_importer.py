@@ -0,0 +1,44 @@
+import asyncio
+import json
+import time
+
+import database as db
+import importer
+
+def _import(path, game_code, batch_size=importer.IMPORT_BATCH_SIZE) -> dict:
+    return asyncio.run(importer.import_file(str(path), game_code, batch_size))
+
+def test_batch_larger_than_sqlite_variable_limit(conn, tmp_path):
+    game_code = db.create_game(1)
+    db.join_game(100, "user100", "Уже в игре", game_code)
+    path = tmp_path / "players.csv"
+    lines = ["user_id,full_name,username"] + [f"{uid},Игрок {uid},player{uid}" for uid in range(100, 3100)]
+    path.write_text("\n".join(lines + ["3000,Повтор,again"]) + "\n", encoding="utf-8")
+
+    report = _import(path, game_code, batch_size=5000)
+    assert report["fatal"] is None
+    assert (report["added"], report["duplicates"]) == (2999, 2)
+    assert db.get_game_stats(game_code)[0] == 3000
+
+def test_broken_json_array_fails_fast(conn, tmp_path, monkeypatch):
+    game_code = db.create_game(1)
+    path = tmp_path / "players.json"
+    good = [{"user_id": uid, "full_name": f"Игрок {uid}"} for uid in range(100, 110)]
+    # Незакрытая строка: раньше буфер рос до конца файла, разбор каждый раз начинался заново
+    path.write_text(json.dumps(good)[:-1] + ', {"full_name": "' + "x" * 5_000_000, encoding="utf-8")
+
+    start = time.perf_counter()
+    report = _import(path, game_code)
+    assert time.perf_counter() - start < 5
+    assert report["added"] == 10
+    assert "JSON" in report["fatal"]
+
+def test_invalid_rows_are_reported(conn, tmp_path):
+    game_code = db.create_game(1)
+    path = tmp_path / "players.jsonl"
+    path.write_text('{"user_id": 100, "full_name": "Игрок"}\n{"user_id": -1, "full_name": "X"}\nне JSON\n',
+                    encoding="utf-8")
+    report = _import(path, game_code, batch_size=2)
+    assert report["added"] == 1
+    assert report["errors"] == 2
+    assert [line for line, _ in report["error_samples"]] == [2, 3]
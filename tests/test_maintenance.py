@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import database as db
+import maintenance
+
+def _idle_game(conn, players: int) -> str:
+    game_code = db.create_game(1)
+    for user_id in range(100, 100 + players):
+        db.join_game(user_id, f"user{user_id}", f"User {user_id}", game_code)
+    conn.execute("UPDATE game_stats SET last_activity = ? WHERE game_code = ?",
+                 (time.time() - 365 * 86400, game_code))
+    conn.commit()
+    return game_code
+
+def _purge_with(monkeypatch, action) -> dict:
+    """purge_idle_games, где action выполняется после первой пачки участников"""
+    monkeypatch.setattr(maintenance, "MAINTENANCE_BATCH", 2)
+    run = db.run
+    batches = []
+
+    async def run_between_batches(func, *args, **kwargs):
+        result = await run(func, *args, **kwargs)
+        if func is db.purge_game_rows:
+            batches.append(result)
+            if len(batches) == 1:
+                action()
+        return result
+
+    monkeypatch.setattr(db, "run", run_between_batches)
+    deleted = []
+
+    async def on_game_deleted(game_code, creator_id):
+        deleted.append(game_code)
+
+    report = asyncio.run(maintenance.purge_idle_games(on_game_deleted))
+    report["deleted"] = deleted
+    return report
+
+def test_idle_game_is_deleted(conn, monkeypatch):
+    game_code = _idle_game(conn, 5)
+    report = _purge_with(monkeypatch, lambda: None)
+    assert report == {"games": 1, "participants": 5, "deleted": [game_code]}
+    assert db.get_game_stats(game_code) is None
+
+def test_join_during_purge_keeps_game(conn, monkeypatch):
+    game_code = _idle_game(conn, 5)
+    report = _purge_with(monkeypatch, lambda: db.join_game(500, "late", "Late", game_code))
+    assert report["games"] == 0 and report["deleted"] == []
+    assert db.get_participant(500) is not None
+    assert db.get_game_stats(game_code)[0] == 4  # трое исходных и новый участник
+
+def test_draw_during_purge_keeps_game(conn, monkeypatch):
+    game_code = _idle_game(conn, 5)
+    report = _purge_with(monkeypatch, lambda: db.assign_pairs(game_code, seed=1))
+    assert report["games"] == 0
+    assert db.is_draw_done(game_code)
+    assert len(db.get_draw_results(game_code)) == 3
+
+def test_check_game_stats_keeps_draw_done(conn):
+    game_code = _idle_game(conn, 4)
+    db.assign_pairs(game_code, seed=1)
+    for user_id in range(100, 104):
+        db.leave_game(user_id)
+    # Счётчик участников расходится, флаг жеребьёвки при этом не сбрасывается
+    conn.execute("UPDATE game_stats SET participant_count = 7 WHERE game_code = ?", (game_code,))
+    conn.commit()
+
+    mismatches = db.check_game_stats(fix=True)
+    assert [(code, actual[2]) for code, _, actual in mismatches] == [(game_code, 1)]
+    assert db.is_draw_done(game_code)
+    assert db.check_game_stats() == []
@@ -0,0 +1,34 @@
+import database as db
+
+def _players(count: int) -> str:
+    game_code = db.create_game(1)
+    for user_id in range(100, 100 + count):
+        db.join_game(user_id, f"user{user_id}", f"Игрок {user_id}", game_code)
+    return game_code
+
+def _walk(game_code: str, limit: int) -> list:
+    """Все участники, страница за страницей вперёд"""
+    seen = []
+    rows, has_more = db.get_participants_page(game_code, limit=limit)
+    seen += rows
+    while has_more:
+        rows, has_more = db.get_participants_page(game_code, after=rows[-1][1::-1], limit=limit)
+        seen += rows
+    return [row[0] for row in seen]
+
+def test_pages_cover_everyone_once(conn):
+    game_code = _players(7)
+    assert _walk(game_code, 3) == list(range(100, 107))
+
+def test_page_after_boundary_participant_left(conn):
+    game_code = _players(6)
+    rows, has_more = db.get_participants_page(game_code, limit=3)
+    assert has_more
+    boundary = rows[-1]
+    db.leave_game(boundary[0])
+
+    cursor = (boundary[1], boundary[0])
+    rows, has_more = db.get_participants_page(game_code, after=cursor, limit=3)
+    assert [row[0] for row in rows] == [103, 104, 105]
+    rows, _ = db.get_participants_page(game_code, before=cursor, limit=3)
+    assert [row[0] for row in rows] == [100, 101]
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+import database as db
+
+# Функции, которые выполняются на каждое обновление, в рассылке, планировщике
+# и обслуживании. Они не должны читать таблицы целиком: время запроса не
+# должно расти с числом игр и участников.
+# Намеренно не проверяются выборки по всей БД: get_all_participants (/admin_alarm),
+# первые страницы get_users_page и get_games_page, счётчики для /metrics
+# (count_outbox, count_fsm_states) и check_game_stats.
+CREATOR = 100
+PLAYERS = [101, 102, 103, 104]
+NEWCOMER = 200
+
+def _game(conn) -> str:
+    """Игра с участниками, пожеланиями и исключением"""
+    game_code = db.create_game(CREATOR)
+    for user_id in [CREATOR] + PLAYERS:
+        db.join_game(user_id, f"user{user_id}", f"User {user_id}", game_code)
+    db.set_wish(PLAYERS[0], "книга")
+    db.add_exclusion(game_code, PLAYERS[0], PLAYERS[1])
+    return game_code
+
+def _drawn_game(conn) -> str:
+    game_code = _game(conn)
+    db.assign_pairs(game_code, seed=1)
+    return game_code
+
+def _calls(game_code: str, drawn: bool):
+    """(название, вызов) для проверки; drawn — игра уже после жеребьёвки"""
+    now = time.time()
+    calls = [
+        ("get_creator_game", lambda: db.get_creator_game(CREATOR)),
+        ("get_creator_id", lambda: db.get_creator_id(game_code)),
+        ("is_creator", lambda: db.is_creator(CREATOR, game_code)),
+        ("is_draw_done", lambda: db.is_draw_done(game_code)),
+        ("get_game_stats", lambda: db.get_game_stats(game_code)),
+        ("get_participant", lambda: db.get_participant(PLAYERS[0])),
+        ("get_participants", lambda: db.get_participants(game_code)),
+        ("get_user_games", lambda: db.get_user_games(PLAYERS[0])),
+        ("get_participants_page", lambda: db.get_participants_page(game_code, limit=2)),
+        ("get_participants_page after", lambda: db.get_participants_page(game_code, after=("User 101", 101), limit=2)),
+        ("get_participants_page before", lambda: db.get_participants_page(game_code, before=("User 103", 103), limit=2)),
+        ("get_users_page after", lambda: db.get_users_page(after=1, limit=2)),
+        ("get_games_page after", lambda: db.get_games_page(after="A", limit=2)),
+        ("find_participant", lambda: db.find_participant(game_code, f"@user{PLAYERS[1]}")),
+        ("find_participant id", lambda: db.find_participant(game_code, str(PLAYERS[1]))),
+        ("set_active_game", lambda: db.set_active_game(PLAYERS[0], game_code)),
+        ("set_wish", lambda: db.set_wish(PLAYERS[1], "шарф")),
+        ("join_game", lambda: db.join_game(NEWCOMER, "newcomer", "New", game_code)),
+        ("leave_game", lambda: db.leave_game(NEWCOMER)),
+        ("create_game", lambda: db.create_game(CREATOR + 1000)),
+        ("get_export_page", lambda: db.get_export_page(game_code, None, 100)),
+        ("get_export_page full", lambda: db.get_export_page(game_code, 1, 100, full=True)),
+        ("get_reminder_targets", lambda: db.get_reminder_targets(game_code)),
+        ("schedule_job", lambda: db.schedule_job("draw", game_code, now + 60)),
+        ("get_game_jobs", lambda: db.get_game_jobs(game_code)),
+        ("get_jobs_after", lambda: db.get_jobs_after(0)),
+        ("take_job", lambda: db.take_job(1)),
+        ("cancel_jobs", lambda: db.cancel_jobs(game_code, "draw")),
+        ("enqueue_messages", lambda: db.enqueue_messages("job", [(PLAYERS[0], "текст", None, "key")])),
+        ("fetch_due_messages", lambda: db.fetch_due_messages(now, 100)),
+        ("next_due_time", lambda: db.next_due_time()),
+        ("finish_messages", lambda: db.finish_messages([("sent", 1, now, 1)])),
+        ("get_job_progress", lambda: db.get_job_progress("job")),
+        ("purge_outbox", lambda: db.purge_outbox(now + 1)),
+        ("save_fsm", lambda: db.save_fsm([("k1", "Form:waiting_for_wish", None, now), ("k2", None, None, now)])),
+        ("load_fsm", lambda: db.load_fsm("k1")),
+        ("purge_fsm", lambda: db.purge_fsm(now - 3600)),
+        ("get_idle_games", lambda: db.get_idle_games(now, 100)),
+        ("get_finished_games", lambda: db.get_finished_games(now, 100)),
+        ("purge_past_pairs", lambda: db.purge_past_pairs(now, 100)),
+        ("delete_user", lambda: db.delete_user(f"@user{PLAYERS[3]}")),
+    ]
+    if drawn:
+        calls += [
+            ("get_draw_results", lambda: db.get_draw_results(game_code)),
+            ("mark_gift_bought", lambda: db.mark_gift_bought(PLAYERS[0])),
+            ("delete_game", lambda: db.delete_game(game_code)),
+            ("delete_game idle", lambda: db.delete_game(game_code, now + 1)),
+        ]
+    else:
+        calls += [
+            ("import_participants", lambda: db.import_participants(
+                game_code, [(NEWCOMER + 1, "u1", "Imported"), (PLAYERS[0], "dup", "Dup")])),
+            ("assign_pairs", lambda: db.assign_pairs(game_code, seed=1)),
+            ("purge_game_rows", lambda: db.purge_game_rows(game_code, now + 1, 2)),
+        ]
+    return calls
+
+def _statements(conn, call) -> list:
+    """SQL-выражения, выполненные вызовом (с подставленными значениями)"""
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    skip = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+    return [sql for sql in statements if not sql.lstrip().upper().startswith(skip)]
+
+def _scans(conn, sql: str) -> list:
+    """Строки плана, где таблица или индекс читается целиком"""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return [detail for *_, detail in plan if detail.startswith("SCAN") and detail != "SCAN CONSTANT ROW"]
+
+@pytest.mark.parametrize("drawn", [False, True], ids=["before_draw", "after_draw"])
+def test_hot_queries_do_not_scan(conn, drawn):
+    game_code = _drawn_game(conn) if drawn else _game(conn)
+    # Прошлые пары: жеребьёвка учитывает их в отдельном запросе
+    conn.execute("INSERT INTO past_pairs (santa_id, ward_id, archived_at) VALUES (?, ?, ?)",
+                 (PLAYERS[0], PLAYERS[2], time.time()))
+    conn.commit()
+
+    problems = []
+    for name, call in _calls(game_code, drawn):
+        for sql in _statements(conn, call):
+            scans = _scans(conn, sql)
+            if scans:
+                problems.append(f"{name}: {' '.join(sql.split())}\n    {scans}")
+    assert not problems, "Полный просмотр таблиц:\n" + "\n".join(problems)
@@ -0,0 +1,134 @@
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import UPDATES_THROTTLED
+
+# === НАСТРОЙКИ ===
+# Лимит 0 отключает соответствующую проверку
+THROTTLE_USER_LIMIT = int(os.getenv("THROTTLE_USER_LIMIT", "20"))
+THROTTLE_USER_PERIOD = float(os.getenv("THROTTLE_USER_PERIOD", "10"))
+THROTTLE_ACTION_LIMIT = int(os.getenv("THROTTLE_ACTION_LIMIT", "5"))
+THROTTLE_ACTION_PERIOD = float(os.getenv("THROTTLE_ACTION_PERIOD", "60"))
+
+# Действия, каждое из которых стоит запросов к БД и исходящих сообщений
+THROTTLED_ACTIONS = (
+    "🎅 Написать Санте",
+    "👧 Написать подопечному",
+    "🎲 Жеребьёвка",
+    "/draw",
+    "📣 Отправить объявление",
+    "gift_bought",
+    "/import",
+    "/export",
+    "/admin_export",
+)
+
+WARNING_TEXT = "⏳ Слишком много запросов. Подождите немного и попробуйте снова."
+
+class SlidingWindow:
+    """Ограничение «не больше limit событий за period секунд» на ключ.
+
+    Скользящее окно приближается двумя счётчиками — текущего и предыдущего
+    окна фиксированной длины, вклад предыдущего убывает линейно. На ключ
+    хранится одна короткая запись, а не список отметок времени. Записи, у
+    которых оба окна истекли, удаляются при очередной проверке раз в period.
+    """
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        # ключ -> [начало текущего окна, счётчик предыдущего, счётчик текущего, предупреждён]
+        self._entries: Dict[Any, List] = {}
+        self._last_evict = 0.0
+
+    def hit(self, key: Any, now: float) -> Tuple[bool, bool]:
+        """(разрешено, нужно ли предупредить) — предупреждаем один раз за окно"""
+        if now - self._last_evict > self.period:
+            self.evict(now)
+        window = now - now % self.period
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [window, 0, 0, False]
+        elif entry[0] < window:
+            previous = entry[2] if entry[0] == window - self.period else 0
+            entry[:] = [window, previous, 0, False]
+
+        weight = 1.0 - (now - window) / self.period
+        if entry[1] * weight + entry[2] >= self.limit:
+            warn = not entry[3]
+            entry[3] = True
+            return False, warn
+        entry[2] += 1
+        return True, False
+
+    def evict(self, now: float):
+        self._last_evict = now
+        expired = now - now % self.period - self.period
+        for key in [k for k, entry in self._entries.items() if entry[0] < expired]:
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+def action_of(update: Update) -> Optional[str]:
+    """Текст кнопки, команда без аргументов или callback_data"""
+    if update.message is not None and update.message.text:
+        text = update.message.text
+        if text.startswith("/"):
+            return text.split(maxsplit=1)[0].split("@", 1)[0]
+        return text
+    if update.callback_query is not None:
+        return update.callback_query.data
+    return None
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает обновления пользователя, превысившего лимиты частоты.
+
+    Регистрируется outer-middleware на update раньше FSM-middleware, поэтому
+    отброшенное обновление не читает состояние и не доходит до БД.
+    """
+
+    def __init__(self, actions: Tuple[str, ...] = THROTTLED_ACTIONS):
+        self.user_window = SlidingWindow(THROTTLE_USER_LIMIT, THROTTLE_USER_PERIOD)
+        self.action_window = SlidingWindow(THROTTLE_ACTION_LIMIT, THROTTLE_ACTION_PERIOD)
+        self.actions = frozenset(actions)
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        action = action_of(event)
+        limit = None
+        if action in self.actions and self.action_window.limit > 0:
+            allowed, warn = self.action_window.hit((user.id, action), now)
+            if not allowed:
+                limit = action
+        if limit is None and self.user_window.limit > 0:
+            allowed, warn = self.user_window.hit(user.id, now)
+            if not allowed:
+                limit = "user"
+        if limit is None:
+            return await handler(event, data)
+
+        UPDATES_THROTTLED.inc(limit)
+        if warn:
+            await self._warn(event)
+        return None
+
+    @staticmethod
+    async def _warn(event: Update):
+        if event.callback_query is not None:
+            await event.callback_query.answer(WARNING_TEXT)
+        elif event.message is not None:
+            await event.message.answer(WARNING_TEXT)
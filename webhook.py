@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from metrics import metrics_handler
+
+# === НАСТРОЙКИ ===
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://santa.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Обязателен: админские команды проверяют только from.id, без секрета
+# поддельное обновление на публичный адрес выполнилось бы от имени админа
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+def create_app(dp: Dispatcher, bot: Bot, with_metrics: bool = False) -> web.Application:
+    """aiohttp-приложение: приём обновлений на WEBHOOK_PATH и /health.
+
+    with_metrics — ещё и /metrics; только для слушателя на localhost (воркер
+    кластера), публичный webhook отдаёт метрики отдельным сервером на METRICS_HOST.
+    """
+    app = web.Application()
+    app.router.add_get("/health", health)
+    if with_metrics:
+        app.router.add_get("/metrics", metrics_handler)
+    # Обновления обрабатываются внутри запроса, поэтому при остановке
+    # aiohttp дожидается всех уже принятых обновлений
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=False,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def wait_for_signal():
+    """Ждёт SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await stop.wait()
+
+async def run_webhook(dp: Dispatcher, bot: Bot, register: bool = True):
+    """Запускает HTTP-сервер и работает до SIGINT/SIGTERM.
+
+    register=False — не регистрировать webhook в Telegram (воркер кластера,
+    обновления ему передаёт ingress).
+    """
+    if register and not WEBHOOK_URL:
+        raise ValueError("Для режима webhook нужна переменная окружения WEBHOOK_URL!")
+    if not WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook нужна переменная окружения WEBHOOK_SECRET (A-Z, a-z, 0-9, _ и -)!")
+
+    runner = web.AppRunner(create_app(dp, bot, with_metrics=not register))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    if register:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logging.info(f"Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await wait_for_signal()
+    finally:
+        logging.info("Остановка webhook: дожидаемся обработки принятых обновлений")
+        await runner.cleanup()